@@ -13,6 +13,12 @@ setup(
         'lxml',
         'bleach'
     ],
+    extras_require={
+        'async': ['aiohttp>=3.9'],
+        'fastjson': ['orjson'],
+        'streaming': ['ijson'],
+        'numpy': ['numpy']
+    },
     author="Mike Bennett",
     author_email="mike.bennett@ed.ac.uk",
     description="Whiiif - Word Highlighting (in) IIIF. Whiiif is an implementation of the IIIF Search API designed to provide full-text search with granular, word-level Annotation results to enable front-end highlighting.",
@@ -0,0 +1,165 @@
+""" bench_endpoints.py: throughput, latency percentiles and peak memory of the search, snippet and collection views
+
+    python tests/benchmarks/bench_endpoints.py [--sizes 1 16 256 4096] [--documents 200] [--requests 20]
+                                               [--json results.json] [--baseline previous.json]
+
+The views are driven through the Flask test client against a local stub SOLR (stub_solr.py), which answers every
+query with a synthetic ocrHighlighting response of the given size, so SOLR's own time is left out but the HTTP round
+trip and response parsing are not. The response caches are turned off so that every request does the full work.
+make_annotations() is also timed on its own, from already grouped hits. Peak memory is measured with tracemalloc over
+a separate request, as tracing slows the timed ones down.
+
+Write the results as JSON with --json, and compare a run against an earlier one with --baseline.
+"""
+
+import argparse
+import json
+import math
+import os
+import platform
+import subprocess
+import tempfile
+import time
+import tracemalloc
+
+from stub_solr import StubSolr
+from synthetic import synthetic_manifest, synthetic_response
+from whiiif import app, highlights, serializer, views
+from whiiif import manifests as manifest_cache
+
+
+def percentile(ordered, percent):
+    """Nearest-rank percentile of a sorted list"""
+    return ordered[max(0, math.ceil(percent / 100 * len(ordered)) - 1)]
+
+
+def measure(request, count):
+    """Time count calls of request (after one to warm up), then trace the memory of one more"""
+    response_bytes = request()
+    latencies = []
+    for _ in range(count):
+        start = time.perf_counter()
+        request()
+        latencies.append(time.perf_counter() - start)
+    latencies.sort()
+
+    tracemalloc.start()
+    request()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return {"requests": count,
+            "throughput_rps": count / sum(latencies),
+            "p50_ms": percentile(latencies, 50) * 1000,
+            "p90_ms": percentile(latencies, 90) * 1000,
+            "p99_ms": percentile(latencies, 99) * 1000,
+            "max_ms": latencies[-1] * 1000,
+            "peak_kb": peak // 1024,
+            "response_bytes": response_bytes}
+
+
+def get(client, url):
+    def request():
+        rv = client.get(url)
+        body = rv.get_data()  # reads streamed responses to the end
+        assert rv.status_code == 200, (url, rv.status_code)
+        return len(body)
+    return request
+
+
+def write_manifests(manifest_dir, documents, canvases):
+    """Write a manifest, and the canvas index the indexer would write, for each synthetic document"""
+    manifest = synthetic_manifest(canvases)
+    manifest_json = json.dumps(manifest)
+    images = manifest_cache.manifest_canvas_images(manifest)
+    for idx in range(documents):
+        document = "synthetic-{}".format(idx)
+        with open(os.path.join(manifest_dir, document + ".json"), "w", encoding="utf8") as manifest_file:
+            manifest_file.write(manifest_json)
+        manifest_cache.write_canvas_index(manifest_cache.canvas_index_path(document), images)
+
+
+def bench(sizes, documents, collection_snippets, canvases, count):
+    rows = []
+    with StubSolr() as stub, tempfile.TemporaryDirectory() as manifest_dir:
+        app.config.update(SOLR_URL=stub.url, SOLR_CORE=stub.core, MANIFEST_LOCATION=manifest_dir,
+                          CANVAS_INDEX_LOCATION=manifest_dir, SEARCH_CACHE_SIZE=0, SNIPPETS_CACHE_SIZE=0,
+                          COLLECTION_CACHE_SIZE=0, PROFILE_SAMPLE_RATE=0, SERVER_NAME='localhost:5000')
+        write_manifests(manifest_dir, documents, canvases)
+        client = app.test_client()
+
+        for size in sizes:
+            results_json = synthetic_response(1, size, canvases)
+            stub.respond(serializer.dumpb(results_json))
+            rows.append(dict(endpoint="search", snippets=size,
+                             **measure(get(client, "/search/synthetic-0?q=edinburgh"), count)))
+            rows.append(dict(endpoint="snippets", snippets=size,
+                             **measure(get(client, "/snippets/synthetic-0?q=edinburgh"), count)))
+            with app.test_request_context("/search/synthetic-0?q=edinburgh"):
+                results, total, _ = views.search_results(results_json, results_json["response"]["docs"])
+
+                def annotate():
+                    views.make_annotations(results, total, [])
+                rows.append(dict(endpoint="make_annotations", snippets=size, **measure(annotate, count)))
+
+        stub.respond(serializer.dumpb(synthetic_response(documents, collection_snippets, canvases)))
+        rows.append(dict(endpoint="collection", snippets=documents * collection_snippets,
+                         **measure(get(client, "/collection/search?q=edinburgh"), count)))
+        assert stub.queries == (len(sizes) * 2 + 1) * (count + 2)
+    return rows
+
+
+def environment():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {"time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "commit": commit,
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "serializer": serializer.backend,
+            "stream_parse": highlights.streaming_enabled()}
+
+
+def compare(rows, baseline):
+    """Print the change in median latency and throughput of each benchmark from a baseline run"""
+    previous = {(row["endpoint"], row["snippets"]): row for row in baseline["results"]}
+    print("\nCompared to {} ({}):".format(baseline["environment"]["commit"], baseline["environment"]["time"]))
+    print("{:>16} {:>8} {:>12} {:>14}".format("endpoint", "snippets", "p50 change", "req/s change"))
+    for row in rows:
+        before = previous.get((row["endpoint"], row["snippets"]))
+        if before is None:
+            continue
+        print("{:>16} {:>8} {:>+11.1f}% {:>+13.1f}%".format(
+            row["endpoint"], row["snippets"], (row["p50_ms"] / before["p50_ms"] - 1) * 100,
+            (row["throughput_rps"] / before["throughput_rps"] - 1) * 100))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the Whiiif search views against a stub SOLR")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1, 16, 256, 4096], help='snippets per response')
+    parser.add_argument('--documents', type=int, default=200, help='documents in the Collection Search response')
+    parser.add_argument('--collection-snippets', type=int, default=5, help='snippets per Collection Search document')
+    parser.add_argument('--canvases', type=int, default=500, help='canvases in each synthetic manifest')
+    parser.add_argument('--requests', type=int, default=20, help='timed requests per benchmark')
+    parser.add_argument('--json', metavar='PATH', help='write the results to this file as JSON')
+    parser.add_argument('--baseline', metavar='PATH', help='JSON results of an earlier run to compare against')
+    args = parser.parse_args()
+
+    results = bench(args.sizes, args.documents, args.collection_snippets, args.canvases, args.requests)
+
+    print("{:>16} {:>8} {:>10} {:>9} {:>9} {:>9} {:>10} {:>12}".format(
+        "endpoint", "snippets", "req/s", "p50 ms", "p90 ms", "p99 ms", "peak KB", "bytes"))
+    for row in results:
+        print("{endpoint:>16} {snippets:>8} {throughput_rps:>10.1f} {p50_ms:>9.2f} {p90_ms:>9.2f} {p99_ms:>9.2f} "
+              "{peak_kb:>10} {response_bytes!s:>12}".format(**row))
+
+    if args.json:
+        with open(args.json, "w", encoding="utf8") as json_file:
+            json.dump({"environment": environment(), "arguments": vars(args), "results": results}, json_file,
+                      indent=2)
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf8") as baseline_file:
+            compare(results, json.load(baseline_file))
@@ -0,0 +1,99 @@
+""" bench_escape.py: compare streaming ALTO escaping against reading the whole file, and against the iterparse
+normalizer that replaced it (keeping the whole ALTO, and stripping it), on time and peak RSS
+
+    python tests/benchmarks/bench_escape.py [--sizes 16 64 256] [--chunk-size 1048576]
+
+Sizes are in MB. Each escape runs in a fresh interpreter, so that its peak RSS isn't hidden by an earlier, larger run.
+"""
+
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+from synthetic import write_alto
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir, os.pardir, "utils"))
+
+
+def whole_file_escape(alto, out_path, chunk_size):
+    """The escaper before streaming: read, replace and encode the whole file, then write it out"""
+    with open(alto, "r", encoding="utf8") as alto_file:
+        alto_in = alto_file.read()
+    alto_out = alto_in.replace("encoding=\"UTF-8\"", "encoding=\"ASCII\"").encode('ascii', 'xmlcharrefreplace')
+    with open(out_path, 'wb') as out_file:
+        out_file.write(alto_out)
+
+
+def stream_escape(alto, out_path, chunk_size):
+    from index_with_plugin import escape_stream
+    with open(alto, "r", encoding="utf8") as alto_file, open(out_path, 'wb') as out_file:
+        escape_stream(alto_file, out_file, chunk_size)
+
+
+def normalize(alto, out_path, chunk_size):
+    from alto_normalize import normalize_alto
+    with open(out_path, 'wb') as out_file:
+        normalize_alto(alto, out_file)
+
+
+def normalize_strip(alto, out_path, chunk_size):
+    from alto_normalize import normalize_alto
+    with open(out_path, 'wb') as out_file:
+        normalize_alto(alto, out_file, strip=True)
+
+
+approaches = {"whole": whole_file_escape, "stream": stream_escape, "normalize": normalize, "strip": normalize_strip}
+
+
+def run(approach, alto, out_path, chunk_size):
+    import index_with_plugin  # noqa: F401 - both approaches pay for the same imports
+    baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.perf_counter()
+    approaches[approach](alto, out_path, chunk_size)
+    elapsed = time.perf_counter() - start
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print(json.dumps({"seconds": elapsed, "peak_rss_mb": peak / 1024, "escape_rss_mb": (peak - baseline) / 1024}))
+
+
+def bench(sizes, chunk_size):
+    rows = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for size in sizes:
+            alto = os.path.join(tmp, "alto.xml")
+            write_alto(alto, size * 1024 * 1024)
+            outputs = {}
+            for approach in approaches:
+                out_path = os.path.join(tmp, approach + "_escaped.xml")
+                child = subprocess.run([sys.executable, __file__, "--run", approach, alto, out_path,
+                                        "--chunk-size", str(chunk_size)],
+                                       check=True, capture_output=True, text=True, cwd=tmp)
+                row = json.loads(child.stdout.splitlines()[-1])
+                row.update({"approach": approach, "size_mb": size, "out_mb": os.path.getsize(out_path) / 1024 / 1024})
+                rows.append(row)
+                if approach in ("whole", "stream"):  # the normalizers' output is meant to differ
+                    with open(out_path, "rb") as out_file:
+                        outputs[approach] = out_file.read()
+            assert outputs["whole"] == outputs["stream"], "escapers disagree"
+    return rows
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark ALTO escaping and normalization for the indexing tool")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[16, 64, 256], help='ALTO file sizes in MB')
+    parser.add_argument('--chunk-size', type=int, default=1024 * 1024, help='characters escaped at a time')
+    parser.add_argument('--run', nargs=3, metavar=('APPROACH', 'ALTO', 'OUT'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run:
+        run(*args.run, chunk_size=args.chunk_size)
+    else:
+        print("{:>9} {:>8} {:>10} {:>14} {:>16} {:>8}".format("approach", "size MB", "seconds", "peak RSS MB",
+                                                              "escape RSS MB", "out MB"))
+        for row in bench(args.sizes, args.chunk_size):
+            print("{approach:>9} {size_mb:>8} {seconds:>10.3f} {peak_rss_mb:>14.1f} {escape_rss_mb:>16.1f} "
+                  "{out_mb:>8.1f}".format(**row))
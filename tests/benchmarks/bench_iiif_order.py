@@ -0,0 +1,124 @@
+""" bench_iiif_order.py: compare IIIF key ordering in utils/iiif_order.py against the recursive implementation it
+replaced, on time and peak memory, when ordering and writing a large manifest
+
+    python tests/benchmarks/bench_iiif_order.py [--canvases 10000] [--repeat 3]
+
+Each approach is run on a manifest with its keys out of order, and on one that is already in canonical order (as a
+manifest is when the indexing tool has written it before).
+"""
+
+import argparse
+import io
+import json
+import os
+import sys
+import timeit
+import tracemalloc
+from collections import OrderedDict
+
+from synthetic import synthetic_manifest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir, os.pardir, "utils"))
+
+import iiif_order  # noqa: E402
+
+
+def recursive_order_object(object, object_type, recursive=False):
+    """The ordering before iiif_order's rank table: key lists scanned per object, recursing in Python"""
+    ordered = OrderedDict()
+    for key in iiif_order.object_keys[object_type]:
+        if key in object:
+            ordered[key] = object[key]
+    for key in set(object.keys()) - set(iiif_order.object_keys[object_type]):
+        ordered[key] = object[key]
+    if recursive and object_type in iiif_order.recursive_keys:
+        for key, subtype in iiif_order.recursive_keys[object_type]:
+            if key in ordered:
+                if type(ordered[key]) == list:
+                    for idx, val in enumerate(ordered[key]):
+                        ordered[key][idx] = recursive_order_object(ordered[key][idx], subtype, recursive=True)
+                elif type(ordered[key]) == dict or type(ordered[key]) == OrderedDict:
+                    ordered[key] = recursive_order_object(ordered[key], subtype, recursive=True)
+    return ordered
+
+
+def recursive_write(manifest):
+    out = io.StringIO()
+    json.dump(recursive_order_object(manifest, "manifest", recursive=True), out, indent=2)
+    return out
+
+
+def iterative_write(manifest):
+    out = io.StringIO()
+    json.dump(iiif_order.order_object(manifest, "manifest", recursive=True), out, indent=2)
+    return out
+
+
+def lazy_write(manifest):
+    out = io.StringIO()
+    iiif_order.dump_ordered(manifest, "manifest", out, indent=2)
+    return out
+
+
+approaches = {"recursive": (recursive_order_object, recursive_write),
+              "iterative": (iiif_order.order_object, iterative_write),
+              "lazy": (None, lazy_write)}
+
+
+def shuffled(canvases):
+    return json.loads(json.dumps(synthetic_manifest(canvases)))
+
+
+def canonical(canvases):
+    return json.loads(json.dumps(recursive_order_object(shuffled(canvases), "manifest", recursive=True)))
+
+
+def best_of(func, make_manifest, canvases, repeat):
+    times = []
+    for run in range(repeat):
+        manifest = make_manifest(canvases)  # the eager orderers update children in place, so each run gets its own
+        times.append(timeit.timeit(lambda: func(manifest), number=1))
+    return min(times)
+
+
+def peak_bytes(func, manifest):
+    tracemalloc.start()
+    kept = func(manifest)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    del kept
+    return peak
+
+
+def bench(canvases, repeat):
+    rows = []
+    for make_manifest in (shuffled, canonical):
+        outputs = {name: write(make_manifest(canvases)).getvalue() for name, (order, write) in approaches.items()}
+        assert outputs["iterative"] == outputs["lazy"], "ordered and lazily ordered output differ"
+        assert json.loads(outputs["recursive"]) == json.loads(outputs["iterative"]), "orderers disagree"
+
+        for name, (order, write) in approaches.items():
+            row = {"approach": name,
+                   "input": make_manifest.__name__,
+                   "order_ms": None,
+                   "write_ms": best_of(write, make_manifest, canvases, repeat) * 1000,
+                   "peak_mb": peak_bytes(write, make_manifest(canvases)) / 1024 / 1024,
+                   "output_mb": len(outputs[name]) / 1024 / 1024}
+            if order is not None:
+                row["order_ms"] = best_of(lambda manifest: order(manifest, "manifest", recursive=True), make_manifest,
+                                          canvases, repeat) * 1000
+            rows.append(row)
+    return rows
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark IIIF key ordering for the indexing tool's --modify")
+    parser.add_argument('--canvases', type=int, default=10000, help='canvases in the synthetic manifest')
+    parser.add_argument('--repeat', type=int, default=3, help='timing runs to take the best of')
+    args = parser.parse_args()
+
+    print("{:>10} {:>10} {:>10} {:>10} {:>14} {:>10}".format("approach", "input", "order ms", "write ms",
+                                                             "write peak MB", "output MB"))
+    for row in bench(args.canvases, args.repeat):
+        print("{approach:>10} {input:>10} {order:>10} {write_ms:>10.1f} {peak_mb:>14.1f} {output_mb:>10.1f}".format(
+            order="-" if row["order_ms"] is None else "{:.1f}".format(row["order_ms"]), **row))
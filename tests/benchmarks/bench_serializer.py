@@ -0,0 +1,47 @@
+""" bench_serializer.py: compare the JSON backends on SOLR response parsing and AnnotationList encoding
+
+    python tests/benchmarks/bench_serializer.py [--sizes 64 512 4096] [--repeat 5]
+"""
+
+import argparse
+import json
+import timeit
+
+from synthetic import scaled_iiif
+from whiiif import app, serializer, views
+
+
+def best_of(func, repeat, number):
+    return min(timeit.repeat(func, repeat=repeat, number=number)) / number
+
+
+def bench(sizes, repeat):
+    rows = []
+    with app.test_request_context('/search/test-manifest?q=myquery'):
+        for size in sizes:
+            solr_body = json.dumps(scaled_iiif(size)).encode("utf8")
+            number = max(1, 4096 // size)
+            for name in serializer.backends:
+                serializer.use(name)
+                results_json = serializer.loads(solr_body)
+                docs = results_json["response"]["docs"]
+                results, total, _ = views.search_results(results_json, docs)
+                annotations = views.make_annotations(results, total, [])
+                rows.append({"backend": name,
+                             "snippets": size,
+                             "parse_ms": best_of(lambda: serializer.loads(solr_body), repeat, number) * 1000,
+                             "encode_ms": best_of(lambda: serializer.dumpb(annotations), repeat, number) * 1000,
+                             "response_bytes": len(serializer.dumpb(annotations))})
+    serializer.use("auto")
+    return rows
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the JSON backends used by whiiif.serializer")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[64, 512, 4096], help='snippets per response')
+    parser.add_argument('--repeat', type=int, default=5, help='timing runs to take the best of')
+    args = parser.parse_args()
+
+    print("{:>8} {:>8} {:>10} {:>10} {:>14}".format("backend", "snippets", "parse ms", "encode ms", "response bytes"))
+    for row in bench(args.sizes, args.repeat):
+        print("{backend:>8} {snippets:>8} {parse_ms:>10.3f} {encode_ms:>10.3f} {response_bytes:>14}".format(**row))
@@ -0,0 +1,65 @@
+""" stub_solr.py: a local HTTP server standing in for SOLR, answering every query with a canned response, so that the
+views can be benchmarked over a real connection (including incremental response parsing) without a SOLR instance """
+
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class StubSolrHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive, as with a real SOLR behind the connection pool
+    disable_nagle_algorithm = True  # as Jetty does; otherwise small responses wait on the client's delayed ACK
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        self.respond()
+
+    def do_GET(self):
+        self.respond()
+
+    def respond(self):
+        body = self.server.body
+        self.server.queries += 1
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json;charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StubSolr(object):
+    """Serve canned SOLR responses from a background thread, on a free local port.
+
+    Use it as a context manager, and set the response body (bytes) to serve with respond().
+    """
+
+    def __init__(self, core="bench"):
+        self.core = core
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), StubSolrHandler)
+        self.server.daemon_threads = True
+        self.server.body = b"{}"
+        self.server.queries = 0
+        self.thread = None
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:{}/solr".format(self.server.server_address[1])
+
+    @property
+    def queries(self):
+        return self.server.queries
+
+    def respond(self, body):
+        self.server.body = body
+
+    def __enter__(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.server.shutdown()
+        self.server.server_close()
+        return False
@@ -0,0 +1,123 @@
+""" synthetic.py: scaled-up SOLR responses built from the fixtures in tests/solr_responses.py, and synthetic ALTO
+files, for benchmarking """
+
+import copy
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir, os.pardir))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+import solr_responses  # noqa: E402
+
+
+def scaled_response(fixture, snippets):
+    """Return a copy of a SOLR ocrHighlighting fixture with its snippets repeated to make up the given number"""
+    response = copy.deepcopy(fixture)
+    for highlighting in response["ocrHighlighting"].values():
+        for field in highlighting.values():
+            original = field["snippets"]
+            field["snippets"] = [copy.deepcopy(original[idx % len(original)]) for idx in range(snippets)]
+            field["numTotal"] = snippets
+    return response
+
+
+def scaled_iiif(snippets):
+    return scaled_response(solr_responses.IIIF, snippets)
+
+
+def scaled_snippet(snippets):
+    return scaled_response(solr_responses.SNIPPET, snippets)
+
+
+def scaled_collection(snippets):
+    return scaled_response(solr_responses.COLLECTION, snippets)
+
+
+ALTO_WORDS = ["Edinburgh", "café", "naïve", "Straße", "ſtreet", "“quoted”", "élève", "word", "the", "of"]
+
+
+def write_alto(alto_path, size):
+    """Write a synthetic UTF-8 ALTO file of roughly size bytes, with non-ASCII words for the escaper to replace"""
+    with open(alto_path, "w", encoding="utf8") as alto_file:
+        alto_file.write('<?xml version="1.0" encoding="UTF-8"?>\n<alto><Layout>\n')
+        written = 0
+        page = 0
+        while written < size:
+            page += 1
+            lines = ['<Page ID="page_{}"><PrintSpace>'.format(page)]
+            for idx in range(2000):
+                lines.append('<String ID="s{0}_{1}" HPOS="{1}" VPOS="{0}" WIDTH="40" HEIGHT="12" '
+                             'CONTENT="{2}"/>'.format(page, idx, ALTO_WORDS[idx % len(ALTO_WORDS)]))
+            lines.append('</PrintSpace></Page>\n')
+            block = "\n".join(lines)
+            alto_file.write(block)
+            written += len(block.encode("utf8"))
+        alto_file.write('</Layout></alto>\n')
+
+
+def synthetic_manifest(canvases):
+    """Return a IIIF Presentation 2 manifest with the given number of canvases, its keys out of canonical order"""
+    base = "https://test-iiif-endpoint/iiif"
+    return {"sequences": [{"canvases": [{"images": [{"on": "{}/canvas/{}".format(base, idx),
+                                                     "resource": {"service": {"profile": "http://iiif.io/api/image/2"
+                                                                                         "/level1.json",
+                                                                              "@id": "{}/image{}".format(base, idx),
+                                                                              "@context": "http://iiif.io/api/image/2"
+                                                                                          "/context.json"},
+                                                                  "width": 4000, "height": 6000,
+                                                                  "format": "image/jpeg",
+                                                                  "@type": "dctypes:Image",
+                                                                  "@id": "{}/image{}/full/full/0/default.jpg".format(
+                                                                      base, idx)},
+                                                     "motivation": "sc:painting",
+                                                     "@type": "oa:Annotation",
+                                                     "@id": "{}/annotation/{}".format(base, idx)}],
+                                         "width": 4000, "height": 6000,
+                                         "label": "Page {}".format(idx + 1),
+                                         "@type": "sc:Canvas",
+                                         "@id": "{}/canvas/{}".format(base, idx)} for idx in range(canvases)],
+                           "label": "Current page order",
+                           "@type": "sc:Sequence",
+                           "@id": "{}/sequence/normal".format(base)}],
+            "service": {"profile": "http://iiif.io/api/search/1/search",
+                        "@id": "http://localhost:5000/search/synthetic",
+                        "@context": "http://iiif.io/api/search/1/context.json"},
+            "metadata": [{"label": "Title", "value": "Synthetic manifest"}],
+            "label": "Synthetic manifest",
+            "@type": "sc:Manifest",
+            "@id": "{}/manifest".format(base),
+            "@context": "http://iiif.io/api/presentation/2/context.json"}
+
+
+SEARCH_WORDS = ["edinburgh", "university", "library", "special", "collections"]
+
+
+def synthetic_snippets(snippets, canvases=500, max_parts=3):
+    """Return ocrHighlighting snippets spread over the given number of pages, with one highlight each of between 1
+    and max_parts parts (as for a phrase broken across lines)"""
+    found = []
+    for idx in range(snippets):
+        page = "page_{}".format(idx % canvases)
+        top = 200 + (idx * 37) % 5000
+        parts = 1 + idx % max_parts
+        highlight = [{"ulx": 100 + 900 * part, "uly": 40 * part, "lrx": 800 + 900 * part, "lry": 40 * part + 90,
+                      "text": SEARCH_WORDS[part % len(SEARCH_WORDS)], "page": page} for part in range(parts)]
+        found.append({"text": "some context before <em>{}</em> and some after".format(
+                          " ".join(part["text"] for part in highlight)),
+                      "score": float(snippets - idx),
+                      "regions": [{"ulx": 150, "uly": top, "lrx": 3900, "lry": top + 40 * parts + 200, "page": page}],
+                      "highlights": [highlight]})
+    return found
+
+
+def synthetic_response(documents, snippets, canvases=500, max_parts=3):
+    """Return a SOLR ocrHighlighting response for the given number of documents, each with the given number of
+    snippets, using the default OCR_TEXT_FIELD, MANIFEST_URL_FIELD and DOCUMENT_ID_FIELD"""
+    docs = [{"id": "synthetic-{}".format(idx),
+             "manifest_url": "http://localhost/manifests/synthetic-{}".format(idx),
+             "ocr_text": "/synthetic/synthetic-{}".format(idx)} for idx in range(documents)]
+    return {"responseHeader": {"status": 0, "QTime": 1},
+            "response": {"numFound": documents, "start": 0, "docs": docs},
+            "ocrHighlighting": {doc["id"]: {"ocr_text": {"snippets": synthetic_snippets(snippets, canvases, max_parts),
+                                                         "numTotal": snippets}} for doc in docs}}
@@ -0,0 +1,593 @@
+import contextlib
+import io
+import json
+import os
+import sys
+import tempfile
+import unittest
+from collections import OrderedDict
+from unittest.mock import patch
+from whiiif import app, cache, pages
+import manifests
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir, "utils"))
+
+import alto_normalize  # noqa: E402
+import iiif_order  # noqa: E402
+import index_with_plugin  # noqa: E402
+from ingest_ledger import IngestLedger  # noqa: E402
+from update_scheduler import UpdateScheduler  # noqa: E402
+
+ALTO = ('<?xml version="1.0" encoding="UTF-8"?>\n'
+        '<alto xmlns="http://www.loc.gov/standards/alto/ns-v3#">'
+        '<Description><MeasurementUnit>pixel</MeasurementUnit></Description>'
+        '<Layout><Page ID="page_0" HEIGHT="6000" WIDTH="4000"><PrintSpace>'
+        '<TextBlock ID="block_0"><TextLine ID="line_0">'
+        '<String ID="string_0" HPOS="10" VPOS="20" WIDTH="30" HEIGHT="40" CONTENT="café" WC="0.91"/><SP/>'
+        '<String ID="string_1" HPOS="50" VPOS="20" WIDTH="30" HEIGHT="40" CONTENT="naïve" WC="0.62"/>'
+        '</TextLine></TextBlock></PrintSpace></Page>'
+        '<Page ID="page_1" HEIGHT="6000" WIDTH="4000"><PrintSpace>'
+        '<TextBlock ID="block_1"><TextLine ID="line_1">'
+        '<String ID="string_2" HPOS="10" VPOS="20" WIDTH="30" HEIGHT="40" CONTENT="word"/>'
+        '</TextLine></TextBlock></PrintSpace></Page></Layout></alto>\n')
+
+
+class IngestTestCase(unittest.TestCase):
+    """Base for the indexing tool tests: a source directory of ALTO / manifest pairs, and somewhere to write output"""
+    def setUp(self):
+        app.config['TESTING'] = True
+        app.config['SOLR_URL'] = 'http://testserver/solr'
+        app.config['SOLR_CORE'] = 'whiiiftest'
+        app.config['SERVER_NAME'] = 'testserver:5000'
+        self.source_dir = tempfile.TemporaryDirectory()
+        self.out_dir = tempfile.TemporaryDirectory()
+        app.config['XML_LOCATION'] = self.out_dir.name
+        app.config['CANVAS_INDEX_LOCATION'] = os.path.join(self.out_dir.name, "canvases")
+        app.config['CACHE_LOCATION'] = os.path.join(self.out_dir.name, "cache")
+        index_with_plugin.DEBUG = False
+
+    def tearDown(self):
+        app.config['XML_LOCATION'] = '/opt/whiiif/resources/xml'
+        app.config['CANVAS_INDEX_LOCATION'] = '/opt/whiiif/resources/canvases'
+        app.config['CACHE_LOCATION'] = '/opt/whiiif/resources/cache'
+        cache.reset()
+        self.source_dir.cleanup()
+        self.out_dir.cleanup()
+
+    def write_pair(self, identifier, alto=ALTO, manifest=manifests.COLLECTION_ONE):
+        alto_path = os.path.join(self.source_dir.name, identifier + ".xml")
+        manifest_path = os.path.join(self.source_dir.name, identifier + ".json")
+        with open(alto_path, "w", encoding="utf8") as alto_file:
+            alto_file.write(alto)
+        if manifest is not None:
+            with open(manifest_path, "w", encoding="utf8") as manifest_file:
+                manifest_file.write(manifest)
+        return alto_path, manifest_path, identifier
+
+
+class BulkImportTestCase(IngestTestCase):
+    """Tests for the bulk import mode of the indexing tool"""
+    def bulk(self, **kwargs):
+        with contextlib.redirect_stdout(io.StringIO()):
+            return index_with_plugin.bulk(self.source_dir.name, workers=2, **kwargs)
+
+    def test_find_pairs_directory(self):
+        # Are ALTO files paired with their manifests, leaving out escaped copies and other files?
+        self.write_pair("doc-b")
+        self.write_pair("doc-a")
+        for name in ("doc-a_escaped.xml", "notes.txt"):
+            open(os.path.join(self.source_dir.name, name), "w").close()
+        source = self.source_dir.name
+        self.assertEqual(list(index_with_plugin.find_pairs(source)),
+                         [(os.path.join(source, "doc-a.xml"), os.path.join(source, "doc-a.json"), "doc-a"),
+                          (os.path.join(source, "doc-b.xml"), os.path.join(source, "doc-b.json"), "doc-b")])
+        self.assertEqual(list(index_with_plugin.find_pairs(source, "/manifests"))[0][1], "/manifests/doc-a.json")
+
+    def test_find_pairs_list_file(self):
+        # Are list file lines read as ALTO MANIFEST [IDENTIFIER], skipping comments and reporting bad lines?
+        list_path = os.path.join(self.source_dir.name, "pairs.txt")
+        with open(list_path, "w") as list_file:
+            list_file.write("# a comment\n/alto/one.xml /manifests/one.json\n\n/alto/two.xml /manifests/2.json two\n"
+                            "/alto/three.xml\n")
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+            pairs = list(index_with_plugin.find_pairs(list_path))
+        self.assertEqual(pairs, [("/alto/one.xml", "/manifests/one.json", "one"),
+                                 ("/alto/two.xml", "/manifests/2.json", "two")])
+        self.assertIn("line 5", out.getvalue())
+
+    def test_checkpoint_resume(self):
+        # Are checkpointed identifiers kept across runs?
+        checkpoint_path = os.path.join(self.out_dir.name, "test.checkpoint")
+        checkpoint = index_with_plugin.Checkpoint(checkpoint_path)
+        self.assertNotIn("doc-a", checkpoint)
+        checkpoint.add(["doc-a", "doc-b"])
+        self.assertIn("doc-a", checkpoint)
+        resumed = index_with_plugin.Checkpoint(checkpoint_path)
+        self.assertEqual(resumed.done, {"doc-a", "doc-b"})
+
+    def test_bulk_import(self):
+        # Are the pairs posted in batches and committed, and the checkpoint removed once the import has finished?
+        for identifier in ("doc-a", "doc-b", "doc-c"):
+            self.write_pair(identifier)
+        with patch("update_scheduler.post_documents", return_value=True) as mock_post, \
+                patch("update_scheduler.commit", return_value=True) as mock_commit:
+            self.assertTrue(self.bulk(batch_size=2))
+            self.assertEqual(sorted(len(call.args[0]) for call in mock_post.call_args_list), [1, 2])
+            posted = [solr_doc for call in mock_post.call_args_list for solr_doc in call.args[0]]
+            self.assertEqual(sorted(solr_doc["id"] for solr_doc in posted), ["doc-a", "doc-b", "doc-c"])
+            self.assertEqual(posted[0]["manifest_url"], "http://mytestserver/manifests/collection-manifest")
+            self.assertTrue(os.path.isfile(posted[0]["ocr_text"]))
+            self.assertEqual(mock_commit.call_count, 1)
+
+            self.assertFalse(os.path.exists(os.path.join(self.out_dir.name, "bulk_index.checkpoint")))
+
+    def test_bulk_import_strip(self):
+        # Are the strip and debug settings passed on to the workers, rather than left to module globals?
+        self.write_pair("doc-a")
+        index_with_plugin.DEBUG = True
+        with patch("update_scheduler.post_documents", return_value=True), \
+                patch("update_scheduler.commit", return_value=True), \
+                patch("index_with_plugin.Pool", wraps=index_with_plugin.Pool) as mock_pool:
+            self.assertTrue(self.bulk(strip=True))
+        self.assertEqual(mock_pool.call_args.kwargs["initargs"], (True,))
+        with open(pages.ocr_path("doc-a"), "rb") as ocr_file:
+            self.assertNotIn(b"MeasurementUnit", ocr_file.read())
+
+    def test_bulk_import_twice(self):
+        # Does a second import after one that finished cleanly index every pair again?
+        for identifier in ("doc-a", "doc-b"):
+            self.write_pair(identifier)
+        with patch("update_scheduler.post_documents", return_value=True) as mock_post, \
+                patch("update_scheduler.commit", return_value=True):
+            self.assertTrue(self.bulk())
+            mock_post.reset_mock()
+            self.assertTrue(self.bulk(force=True))
+            posted = [solr_doc for call in mock_post.call_args_list for solr_doc in call.args[0]]
+            self.assertEqual(sorted(solr_doc["id"] for solr_doc in posted), ["doc-a", "doc-b"])
+
+    def test_bulk_import_failures(self):
+        # Are pairs that can't be prepared, or whose post fails, left out of the checkpoint, and the rest skipped when
+        # the import is run again?
+        self.write_pair("doc-a")
+        self.write_pair("doc-b", manifest=None)
+        with patch("update_scheduler.post_documents", return_value=True) as mock_post, \
+                patch("update_scheduler.commit", return_value=True):
+            self.assertFalse(self.bulk())
+            self.assertEqual([solr_doc["id"] for solr_doc in mock_post.call_args.args[0]], ["doc-a"])
+        checkpoint_path = os.path.join(self.out_dir.name, "bulk_index.checkpoint")
+        self.assertEqual(index_with_plugin.Checkpoint(checkpoint_path).done, {"doc-a"})
+
+        self.write_pair("doc-b")
+        with patch("update_scheduler.post_documents", return_value=True) as mock_post, \
+                patch("update_scheduler.commit", return_value=True):
+            self.assertTrue(self.bulk())
+            self.assertEqual([solr_doc["id"] for solr_doc in mock_post.call_args.args[0]], ["doc-b"])
+        self.assertFalse(os.path.exists(checkpoint_path))
+
+        with patch("update_scheduler.post_documents", return_value=False), \
+                patch("update_scheduler.commit", return_value=True) as mock_commit:
+            self.assertFalse(self.bulk())
+            mock_commit.assert_not_called()
+        self.assertEqual(index_with_plugin.Checkpoint(checkpoint_path).done, set())
+
+
+class EscapeStreamTestCase(unittest.TestCase):
+    """Tests for the chunked ALTO escaper"""
+    def escape(self, text, chunk_size):
+        out = io.BytesIO()
+        index_with_plugin.escape_stream(io.StringIO(text), out, chunk_size)
+        return out.getvalue()
+
+    def test_escape_stream(self):
+        # Is the output ASCII, with the encoding declaration replaced, wherever the chunk boundaries fall?
+        expected = ALTO.replace('encoding="UTF-8"', 'encoding="ASCII"').replace("é", "&#233;").replace(
+            "ï", "&#239;").encode("ascii")
+        declaration = ALTO.index('encoding="UTF-8"')
+        for chunk_size in [1, 2, 7, declaration, declaration + 3, declaration + 8, 64, len(ALTO), 1024 * 1024]:
+            self.assertEqual(self.escape(ALTO, chunk_size), expected, chunk_size)
+
+    def test_escape_stream_short_file(self):
+        # Is a file shorter than the held back characters written whole?
+        self.assertEqual(self.escape("<a>é</a>", 3), b"<a>&#233;</a>")
+        self.assertEqual(self.escape("", 3), b"")
+
+
+class AltoNormalizeTestCase(IngestTestCase):
+    """Tests for normalizing ALTO at ingest, and the page index written with it"""
+    def normalize(self, strip=False):
+        alto_path, _, _ = self.write_pair("doc", manifest=None)
+        out = io.BytesIO()
+        page_ranges, block_ranges = alto_normalize.normalize_alto(alto_path, out, strip)
+        return out.getvalue(), page_ranges, block_ranges
+
+    def test_normalize_keeps_everything(self):
+        # Is the whole ALTO kept, ASCII-escaped, with empty elements self-closing?
+        output, _, _ = self.normalize()
+        self.assertTrue(output.startswith(b'<?xml version="1.0" encoding="ASCII"?>\n'
+                                          b'<alto xmlns="http://www.loc.gov/standards/alto/ns-v3#"><Description>'
+                                          b'<MeasurementUnit>pixel</MeasurementUnit></Description>'))
+        self.assertIn(b'<String ID="string_0" HPOS="10" VPOS="20" WIDTH="30" HEIGHT="40" CONTENT="caf&#233;" '
+                      b'WC="0.91"/><SP/>', output)
+        self.assertIn(b'<Page ID="page_1" HEIGHT="6000" WIDTH="4000">', output)
+        self.assertTrue(output.endswith(b'</Layout></alto>\n'))
+
+    def test_normalize_strip(self):
+        # Is only what the plugin reads kept when stripping?
+        output, _, _ = self.normalize(strip=True)
+        self.assertNotIn(b"MeasurementUnit", output)
+        self.assertNotIn(b"WC=", output)
+        self.assertIn(b'<String ID="string_0" HPOS="10" VPOS="20" WIDTH="30" HEIGHT="40" CONTENT="caf&#233;"/><SP/>',
+                      output)
+
+    def test_normalize_ranges(self):
+        # Does each page and block range cover exactly that element, whether stripping or not?
+        for strip in (False, True):
+            output, page_ranges, block_ranges = self.normalize(strip)
+            self.assertEqual([page_id for page_id, _, _ in page_ranges], ["page_0", "page_1"])
+            self.assertEqual([(block_id, page) for block_id, page, _, _ in block_ranges],
+                             [("block_0", 0), ("block_1", 1)])
+            for page_id, start, end in page_ranges:
+                self.assertTrue(output[start:end].startswith('<Page ID="{}"'.format(page_id).encode()), strip)
+                self.assertTrue(output[start:end].endswith(b"</Page>"), strip)
+            for block_id, _, start, end in block_ranges:
+                self.assertTrue(output[start:end].startswith('<TextBlock ID="{}">'.format(block_id).encode()))
+                self.assertTrue(output[start:end].endswith(b"</TextLine></TextBlock>"))
+
+    def test_normalize_ocr(self):
+        # Is the normalized copy written with a page index of its pages and blocks?
+        alto_path, _, _ = self.write_pair("doc", manifest=None)
+        self.assertEqual(index_with_plugin.normalize_ocr(alto_path, "doc"), pages.ocr_path("doc"))
+        index = pages.page_lookup("doc")
+        self.assertEqual(index.ids, ["page_0", "page_1"])
+        self.assertEqual(index.block_page("block_1"), 1)
+        self.assertTrue(index.read("page_1").startswith(b'<Page ID="page_1"'))
+        self.assertEqual(index.read_block("block_1"), b'<TextBlock ID="block_1"><TextLine ID="line_1"><String '
+                         b'ID="string_2" HPOS="10" VPOS="20" WIDTH="30" HEIGHT="40" CONTENT="word"/></TextLine>'
+                         b'</TextBlock>')
+        with self.assertRaises(KeyError):
+            index.block_range("block_2")
+
+
+    def test_normalize_ocr_failure(self):
+        # Is the previous normalized copy left whole, with no temporary file, if writing the new one fails?
+        alto_path, _, _ = self.write_pair("doc", manifest=None)
+        index_with_plugin.normalize_ocr(alto_path, "doc")
+        with open(pages.ocr_path("doc"), "rb") as ocr_file:
+            original = ocr_file.read()
+        written = sorted(os.listdir(self.out_dir.name))
+        with patch("index_with_plugin.normalize_alto", side_effect=OSError("disk full")), \
+                patch("index_with_plugin.escape_stream", side_effect=OSError("disk full")), \
+                contextlib.redirect_stdout(io.StringIO()):
+            self.assertFalse(index_with_plugin.normalize_ocr(alto_path, "doc"))
+        with open(pages.ocr_path("doc"), "rb") as ocr_file:
+            self.assertEqual(ocr_file.read(), original)
+        self.assertEqual(sorted(os.listdir(self.out_dir.name)), [name for name in written if name != "doc.pages"])
+
+
+class IngestLedgerTestCase(IngestTestCase):
+    """Tests for skipping unchanged ALTO / manifest pairs with the ingest ledger"""
+    def setUp(self):
+        super().setUp()
+        self.ledger = IngestLedger(os.path.join(self.out_dir.name, "ledger.sqlite3"))
+
+    def pipeline(self, alto, manifest, identifier, modify=False, **kwargs):
+        with contextlib.redirect_stdout(io.StringIO()):
+            return index_with_plugin.pipeline(alto, manifest, identifier, modify, self.ledger, **kwargs)
+
+    def test_ledger_record(self):
+        # Does the ledger only report a document unchanged for exactly the hashes last recorded?
+        self.assertFalse(self.ledger.unchanged("doc-a", "alto1", "manifest1"))
+        self.ledger.record("doc-a", "alto1", "manifest1")
+        self.assertTrue(self.ledger.unchanged("doc-a", "alto1", "manifest1"))
+        self.assertFalse(self.ledger.unchanged("doc-a", "alto2", "manifest1"))
+        self.assertFalse(self.ledger.unchanged("doc-b", "alto1", "manifest1"))
+        self.ledger.forget("doc-a")
+        self.assertFalse(self.ledger.unchanged("doc-a", "alto1", "manifest1"))
+
+    def test_pipeline_skips_unchanged(self):
+        # Is an unchanged pair skipped, unless forced, and a changed one reindexed?
+        alto, manifest, identifier = self.write_pair("doc-a")
+        with patch("update_scheduler.post_documents", return_value=True) as mock_post:
+            self.assertTrue(self.pipeline(alto, manifest, identifier))
+            self.assertEqual(mock_post.call_count, 1)
+            self.assertTrue(self.pipeline(alto, manifest, identifier))
+            self.assertEqual(mock_post.call_count, 1)
+            self.assertTrue(self.pipeline(alto, manifest, identifier, force=True))
+            self.assertEqual(mock_post.call_count, 2)
+            self.write_pair("doc-a", alto=ALTO.replace("word", "words"))
+            self.assertTrue(self.pipeline(alto, manifest, identifier))
+            self.assertEqual(mock_post.call_count, 3)
+
+    def test_pipeline_modify(self):
+        # Is a pair first indexed without modify indexed again with it, and one whose manifest can't be written
+        # tried again next time?
+        alto, manifest, identifier = self.write_pair("doc-a")
+        with patch("update_scheduler.post_documents", return_value=True) as mock_post:
+            self.assertTrue(self.pipeline(alto, manifest, identifier))
+            with patch("index_with_plugin.write_manifest", side_effect=OSError("read-only")):
+                self.assertFalse(self.pipeline(alto, manifest, identifier, modify=True))
+            self.assertEqual(mock_post.call_count, 2)
+            self.assertTrue(self.pipeline(alto, manifest, identifier, modify=True))
+            self.assertEqual(mock_post.call_count, 3)
+            self.assertIn(index_with_plugin.search_service(identifier),
+                          index_with_plugin.load_manifest(manifest)["service"])
+            self.assertTrue(self.pipeline(alto, manifest, identifier, modify=True))
+            self.assertEqual(mock_post.call_count, 3)
+
+    def test_bulk_modify(self):
+        # Is a pair whose manifest couldn't be modified left out of the checkpoint and ledger, and retried?
+        alto, manifest, identifier = self.write_pair("doc-a")
+        with patch("update_scheduler.post_documents", return_value=True) as mock_post, \
+                patch("update_scheduler.commit", return_value=True), contextlib.redirect_stdout(io.StringIO()):
+            self.assertTrue(index_with_plugin.bulk(self.source_dir.name, workers=2, ledger=self.ledger))
+            with patch("index_with_plugin.write_manifest", side_effect=OSError("read-only")):
+                self.assertFalse(index_with_plugin.bulk(self.source_dir.name, modify=True, workers=2,
+                                                        ledger=self.ledger))
+            self.assertEqual(index_with_plugin.Checkpoint(
+                os.path.join(self.out_dir.name, "bulk_index.checkpoint")).done, set())
+            self.assertTrue(index_with_plugin.bulk(self.source_dir.name, modify=True, workers=2, ledger=self.ledger))
+            self.assertEqual(mock_post.call_count, 3)
+            self.assertTrue(index_with_plugin.bulk(self.source_dir.name, modify=True, workers=2, ledger=self.ledger))
+            self.assertEqual(mock_post.call_count, 3)
+
+    def test_pipeline_failure_not_recorded(self):
+        # Is a pair whose post failed tried again next time?
+        alto, manifest, identifier = self.write_pair("doc-a")
+        with patch("update_scheduler.post_documents", return_value=False):
+            self.assertFalse(self.pipeline(alto, manifest, identifier))
+        with patch("update_scheduler.post_documents", return_value=True) as mock_post:
+            self.assertTrue(self.pipeline(alto, manifest, identifier))
+            self.assertEqual(mock_post.call_count, 1)
+
+    def test_bulk_skips_unchanged(self):
+        # Does a bulk import skip pairs the ledger shows are unchanged?
+        for identifier in ("doc-a", "doc-b"):
+            self.write_pair(identifier)
+        with patch("update_scheduler.post_documents", return_value=True) as mock_post, \
+                patch("update_scheduler.commit", return_value=True), contextlib.redirect_stdout(io.StringIO()):
+            index_with_plugin.bulk(self.source_dir.name, workers=2, ledger=self.ledger)
+            self.write_pair("doc-b", alto=ALTO.replace("word", "words"))
+            mock_post.reset_mock()
+            index_with_plugin.bulk(self.source_dir.name, workers=2, ledger=self.ledger)
+            self.assertEqual([solr_doc["id"] for solr_doc in mock_post.call_args.args[0]], ["doc-b"])
+
+
+class UpdateSchedulerTestCase(unittest.TestCase):
+    """Tests for batching SOLR updates and scheduling commits"""
+    def setUp(self):
+        app.config['SOLR_URL'] = 'http://testserver/solr'
+        app.config['SOLR_CORE'] = 'whiiiftest'
+        self.committed = []
+        self.failed = []
+        self.now = 1000.0
+        patches = [patch("update_scheduler.post_documents", return_value=True),
+                   patch("update_scheduler.commit", return_value=True),
+                   patch("time.monotonic", side_effect=lambda: self.now),
+                   patch("time.sleep", side_effect=self.sleep)]
+        self.mock_post, self.mock_commit = [mock.start() for mock in patches][:2]
+        for mock in patches:
+            self.addCleanup(mock.stop)
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+    def scheduler(self, **kwargs):
+        return UpdateScheduler(on_commit=self.committed.extend, on_failure=self.failed.extend, **kwargs)
+
+    def test_batches(self):
+        # Are documents posted batch_size at a time, and everything committed once on leaving the block?
+        with self.scheduler(batch_size=2) as scheduler:
+            for item in range(5):
+                scheduler.add(item, {"id": item})
+            self.assertEqual([len(call.args[0]) for call in self.mock_post.call_args_list], [2, 2])
+            self.mock_commit.assert_not_called()
+        self.assertEqual([len(call.args[0]) for call in self.mock_post.call_args_list], [2, 2, 1])
+        self.assertEqual(self.mock_commit.call_count, 1)
+        self.assertEqual(self.committed, [0, 1, 2, 3, 4])
+
+    def test_commit_docs(self):
+        # Is a commit made once commit_docs documents are waiting?
+        with self.scheduler(batch_size=2, commit_docs=4) as scheduler:
+            for item in range(5):
+                scheduler.add(item, {"id": item})
+            self.assertEqual(self.mock_commit.call_count, 1)
+            self.assertEqual(self.committed, [0, 1, 2, 3])
+        self.assertEqual(self.mock_commit.call_count, 2)
+        self.assertEqual(self.committed, [0, 1, 2, 3, 4])
+
+    def test_commit_seconds(self):
+        # Is a commit made once commit_seconds have passed since the last one?
+        with self.scheduler(batch_size=1, commit_seconds=60) as scheduler:
+            scheduler.add(0, {"id": 0})
+            self.now += 30
+            scheduler.add(1, {"id": 1})
+            self.mock_commit.assert_not_called()
+            self.now += 30
+            scheduler.add(2, {"id": 2})
+            self.assertEqual(self.mock_commit.call_count, 1)
+            self.assertEqual(self.committed, [0, 1, 2])
+
+    def test_failures(self):
+        # Are the documents of failed posts and commits passed to on_failure, rather than on_commit?
+        self.mock_post.side_effect = [True, False]
+        with self.scheduler(batch_size=2) as scheduler:
+            for item in range(4):
+                scheduler.add(item, {"id": item})
+        self.assertEqual(self.failed, [2, 3])
+        self.assertEqual(self.committed, [0, 1])
+
+        self.failed.clear()
+        self.mock_post.side_effect = None
+        self.mock_commit.return_value = False
+        with self.scheduler(batch_size=2) as scheduler:
+            scheduler.add(4, {"id": 4})
+        self.assertEqual(self.failed, [4])
+
+    def test_flush_on_error(self):
+        # Is what's pending posted and committed when the block is left by an exception?
+        with self.assertRaises(KeyboardInterrupt), contextlib.redirect_stdout(io.StringIO()):
+            with self.scheduler(batch_size=10) as scheduler:
+                scheduler.add(0, {"id": 0})
+                raise KeyboardInterrupt
+        self.assertEqual(self.committed, [0])
+
+    def test_commit_within(self):
+        # Are commitWithin updates only counted as committed once SOLR must have committed them?
+        with self.scheduler(batch_size=1, commit_within=5000) as scheduler:
+            scheduler.add(0, {"id": 0})
+            self.assertEqual(self.mock_post.call_args.args[1], {"commitWithin": 5000})
+            self.assertEqual(self.committed, [])
+            self.now += 5
+            scheduler.add(1, {"id": 1})
+            self.assertEqual(self.committed, [0])
+        self.assertEqual(self.committed, [0, 1])
+        self.assertEqual(self.now, 1010)  # waited for the last update on leaving the block
+        self.mock_commit.assert_not_called()
+
+    def test_soft_commit(self):
+        # Are soft committed updates searchable, and so committed, as soon as they are posted?
+        with self.scheduler(batch_size=1, soft_commit=True) as scheduler:
+            scheduler.add(0, {"id": 0})
+            self.assertEqual(self.mock_post.call_args.args[1], {"softCommit": "true"})
+            self.assertEqual(self.committed, [0])
+        self.mock_commit.assert_not_called()
+
+
+class ManifestServiceTestCase(IngestTestCase):
+    """Tests for adding the search service to manifests, rewriting them only when it changes"""
+    def setUp(self):
+        super().setUp()
+        _, self.manifest, _ = self.write_pair("doc")
+        self.service = {"@context": "http://iiif.io/api/search/1/context.json",
+                        "@id": "testserver:5000/search/doc",
+                        "profile": "http://iiif.io/api/search/1/search"}
+
+    def add_service(self):
+        return index_with_plugin.add_search_service(self.manifest, index_with_plugin.load_manifest(self.manifest),
+                                                    "doc")
+
+    def test_set_service(self):
+        # Is a service added alongside others, replaced by @id, and left alone if it's already there?
+        manifest_json = {}
+        self.assertTrue(index_with_plugin.set_service(manifest_json, self.service))
+        self.assertEqual(manifest_json["service"], self.service)
+        self.assertFalse(index_with_plugin.set_service(manifest_json, dict(self.service)))
+
+        other = {"@id": "http://example.com/other"}
+        manifest_json = {"service": other}
+        self.assertTrue(index_with_plugin.set_service(manifest_json, self.service))
+        self.assertEqual(manifest_json["service"], [other, self.service])
+
+        changed = dict(self.service, profile="http://iiif.io/api/search/0/search")
+        self.assertTrue(index_with_plugin.set_service(manifest_json, changed))
+        self.assertEqual(manifest_json["service"], [other, changed])
+        self.assertFalse(index_with_plugin.set_service(manifest_json, dict(changed)))
+
+    def test_add_search_service(self):
+        # Is the manifest rewritten (keeping its mode) when the service is added, and left untouched after that?
+        os.chmod(self.manifest, 0o640)
+        self.assertTrue(self.add_service())
+        manifest_json = index_with_plugin.load_manifest(self.manifest)
+        self.assertIn(self.service, manifest_json["service"])
+        self.assertEqual(list(manifest_json)[:3], ["@context", "@id", "@type"])
+        written = os.stat(self.manifest)
+        self.assertEqual(written.st_mode & 0o777, 0o640)
+
+        with patch("index_with_plugin.write_manifest") as mock_write:
+            self.assertTrue(self.add_service())
+            mock_write.assert_not_called()
+        self.assertTrue(self.add_service())
+        self.assertEqual(os.stat(self.manifest).st_ino, written.st_ino)
+        self.assertEqual(os.stat(self.manifest).st_mtime_ns, written.st_mtime_ns)
+
+    def test_write_manifest_failure(self):
+        # Is the manifest left whole, with no temporary file, if writing the new one fails?
+        with open(self.manifest, "rb") as manifest_file:
+            original = manifest_file.read()
+        with self.assertRaises(TypeError):
+            index_with_plugin.write_manifest(self.manifest, {"service": object()})
+        with open(self.manifest, "rb") as manifest_file:
+            self.assertEqual(manifest_file.read(), original)
+        self.assertEqual(sorted(os.listdir(self.source_dir.name)), ["doc.json", "doc.xml"])
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.assertFalse(index_with_plugin.add_search_service(self.manifest, {"service": object()}, "doc"))
+
+    def test_bulk_modify(self):
+        # Are the manifests of a bulk import given the search service by the worker pool?
+        self.write_pair("doc-b")
+        with patch("update_scheduler.post_documents", return_value=True), \
+                patch("update_scheduler.commit", return_value=True), contextlib.redirect_stdout(io.StringIO()):
+            self.assertTrue(index_with_plugin.bulk(self.source_dir.name, modify=True, workers=2))
+        for identifier in ("doc", "doc-b"):
+            manifest_json = index_with_plugin.load_manifest(os.path.join(self.source_dir.name, identifier + ".json"))
+            self.assertIn(dict(self.service, **{"@id": "testserver:5000/search/" + identifier}),
+                          manifest_json["service"])
+
+
+def recursive_order_object(object, object_type, recursive=False):
+    """The ordering order_object replaced, for comparison: key lists scanned per object, recursing in Python"""
+    ordered = OrderedDict()
+    for key in iiif_order.object_keys[object_type]:
+        if key in object:
+            ordered[key] = object[key]
+    for key in set(object.keys()) - set(iiif_order.object_keys[object_type]):
+        ordered[key] = object[key]
+    if recursive and object_type in iiif_order.recursive_keys:
+        for key, subtype in iiif_order.recursive_keys[object_type]:
+            if key in ordered:
+                if type(ordered[key]) == list:
+                    for idx, val in enumerate(ordered[key]):
+                        ordered[key][idx] = recursive_order_object(ordered[key][idx], subtype, recursive=True)
+                elif type(ordered[key]) == dict or type(ordered[key]) == OrderedDict:
+                    ordered[key] = recursive_order_object(ordered[key], subtype, recursive=True)
+    return ordered
+
+
+class IIIFOrderTestCase(unittest.TestCase):
+    """Tests for putting the keys of IIIF objects in canonical order"""
+    def manifest(self):
+        # keys out of order at every level, with one key the ordering doesn't list in each object (the reference
+        # implementation puts several in set order)
+        canvases = [{"images": [{"on": "canvas-{}".format(idx), "resource": {"service": {"profile": "level2",
+                                                                                       "@id": "image-service"},
+                                                                           "format": "image/jpeg",
+                                                                           "@id": "image-{}".format(idx)},
+                                 "extra": idx, "@type": "oa:Annotation", "motivation": "sc:painting"}],
+                     "width": 1000, "label": str(idx), "@id": "canvas-{}".format(idx), "height": 1500,
+                     "@type": "sc:Canvas", "extra": idx}
+                    for idx in range(3)]
+        return {"sequences": [{"canvases": canvases, "@type": "sc:Sequence", "label": "default", "extra": True}],
+                "service": [{"profile": "http://iiif.io/api/search/1/search", "@id": "search"}],
+                "label": "Test", "structures": [], "@id": "manifest", "extra": "x",
+                "@context": "http://iiif.io/api/presentation/2/context.json", "@type": "sc:Manifest"}
+
+    def test_same_as_recursive(self):
+        # Does order_object give the same output as the recursive ordering, for out of order and ordered manifests?
+        expected = json.dumps(recursive_order_object(self.manifest(), "manifest", recursive=True), indent=2)
+        ordered = iiif_order.order_object(self.manifest(), "manifest", recursive=True)
+        self.assertEqual(json.dumps(ordered, indent=2), expected)
+        self.assertEqual(json.dumps(iiif_order.order_object(ordered, "manifest", recursive=True), indent=2), expected)
+        out = io.StringIO()
+        iiif_order.dump_ordered(self.manifest(), "manifest", out, indent=2)
+        self.assertEqual(out.getvalue(), expected)
+        self.assertEqual(list(iiif_order.order_object(self.manifest(), "manifest")),
+                         list(recursive_order_object(self.manifest(), "manifest")))
+
+    def test_unlisted_keys(self):
+        # Are keys the ordering doesn't list put last, in their original order?
+        ordered = iiif_order.order_object({"z": 1, "label": "a", "y": 2, "@id": "b", "x": 3}, "manifest")
+        self.assertEqual(list(ordered), ["@id", "label", "z", "y", "x"])
+
+    def test_non_object_children(self):
+        # Are children that aren't objects (which the recursive ordering failed on) left as they are?
+        ordered = iiif_order.order_object({"service": ["search", {"profile": "p", "@id": "s"}], "@id": "m"},
+                                          "manifest", recursive=True)
+        self.assertEqual(json.dumps(ordered), '{"@id": "m", "service": ["search", {"@id": "s", "profile": "p"}]}')
+
+    def test_in_order_kept(self):
+        # Is an object already in order returned as it is, rather than copied?
+        manifest = iiif_order.order_object(self.manifest(), "manifest", recursive=True)
+        canvas = manifest["sequences"][0]["canvases"][0]
+        self.assertIs(iiif_order.order_object(manifest, "manifest", recursive=True), manifest)
+        self.assertIs(manifest["sequences"][0]["canvases"][0], canvas)
@@ -1,9 +1,37 @@
+import asyncio
+import io
+import json
+import os
+import tempfile
+import threading
+import time
 import unittest
-from unittest.mock import patch, mock_open
-from whiiif import app
+from unittest.mock import ANY, patch, mock_open
+from whiiif import app, cache, coalesce, geometry, highlights, metrics, pages, profiling, query, serializer, solr, views
+from whiiif import manifests as manifest_cache
 import solr_responses
 import manifests
-from requests.exceptions import ConnectionError
+from requests.exceptions import ChunkedEncodingError, ConnectionError
+from urllib3.exceptions import ProtocolError, ReadTimeoutError
+
+try:
+    from aiohttp import ClientConnectionError
+    from aiohttp.test_utils import AioHTTPTestCase
+    from whiiif import aio
+except ImportError:  # the async serving mode is an optional extra
+    aio = None
+    AioHTTPTestCase = unittest.TestCase
+
+
+def multi_hit_snippets():
+    """The IIIF Search SOLR response with its first two snippets merged into one, with two hits"""
+    results_json = json.loads(json.dumps(solr_responses.IIIF))
+    highlighting = results_json["ocrHighlighting"]["test-manifest"]["ocr_text"]
+    first, second = highlighting["snippets"][:2]
+    first["highlights"].extend(second["highlights"])
+    del highlighting["snippets"][1]
+    highlighting["numTotal"] = len(highlighting["snippets"])
+    return results_json
 
 
 class FakeResponse(object):
@@ -32,6 +60,58 @@ class FakeResponse(object):
             raise ConnectionError
         return self.json_data
 
+    @property
+    def content(self):
+        if self.test == "connection_failure":
+            raise ConnectionError
+        if self.test in ("stalled", "read_timeout"):
+            raise ChunkedEncodingError
+        return json.dumps(self.json_data).encode("utf8")
+
+    @property
+    def raw(self):
+        if self.test in ("stalled", "read_timeout"):
+            return StalledReader(json.dumps(solr_responses.IIIF).encode("utf8"), self.test)
+        return io.BytesIO(self.content)
+
+    def close(self):
+        pass
+
+
+class StalledReader(object):
+    """Simulate a SOLR response body that fails halfway through, as urllib3 reports it"""
+
+    def __init__(self, body, test):
+        self.stream = io.BytesIO(body[:len(body) // 2])
+        self.test = test
+
+    def read(self, n=-1):
+        data = self.stream.read(n)
+        if data:
+            return data
+        if self.test == "read_timeout":
+            raise ReadTimeoutError(None, "http://testserver/solr", "Read timed out.")
+        raise ProtocolError("Connection broken: IncompleteRead")
+
+
+class FakeAsyncResponse(object):
+    """Class to simulate the aiohttp responses from SOLR, for monkeypatching AsyncSolrClient.fetch"""
+
+    def __init__(self, json_data):
+        self.body = json.dumps(json_data).encode("utf8")
+        self.content = FakeStreamReader(self.body)
+
+    async def read(self):
+        return self.body
+
+
+class FakeStreamReader(object):
+    def __init__(self, body):
+        self.stream = io.BytesIO(body)
+
+    async def read(self, n=-1):
+        return self.stream.read(n)
+
 
 class FakeManifests:
     """Class to simulate the data returned from reading manifest JSON files"""
@@ -69,22 +149,29 @@ class IIIFSearchTestCase(unittest.TestCase):
         app.config['OCR_TEXT_FIELD'] = 'ocr_text'
         app.config['MANIFEST_URL_FIELD'] = 'manifest_url'
         app.config['DOCUMENT_ID_FIELD'] = 'id'
+        app.config['SEARCH_STREAM_THRESHOLD'] = -1
+        cache.reset()
+        query.reset()
         self.app = app.test_client()
 
+    def tearDown(self):
+        app.config['SEARCH_STREAM_THRESHOLD'] = -1
+        app.config['SEARCH_PAGE_SIZE'] = 0
+
     def test_iiif_search_query(self):
         # Does the IIIF endpoint generate the right SOLR query?
-        with patch("requests.get") as mock_request:
+        with patch("whiiif.solr.post") as mock_request:
             mock_request.return_value = FakeResponse(test="iiif")
             rv = self.app.get('/search/test-manifest?q=myquery')
-            mock_request.assert_called_once_with("http://testserver/solr/whiiiftest/select?hl=on&"
-                                                 "hl.ocr.absoluteHighlights=true&hl.weightMatches=true"
+            mock_request.assert_called_once_with("http://testserver/solr/whiiiftest/select",
+                                                 "hl=on&hl.ocr.absoluteHighlights=true&hl.weightMatches=true"
                                                  "&hl.ocr.limitBlock=page&hl.ocr.contextSize=1"
                                                  "&hl.ocr.contextBlock=word&df=ocr_text&hl.ocr.fl=ocr_text"
-                                                 "&hl.snippets=4096&fq=id:test-manifest&q=myquery")
+                                                 "&hl.snippets=4096&fq=id%3Atest-manifest&q=myquery")
 
     def test_iiif_search_context(self):
         # Does the IIIF endpoint response contain the correct @context block?
-        with patch("requests.get") as mock_request:
+        with patch("whiiif.solr.post") as mock_request:
             mock_request.return_value = FakeResponse(test="iiif")
             rv = self.app.get('/search/test-manifest?q=myquery')
             json_response = rv.get_json()
@@ -93,7 +180,7 @@ class IIIFSearchTestCase(unittest.TestCase):
 
     def test_iiif_search_id(self):
         # Does the IIIF endpoint response contain the correct @id?
-        with patch("requests.get") as mock_request:
+        with patch("whiiif.solr.post") as mock_request:
             mock_request.return_value = FakeResponse(test="iiif")
             rv = self.app.get('/search/test-manifest?q=myquery')
             json_response = rv.get_json()
@@ -101,7 +188,7 @@ class IIIFSearchTestCase(unittest.TestCase):
 
     def test_iiif_search_result_counts(self):
         # Does the IIIF endpoint response contain correct numbers of items?
-        with patch("requests.get") as mock_request:
+        with patch("whiiif.solr.post") as mock_request:
             mock_request.return_value = FakeResponse(test="iiif")
             rv = self.app.get('/search/test-manifest?q=myquery')
             json_response = rv.get_json()
@@ -111,7 +198,7 @@ class IIIFSearchTestCase(unittest.TestCase):
 
     def test_iiif_search_resources_single(self):
         # Does the IIIF endpoint response have a correct resources block for single annotation results?
-        with patch("requests.get") as mock_request:
+        with patch("whiiif.solr.post") as mock_request:
             mock_request.return_value = FakeResponse(test="iiif")
             rv = self.app.get('/search/test-manifest?q=myquery')
             json_response = rv.get_json()
@@ -128,7 +215,7 @@ class IIIFSearchTestCase(unittest.TestCase):
 
     def test_iiif_search_hits_single(self):
         # Does the IIIF endpoint response have a correct hits block for single annotation results?
-        with patch("requests.get") as mock_request:
+        with patch("whiiif.solr.post") as mock_request:
             mock_request.return_value = FakeResponse(test="iiif")
             rv = self.app.get('/search/test-manifest?q=myquery')
             json_response = rv.get_json()
@@ -139,7 +226,7 @@ class IIIFSearchTestCase(unittest.TestCase):
 
     def test_iiif_search_resources_multiple(self):
         # Does the IIIF endpoint response have a correct resources block for multiple annotation results?
-        with patch("requests.get") as mock_request:
+        with patch("whiiif.solr.post") as mock_request:
             mock_request.return_value = FakeResponse(test="iiif")
             rv = self.app.get('/search/test-manifest?q=myquery')
             json_response = rv.get_json()
@@ -156,7 +243,7 @@ class IIIFSearchTestCase(unittest.TestCase):
 
     def test_iiif_search_hits_multiple(self):
         # Does the IIIF endpoint response have a correct hits block for multiple annotation results?
-        with patch("requests.get") as mock_request:
+        with patch("whiiif.solr.post") as mock_request:
             mock_request.return_value = FakeResponse(test="iiif")
             rv = self.app.get('/search/test-manifest?q=myquery')
             json_response = rv.get_json()
@@ -166,7 +253,7 @@ class IIIFSearchTestCase(unittest.TestCase):
 
     def test_iiif_search_ignored(self):
         # Does the IIIF endpoint response correctly add the ignored value?
-        with patch("requests.get") as mock_request:
+        with patch("whiiif.solr.post") as mock_request:
             mock_request.return_value = FakeResponse(test="iiif")
             rv = self.app.get('/search/test-manifest?q=myquery&motivation=tagging')
             json_response = rv.get_json()
@@ -174,7 +261,7 @@ class IIIFSearchTestCase(unittest.TestCase):
 
     def test_iiif_search_connection_failure(self):
         # Does the IIIF endpoint register the error and return gracefully when SOLR doesn't respond?
-        with patch("requests.get") as mock_request, self.assertLogs(level='ERROR') as log_catcher:
+        with patch("whiiif.solr.post") as mock_request, self.assertLogs(level='ERROR') as log_catcher:
             mock_request.return_value = FakeResponse(test="connection_failure")
             rv = self.app.get('/search/test-manifest')
             self.assertIn("ERROR:whiiif:Error occurred with SOLR query: <class 'requests.exceptions.ConnectionError'>",
@@ -187,7 +274,7 @@ class IIIFSearchTestCase(unittest.TestCase):
 
     def test_iiif_search_solr_error(self):
         # Does the IIIF endpoint register the error and return gracefully when SOLR returns an error?
-        with patch("requests.get") as mock_request, self.assertLogs(level='ERROR') as log_catcher:
+        with patch("whiiif.solr.post") as mock_request, self.assertLogs(level='ERROR') as log_catcher:
             mock_request.return_value = FakeResponse(test="solr_error")
             rv = self.app.get('/search/test-manifest')
             self.assertIn("ERROR:whiiif:Error occurred with SOLR query: <class 'KeyError'>",
@@ -198,15 +285,175 @@ class IIIFSearchTestCase(unittest.TestCase):
             self.assertEqual(json_response["@id"], "http://testserver:5000/search/test-manifest")
             self.assertEqual(json_response["within"]["total"], 0)
 
+    def test_iiif_search_read_failure(self):
+        # Is a SOLR response that fails partway through handled gracefully, whether it's parsed as it arrives or not?
+        self.addCleanup(app.config.__setitem__, 'SOLR_STREAM_PARSE', app.config['SOLR_STREAM_PARSE'])
+        for stream_parse in (True, False):
+            for test, error in (("stalled", "ConnectionError"), ("read_timeout", "ReadTimeout")):
+                app.config['SOLR_STREAM_PARSE'] = stream_parse
+                with patch("whiiif.solr.post") as mock_request, self.assertLogs(level='ERROR') as log_catcher:
+                    mock_request.return_value = FakeResponse(test=test)
+                    rv = self.app.get('/search/test-manifest?q=myquery')
+                self.assertEqual(rv.status_code, 200)
+                self.assertEqual(rv.get_json()["within"]["total"], 0)
+                if stream_parse and highlights.ijson is not None:
+                    self.assertIn("ERROR:whiiif:Error occurred with SOLR query: "
+                                  "<class 'requests.exceptions.{}'>".format(error), log_catcher.output)
+
     def test_iiif_search_scaled(self):
         # Does the IIIF endpoint correctly apply scaling when present in SOLR results?
-        with patch("requests.get") as mock_request:
+        with patch("whiiif.solr.post") as mock_request:
             mock_request.return_value = FakeResponse(test="iiif_scaled")
             rv = self.app.get('/search/test-scaled-manifest?q=test')
             json_response = rv.get_json()
             self.assertEqual(json_response["resources"][0]["on"],
                              'http://mytestserver/manifests/test-scaled-manifest/canvas/1#xywh=316,363,93,46')
 
+    def test_iiif_search_streamed(self):
+        # Is a streamed response identical to the one built in memory?
+        with patch("whiiif.solr.post") as mock_request:
+            mock_request.return_value = FakeResponse(test="iiif")
+            app.config['SEARCH_STREAM_THRESHOLD'] = -1
+            built = self.app.get('/search/test-manifest?q=myquery').get_data(as_text=True)
+            cache.reset()
+            app.config['SEARCH_STREAM_THRESHOLD'] = 0
+            app.config['SEARCH_STREAM_CHUNK_SIZE'] = 100
+            rv = self.app.get('/search/test-manifest?q=myquery')
+            self.assertTrue(rv.is_streamed)
+            self.assertEqual(rv.get_data(as_text=True), built)
+            self.assertEqual(rv.headers["Access-Control-Allow-Origin"], "*")
+
+    def test_iiif_search_paged_query(self):
+        # Does a paged IIIF Search only ask SOLR for the snippets up to the end of the requested page?
+        with patch("whiiif.solr.post") as mock_request:
+            mock_request.return_value = FakeResponse(test="iiif")
+            app.config['SEARCH_PAGE_SIZE'] = 1
+            rv = self.app.get('/search/test-manifest?q=myquery&page=1')
+            self.assertIn("&hl.snippets=2&", mock_request.call_args[0][1])
+
+    def test_iiif_search_paged_first(self):
+        # Does the first page of a paged IIIF Search link to the next and last pages?
+        with patch("whiiif.solr.post") as mock_request:
+            mock_request.return_value = FakeResponse(test="iiif")
+            app.config['SEARCH_PAGE_SIZE'] = 1
+            rv = self.app.get('/search/test-manifest?q=myquery')
+            json_response = rv.get_json()
+            self.assertEqual(json_response["within"]["first"],
+                             "http://testserver:5000/search/test-manifest?q=myquery&page=0")
+            self.assertEqual(json_response["within"]["last"],
+                             "http://testserver:5000/search/test-manifest?q=myquery&page=2")
+            self.assertEqual(json_response["next"], "http://testserver:5000/search/test-manifest?q=myquery&page=1")
+            self.assertNotIn("prev", json_response)
+            self.assertEqual(json_response["startIndex"], 0)
+
+    def test_iiif_search_paged_last(self):
+        # Does the last page of a paged IIIF Search contain only its hits, numbered from the startIndex?
+        with patch("whiiif.solr.post") as mock_request:
+            mock_request.return_value = FakeResponse(test="iiif")
+            app.config['SEARCH_PAGE_SIZE'] = 1
+            rv = self.app.get('/search/test-manifest?q=myquery&page=2')
+            json_response = rv.get_json()
+            self.assertEqual(json_response["within"]["total"], 3)
+            self.assertEqual(json_response["startIndex"], 2)
+            self.assertEqual(json_response["prev"], "http://testserver:5000/search/test-manifest?q=myquery&page=1")
+            self.assertNotIn("next", json_response)
+            self.assertEqual(len(json_response["hits"]), 1)
+            self.assertEqual(json_response["hits"][0]["annotations"], ['uun:whiiif:test-manifest:page_537:2',
+                                                                       'uun:whiiif:test-manifest:page_537:2b'])
+
+    def test_iiif_search_paged_multi_hit(self):
+        # Are pages counted in hits, as startIndex and total are, when a snippet has more than one hit?
+        with patch("whiiif.solr.post") as mock_request:
+            mock_request.return_value.status_code = 200
+            mock_request.return_value.json.return_value = multi_hit_snippets()
+            mock_request.return_value.content = json.dumps(multi_hit_snippets()).encode()
+            mock_request.return_value.raw = None
+            app.config['SEARCH_PAGE_SIZE'] = 1
+            responses = [self.app.get('/search/test-manifest?q=myquery&page={}'.format(page)).get_json()
+                         for page in range(3)]
+        annotations = [[hit["annotations"] for hit in response["hits"]] for response in responses]
+        self.assertEqual(annotations, [[['uun:whiiif:test-manifest:page_1069:0']],
+                                       [['uun:whiiif:test-manifest:page_1073:1']],
+                                       [['uun:whiiif:test-manifest:page_537:2',
+                                         'uun:whiiif:test-manifest:page_537:2b']]])
+        self.assertEqual([response["startIndex"] for response in responses], [0, 1, 2])
+        self.assertEqual(responses[1]["next"], "http://testserver:5000/search/test-manifest?q=myquery&page=2")
+        self.assertEqual(responses[1]["prev"], "http://testserver:5000/search/test-manifest?q=myquery&page=0")
+        self.assertEqual(responses[2]["within"]["total"], 3)
+        self.assertNotIn("next", responses[2])
+
+    def test_iiif_search_hit_records(self):
+        # Are hit coordinates kept as (scaled) numbers until the annotation is written?
+        results_json = solr_responses.IIIF_SCALED
+        results, total, _ = views.search_results(results_json, results_json["response"]["docs"])
+        part = results[0][0]
+        self.assertIsInstance(part.x, int)
+        self.assertFalse(hasattr(part, "__dict__"))
+        with app.test_request_context('/search/test-manifest'):
+            annotations = views.make_annotations(results, total, [])
+        self.assertTrue(annotations["resources"][0]["on"].endswith(
+            "#xywh={},{},{},{}".format(part.x, part.y, part.w, part.h)))
+
+    def test_iiif_search_stream_chunks(self):
+        # Is the streamed AnnotationList split into chunks of around the configured size?
+        results = [[highlights.HighlightPart("m", "http://m", "page_1", 1, 2, 3, 4, "word")]] * 50
+        chunks = list(views.iter_annotations(results, 50, [], "http://testserver/search/m", 500))
+        self.assertGreater(len(chunks), 5)
+        self.assertTrue(all(len(chunk) < 1000 for chunk in chunks))
+        with app.test_request_context('/search/m'):
+            self.assertEqual(json.loads("".join(chunks)),
+                             views.make_annotations(results, 50, [], "http://testserver/search/m"))
+
+
+@unittest.skipIf(highlights.ijson is None, "ijson is not installed")
+class SearchResultsParserTestCase(unittest.TestCase):
+    """Tests for the incremental IIIF Search SOLR response parser"""
+    def setUp(self):
+        app.config['OCR_TEXT_FIELD'] = 'ocr_text'
+        app.config['MANIFEST_URL_FIELD'] = 'manifest_url'
+        app.config['DOCUMENT_ID_FIELD'] = 'id'
+
+    def parse_both(self, results_json, first_hit=0, hit_limit=None):
+        parsed = highlights.SearchResultsParser(first_hit, hit_limit).parse(
+            io.BytesIO(json.dumps(results_json).encode()))
+        loaded = views.search_results(results_json, views.solr_docs(results_json), first_hit, hit_limit)
+        return parsed, loaded
+
+    def test_parser_matches_search_results(self):
+        # Does parsing the response as it arrives give exactly the same hits as loading it all first?
+        for results_json in (solr_responses.IIIF, solr_responses.IIIF_SCALED):
+            parsed, loaded = self.parse_both(results_json)
+            self.assertEqual(parsed, loaded)
+            self.assertTrue(parsed[0])
+
+    def test_parser_page(self):
+        # Are the hits before and after a page only counted, whether or not their snippets hold several hits?
+        parsed, loaded = self.parse_both(solr_responses.IIIF, first_hit=2)
+        self.assertEqual(parsed, loaded)
+        self.assertEqual(parsed[2], 2)
+        parsed, loaded = self.parse_both(multi_hit_snippets(), first_hit=1, hit_limit=1)
+        self.assertEqual(parsed, loaded)
+        self.assertEqual((len(parsed[0]), parsed[1], parsed[2]), (1, 3, 1))
+
+    def test_parser_solr_error(self):
+        # Is a SOLR error response (with no docs) reported the same way as by search_results?
+        with self.assertRaises(KeyError):
+            highlights.SearchResultsParser().parse(io.BytesIO(json.dumps(solr_responses.SOLR_ERROR).encode()))
+
+    def test_parser_enabled(self):
+        # Does the search endpoint give the same response when streaming parsing is turned on?
+        with patch("whiiif.solr.post") as mock_request:
+            mock_request.return_value = FakeResponse(test="iiif")
+            cache.reset()
+            loaded = app.test_client().get('/search/test-manifest?q=myquery').get_json()
+            app.config['SOLR_STREAM_PARSE'] = True
+            try:
+                cache.reset()
+                streamed = app.test_client().get('/search/test-manifest?q=myquery').get_json()
+            finally:
+                app.config['SOLR_STREAM_PARSE'] = False
+            self.assertEqual(streamed, loaded)
+
 
 class CollectionSearchTestCase(unittest.TestCase):
     """Tests for the Collection Search endpoint"""
@@ -225,21 +472,30 @@ class CollectionSearchTestCase(unittest.TestCase):
         app.config['COLLECTION_SNIPPET_CONTEXT'] = 'word'
         app.config['COLLECTION_SNIPPET_CONTEXT_SIZE'] = 5
         app.config['COLLECTION_SNIPPET_CONTEXT_LIMIT'] = 'page'
+        cache.reset()
+        query.reset()
+        manifest_cache.reset()
+        # these tests read the (mocked) manifests, so make sure no canvas indexes are found
+        no_canvas_index = patch("whiiif.manifests.CanvasIndex", side_effect=FileNotFoundError)
+        no_canvas_index.start()
+        self.addCleanup(no_canvas_index.stop)
         self.app = app.test_client()
 
     def test_collection_search_query(self):
         # Does the Collection Search endpoint generate the right SOLR query?
-        with patch("requests.get") as mock_request, patch("builtins.open", FakeManifests().manifests):
+        with patch("whiiif.solr.post") as mock_request, patch("builtins.open", FakeManifests().manifests), \
+                patch("whiiif.manifests.file_stamp", return_value=(0, 0)):
             mock_request.return_value = FakeResponse(test="collection")
             rv = self.app.get('/collection/search?q=myquery')
-            mock_request.assert_called_once_with("http://testserver/solr/whiiiftest/select?hl=on"
-                                                 "&hl.weightMatches=true&rows=20&df=ocr_text&hl.ocr.fl=ocr_text"
+            mock_request.assert_called_once_with("http://testserver/solr/whiiiftest/select",
+                                                 "hl=on&hl.weightMatches=true&rows=20&df=ocr_text&hl.ocr.fl=ocr_text"
                                                  "&hl.snippets=2&hl.ocr.contextBlock=word&hl.ocr.contextSize=5"
                                                  "&hl.ocr.limitBlock=page&q=myquery")
 
     def test_collection_search_result_counts(self):
         # Does the Collection Search endpoint response contain correct numbers of items?
-        with patch("requests.get") as mock_request, patch("builtins.open", FakeManifests().manifests):
+        with patch("whiiif.solr.post") as mock_request, patch("builtins.open", FakeManifests().manifests), \
+                patch("whiiif.manifests.file_stamp", return_value=(0, 0)):
             mock_request.return_value = FakeResponse(test="collection")
             rv = self.app.get('/collection/search?q=myquery')
             json_response = rv.get_json()
@@ -251,7 +507,8 @@ class CollectionSearchTestCase(unittest.TestCase):
 
     def test_collection_search_manifest_url(self):
         # Does the Collection Search endpoint response contain correct manifest_urls?
-        with patch("requests.get") as mock_request, patch("builtins.open", FakeManifests().manifests):
+        with patch("whiiif.solr.post") as mock_request, patch("builtins.open", FakeManifests().manifests), \
+                patch("whiiif.manifests.file_stamp", return_value=(0, 0)):
             mock_request.return_value = FakeResponse(test="collection")
             rv = self.app.get('/collection/search?q=myquery')
             json_response = rv.get_json()
@@ -260,7 +517,8 @@ class CollectionSearchTestCase(unittest.TestCase):
 
     def test_collection_search_canvas_id(self):
         # Does the Collection Search endpoint response contain correct canvas ids?
-        with patch("requests.get") as mock_request, patch("builtins.open", FakeManifests().manifests):
+        with patch("whiiif.solr.post") as mock_request, patch("builtins.open", FakeManifests().manifests), \
+                patch("whiiif.manifests.file_stamp", return_value=(0, 0)):
             mock_request.return_value = FakeResponse(test="collection")
             rv = self.app.get('/collection/search?q=myquery')
             json_response = rv.get_json()
@@ -271,7 +529,8 @@ class CollectionSearchTestCase(unittest.TestCase):
 
     def test_collection_search_region(self):
         # Does the Collection Search endpoint response contain correct regions?
-        with patch("requests.get") as mock_request, patch("builtins.open", FakeManifests().manifests):
+        with patch("whiiif.solr.post") as mock_request, patch("builtins.open", FakeManifests().manifests), \
+                patch("whiiif.manifests.file_stamp", return_value=(0, 0)):
             mock_request.return_value = FakeResponse(test="collection")
             rv = self.app.get('/collection/search?q=myquery')
             json_response = rv.get_json()
@@ -283,7 +542,8 @@ class CollectionSearchTestCase(unittest.TestCase):
     def test_collection_search_url(self):
         # Does the Collection Search endpoint response contain correct a correct image URL?
         # https://test-iiif-endpoint/iiif/collectionimage0/full/full/0/default.jpg",
-        with patch("requests.get") as mock_request, patch("builtins.open", FakeManifests().manifests):
+        with patch("whiiif.solr.post") as mock_request, patch("builtins.open", FakeManifests().manifests), \
+                patch("whiiif.manifests.file_stamp", return_value=(0, 0)):
             mock_request.return_value = FakeResponse(test="collection")
             rv = self.app.get('/collection/search?q=myquery')
             json_response = rv.get_json()
@@ -298,7 +558,8 @@ class CollectionSearchTestCase(unittest.TestCase):
 
     def test_collection_search_coords_single(self):
         # Does the Collection Search endpoint response have correct coords block for a single part result?
-        with patch("requests.get") as mock_request, patch("builtins.open", FakeManifests().manifests):
+        with patch("whiiif.solr.post") as mock_request, patch("builtins.open", FakeManifests().manifests), \
+                patch("whiiif.manifests.file_stamp", return_value=(0, 0)):
             mock_request.return_value = FakeResponse(test="collection")
             rv = self.app.get('/collection/search?q=myquery')
             json_response = rv.get_json()
@@ -311,7 +572,8 @@ class CollectionSearchTestCase(unittest.TestCase):
 
     def test_collection_search_coords_multi(self):
         # Does the Collection Search endpoint response have correct coords block for a multiple part result?
-        with patch("requests.get") as mock_request, patch("builtins.open", FakeManifests().manifests):
+        with patch("whiiif.solr.post") as mock_request, patch("builtins.open", FakeManifests().manifests), \
+                patch("whiiif.manifests.file_stamp", return_value=(0, 0)):
             mock_request.return_value = FakeResponse(test="collection")
             rv = self.app.get('/collection/search?q=myquery')
             json_response = rv.get_json()
@@ -322,7 +584,7 @@ class CollectionSearchTestCase(unittest.TestCase):
 
     def test_collection_search_connection_failure(self):
         # Does the Collection Search endpoint register the error and return gracefully when SOLR doesn't respond?
-        with patch("requests.get") as mock_request, self.assertLogs(level='ERROR') as log_catcher:
+        with patch("whiiif.solr.post") as mock_request, self.assertLogs(level='ERROR') as log_catcher:
             mock_request.return_value = FakeResponse(test="connection_failure")
             rv = self.app.get('/collection/search?q=myquery')
             self.assertIn("ERROR:whiiif:Error occurred with SOLR query: <class 'requests.exceptions.ConnectionError'>",
@@ -332,7 +594,7 @@ class CollectionSearchTestCase(unittest.TestCase):
 
     def test_collection_search_solr_error(self):
         # Does the Collection Search endpoint register the error and return gracefully when SOLR returns an error?
-        with patch("requests.get") as mock_request, self.assertLogs(level='ERROR') as log_catcher:
+        with patch("whiiif.solr.post") as mock_request, self.assertLogs(level='ERROR') as log_catcher:
             mock_request.return_value = FakeResponse(test="solr_error")
             rv = self.app.get('/collection/search?q=myquery')
             self.assertIn("ERROR:whiiif:Error occurred with SOLR query: <class 'KeyError'>",
@@ -343,7 +605,7 @@ class CollectionSearchTestCase(unittest.TestCase):
     def test_collection_search_missing_manifests(self):
         # Does the Collection Search endpoint register the error and skip the result if the manifest JSON is missing?
         # TODO: Add a third manifest to the response, and have only two "missing"
-        with patch("requests.get") as mock_request, self.assertLogs(level='ERROR') as log_catcher:
+        with patch("whiiif.solr.post") as mock_request, self.assertLogs(level='ERROR') as log_catcher:
             mock_request.return_value = FakeResponse(test="collection")
             rv = self.app.get('/collection/search?q=myquery')
             self.assertIn("ERROR:whiiif:Missing manifest JSON file: /test/manifests/collection-manifest.json",
@@ -370,21 +632,23 @@ class SnippetSearchTestCase(unittest.TestCase):
         app.config['SNIPPET_CONTEXT'] = 'word'
         app.config['SNIPPET_CONTEXT_SIZE'] = 5
         app.config['SNIPPET_CONTEXT_LIMIT'] = 'line'
+        cache.reset()
+        query.reset()
         self.app = app.test_client()
 
     def test_snippet_search_query(self):
         # Does the Snippet Search endpoint generate the right SOLR query?
-        with patch("requests.get") as mock_request:
+        with patch("whiiif.solr.post") as mock_request:
             mock_request.return_value = FakeResponse(test="snippet")
             rv = self.app.get('/snippets/test-manifest?q=myquery')
-            mock_request.assert_called_once_with("http://testserver/solr/whiiiftest/select?hl=on"
-                                                 "&hl.weightMatches=true&hl.snippets=3&df=ocr_text&hl.ocr.fl=ocr_text"
+            mock_request.assert_called_once_with("http://testserver/solr/whiiiftest/select",
+                                                 "hl=on&hl.weightMatches=true&df=ocr_text&hl.ocr.fl=ocr_text"
                                                  "&hl.ocr.contextBlock=word&hl.ocr.contextSize=5&hl.ocr.limitBlock=line"
-                                                 "&fq=id:test-manifest&q=myquery")
+                                                 "&hl.snippets=3&fq=id%3Atest-manifest&q=myquery")
 
     def test_snippet_search_result_counts(self):
         # Does the Snippet Search endpoint response contain correct numbers of items?
-        with patch("requests.get") as mock_request:
+        with patch("whiiif.solr.post") as mock_request:
             mock_request.return_value = FakeResponse(test="snippet")
             rv = self.app.get('/snippets/test-manifest?q=myquery')
             json_response = rv.get_json()
@@ -394,7 +658,7 @@ class SnippetSearchTestCase(unittest.TestCase):
 
     def test_snippet_search_id(self):
         # Does the Snippet Search endpoint response contain the correct id?
-        with patch("requests.get") as mock_request:
+        with patch("whiiif.solr.post") as mock_request:
             mock_request.return_value = FakeResponse(test="snippet")
             rv = self.app.get('/snippets/test-manifest?q=myquery')
             json_response = rv.get_json()
@@ -402,7 +666,7 @@ class SnippetSearchTestCase(unittest.TestCase):
 
     def test_snippet_search_canvas_id(self):
         # Does the Snippet Search endpoint response contain correct canvas ids?
-        with patch("requests.get") as mock_request:
+        with patch("whiiif.solr.post") as mock_request:
             mock_request.return_value = FakeResponse(test="snippet")
             rv = self.app.get('/snippets/test-manifest?q=myquery')
             json_response = rv.get_json()
@@ -412,7 +676,7 @@ class SnippetSearchTestCase(unittest.TestCase):
 
     def test_snippet_search_region(self):
         # Does the Snippet Search endpoint response contain correct regions?
-        with patch("requests.get") as mock_request:
+        with patch("whiiif.solr.post") as mock_request:
             mock_request.return_value = FakeResponse(test="snippet")
             rv = self.app.get('/snippets/test-manifest?q=myquery')
             json_response = rv.get_json()
@@ -422,7 +686,7 @@ class SnippetSearchTestCase(unittest.TestCase):
 
     def test_snippet_search_coords_single(self):
         # Does the Snippet Search endpoint response have correct coords block for a single part result?
-        with patch("requests.get") as mock_request:
+        with patch("whiiif.solr.post") as mock_request:
             mock_request.return_value = FakeResponse(test="snippet")
             rv = self.app.get('/snippets/test-manifest?q=myquery')
             json_response = rv.get_json()
@@ -433,7 +697,7 @@ class SnippetSearchTestCase(unittest.TestCase):
 
     def test_snippet_search_coords_multi(self):
         # Does the Snippet Search endpoint response have correct coords block for a multiple part result?
-        with patch("requests.get") as mock_request:
+        with patch("whiiif.solr.post") as mock_request:
             mock_request.return_value = FakeResponse(test="snippet")
             rv = self.app.get('/snippets/test-manifest?q=myquery')
             json_response = rv.get_json()
@@ -444,7 +708,7 @@ class SnippetSearchTestCase(unittest.TestCase):
 
     def test_snippet_search_connection_failure(self):
         # Does the Snippet Search endpoint register the error and return gracefully when SOLR doesn't respond?
-        with patch("requests.get") as mock_request, self.assertLogs(level='ERROR') as log_catcher:
+        with patch("whiiif.solr.post") as mock_request, self.assertLogs(level='ERROR') as log_catcher:
             mock_request.return_value = FakeResponse(test="connection_failure")
             rv = self.app.get('/snippets/test-manifest?q=myquery')
             self.assertIn("ERROR:whiiif:Error occurred with SOLR query: <class 'requests.exceptions.ConnectionError'>",
@@ -454,7 +718,7 @@ class SnippetSearchTestCase(unittest.TestCase):
 
     def test_snippet_search_solr_error(self):
         # Does the Snippet Search endpoint register the error and return gracefully when SOLR returns an error?
-        with patch("requests.get") as mock_request, self.assertLogs(level='ERROR') as log_catcher:
+        with patch("whiiif.solr.post") as mock_request, self.assertLogs(level='ERROR') as log_catcher:
             mock_request.return_value = FakeResponse(test="solr_error")
             rv = self.app.get('/snippets/test-manifest?q=myquery')
             self.assertIn("ERROR:whiiif:Error occurred with SOLR query: <class 'KeyError'>",
@@ -464,22 +728,850 @@ class SnippetSearchTestCase(unittest.TestCase):
 
     def test_snippet_search_snips(self):
         # Does the Snippet Search endpoint correctly handle the snips parameter?
-        with patch("requests.get") as mock_request:
+        with patch("whiiif.solr.post") as mock_request:
             mock_request.return_value = FakeResponse(test="snippet")
             rv = self.app.get('/snippets/test-manifest?q=myquery&snips=1')
-            mock_request.assert_called_once_with("http://testserver/solr/whiiiftest/select?hl=on"
-                                                 "&hl.weightMatches=true&hl.snippets=1&df=ocr_text&hl.ocr.fl=ocr_text"
+            mock_request.assert_called_once_with("http://testserver/solr/whiiiftest/select",
+                                                 "hl=on&hl.weightMatches=true&df=ocr_text&hl.ocr.fl=ocr_text"
                                                  "&hl.ocr.contextBlock=word&hl.ocr.contextSize=5&hl.ocr.limitBlock=line"
-                                                 "&fq=id:test-manifest&q=myquery")
+                                                 "&hl.snippets=1&fq=id%3Atest-manifest&q=myquery")
 
     def test_snippet_search_scaled(self):
         # Does the Snippet Search endpoint response correctly apply scaling when present in SOLR response?
-        with patch("requests.get") as mock_request:
+        with patch("whiiif.solr.post") as mock_request:
             mock_request.return_value = FakeResponse(test="snippet_scaled")
             rv = self.app.get('/snippets/test-manifest?q=myquery')
             json_response = rv.get_json()
             self.assertEqual(json_response[0]["canvases"][0]["region"], "7434,12852,8949,539")
             self.assertEqual(json_response[0]["canvases"][0]["highlights"][0]["coords"], "5855,0,2705,339")
 
+    def test_snippet_batch_query(self):
+        # Does the batch Snippet Search endpoint fetch every document in a single SOLR query?
+        with patch("whiiif.solr.post") as mock_request:
+            mock_request.return_value = FakeResponse(test="snippet")
+            rv = self.app.get('/snippets?ids=test-manifest,other-manifest,test-manifest,bad%20id&q=myquery')
+            mock_request.assert_called_once_with("http://testserver/solr/whiiiftest/select",
+                                                 "hl=on&hl.weightMatches=true&df=ocr_text&hl.ocr.fl=ocr_text"
+                                                 "&hl.ocr.contextBlock=word&hl.ocr.contextSize=5&hl.ocr.limitBlock=line"
+                                                 "&hl.snippets=3&rows=3"
+                                                 "&fq=%7B%21terms+f%3Did%7Dtest-manifest%2Cother-manifest%2Cbadid"
+                                                 "&q=myquery")
+
+    def test_snippet_batch_results(self):
+        # Does the batch endpoint return the same per-document results as /snippets/<id>, and cache them per document?
+        with patch("whiiif.solr.post") as mock_request:
+            mock_request.return_value = FakeResponse(test="snippet")
+            batch = self.app.get('/snippets?ids=other-manifest,test-manifest&q=myquery').get_json()
+            single = self.app.get('/snippets/test-manifest?q=myquery').get_json()
+            self.assertEqual(batch, single)
+            self.assertEqual(self.app.get('/snippets/other-manifest?q=myquery').get_json(), [])
+            self.assertEqual(mock_request.call_count, 1)
+
+    def test_snippet_batch_max_ids(self):
+        # Is the number of documents in one batch limited?
+        app.config['SNIPPETS_BATCH_MAX_IDS'] = 2
+        try:
+            with patch("whiiif.solr.post") as mock_request:
+                mock_request.return_value = FakeResponse(test="snippet")
+                self.app.get('/snippets?ids=a,b,c&q=myquery')
+                self.assertIn("&rows=2&fq=%7B%21terms+f%3Did%7Da%2Cb&", mock_request.call_args[0][1])
+        finally:
+            app.config['SNIPPETS_BATCH_MAX_IDS'] = 50
+
+
+class GeometryTestCase(unittest.TestCase):
+    """Tests for the batched box conversions"""
+    boxes = [{"ulx": 3133, "uly": 1319, "lrx": 3436, "lry": 1442}, {"ulx": 7, "uly": 9, "lrx": 20, "lry": 30}] * 40
+
+    def test_xywh(self):
+        # Are boxes converted to x,y,w,h, with scaled values truncated like int()?
+        self.assertEqual(geometry.xywh(self.boxes[:2]), [(3133, 1319, 303, 123), (7, 9, 13, 21)])
+        self.assertEqual(geometry.xywh(self.boxes[:2], 0.25), [(783, 329, 75, 30), (1, 2, 3, 5)])
+
+    @unittest.skipIf(geometry.numpy is None, "NumPy is not installed")
+    def test_numpy_matches_python(self):
+        # Does the NumPy path give exactly the same boxes as the pure Python one?
+        for scale in (0.25, 1.5, 0.3333):
+            self.assertEqual([tuple(box) for box in geometry.xywh(self.boxes, scale)],
+                             geometry._python_xywh(self.boxes, scale))
+
+
+class SolrClientTestCase(unittest.TestCase):
+    """Tests for the pooled SOLR client"""
+    def setUp(self):
+        app.config['SOLR_CONNECT_TIMEOUT'] = 2
+        app.config['SOLR_READ_TIMEOUT'] = 10
+        app.config['SOLR_RETRIES'] = 3
+        app.config['SOLR_POOL_MAXSIZE'] = 8
+        solr.reset_session()
+
+    def tearDown(self):
+        solr.reset_session()
+
+    def test_session_reused(self):
+        # Is one Session shared between requests in the same process?
+        self.assertIs(solr.get_session(), solr.get_session())
+
+    def test_session_not_shared_across_fork(self):
+        # Is a new Session built when the process id changes, e.g. in a pre-forked worker?
+        session = solr.get_session()
+        with patch("os.getpid", return_value=-1):
+            self.assertIsNot(solr.get_session(), session)
+
+    def test_session_pool_config(self):
+        # Is the connection pool configured from the app settings?
+        adapter = solr.get_session().get_adapter("http://testserver/solr")
+        self.assertEqual(adapter._pool_maxsize, 8)
+        self.assertEqual(adapter.max_retries.total, 3)
+
+    def test_post_form(self):
+        # Are queries sent as urlencoded form bodies, with the configured timeouts?
+        with patch("requests.Session.post") as mock_post:
+            solr.post("http://testserver/solr/whiiiftest/select", "q=myquery")
+            mock_post.assert_called_once_with("http://testserver/solr/whiiiftest/select", data=b"q=myquery",
+                                              timeout=(2, 10), stream=True,
+                                              headers={"Content-Type": "application/x-www-form-urlencoded; "
+                                                                      "charset=UTF-8"})
+
+    def test_query_encoding(self):
+        # Are the per-request params urlencoded, so they can't inject extra SOLR params?
+        app.config['SOLR_URL'] = 'http://testserver/solr'
+        app.config['SOLR_CORE'] = 'whiiiftest'
+        app.config['DOCUMENT_ID_FIELD'] = 'id'
+        query.reset()
+        solr_query = query.search("test-manifest", "my query&rows=100000", 10)
+        self.assertEqual(solr_query.url, "http://testserver/solr/whiiiftest/select")
+        self.assertTrue(solr_query.data.endswith("&hl.snippets=10&fq=id%3Atest-manifest&q=my+query%26rows%3D100000"))
+        self.assertIs(query.get_template("search"), query.get_template("search"))
+
+
+class CoalesceTestCase(unittest.TestCase):
+    """Tests for the single-flight coalescing of identical SOLR queries"""
+    def setUp(self):
+        app.config['TESTING'] = True
+        app.config['SERVER_NAME'] = 'testserver:5000'
+        app.config['SOLR_URL'] = 'http://testserver/solr'
+        app.config['SOLR_CORE'] = 'whiiiftest'
+        app.config['OCR_TEXT_FIELD'] = 'ocr_text'
+        app.config['MANIFEST_URL_FIELD'] = 'manifest_url'
+        app.config['DOCUMENT_ID_FIELD'] = 'id'
+        app.config['SEARCH_CACHE_SIZE'] = 0
+        cache.reset()
+        query.reset()
+
+    def tearDown(self):
+        app.config['SEARCH_CACHE_SIZE'] = 1024
+        cache.reset()
+
+    def test_concurrent_searches_coalesced(self):
+        # Do identical searches arriving while one is in flight share its SOLR query and result?
+        flights = coalesce.SingleFlight()
+        release = threading.Event()
+
+        def slow_post(*args, **kwargs):
+            release.wait(5)
+            return FakeResponse(test="iiif")
+
+        responses = []
+
+        def search():
+            responses.append(app.test_client().get('/search/test-manifest?q=myquery').get_json())
+
+        with patch("whiiif.solr.post", side_effect=slow_post) as mock_request, \
+                patch("whiiif.coalesce.flights", flights):
+            threads = [threading.Thread(target=search) for _ in range(4)]
+            for thread in threads:
+                thread.start()
+            for _ in range(500):
+                if flights.coalesced == 3:
+                    break
+                time.sleep(0.01)
+            release.set()
+            for thread in threads:
+                thread.join(5)
+            self.assertEqual(mock_request.call_count, 1)
+        self.assertEqual(flights.stats(), {"in_flight": 0, "leaders": 1, "coalesced": 3})
+        self.assertEqual(len(responses), 4)
+        self.assertTrue(all(response["resources"] == responses[0]["resources"] for response in responses))
+
+    def test_errors_shared(self):
+        # Do coalesced requests see the error from the shared query, and is the key cleared afterwards?
+        flights = coalesce.SingleFlight()
+        with self.assertRaises(ConnectionError):
+            flights.do("key", FakeResponse(test="connection_failure").json)
+        self.assertEqual(flights.do("key", lambda: 1), 1)
+        self.assertEqual(flights.stats()["in_flight"], 0)
+
+    def test_async_coalesced(self):
+        # Do concurrent tasks awaiting the same key share one call?
+        flights = coalesce.AsyncSingleFlight()
+        calls = []
+
+        async def run():
+            calls.append(1)
+            await asyncio.sleep(0.01)
+            return {"docs": []}
+
+        async def burst():
+            return await asyncio.gather(*[flights.do("key", run) for _ in range(5)])
+
+        results = asyncio.run(burst())
+        self.assertEqual(len(calls), 1)
+        self.assertTrue(all(result is results[0] for result in results))
+        self.assertEqual(flights.stats(), {"in_flight": 0, "leaders": 1, "coalesced": 4})
+
+
+class SearchCacheTestCase(unittest.TestCase):
+    """Tests for the IIIF Search response cache"""
+    def setUp(self):
+        app.config['TESTING'] = True
+        app.config['DEBUG'] = False
+        app.config['SERVER_NAME'] = 'testserver:5000'
+        app.config['SOLR_URL'] = 'http://testserver/solr'
+        app.config['SOLR_CORE'] = 'whiiiftest'
+        app.config['CACHE_BACKEND'] = 'memory'
+        app.config['SEARCH_CACHE_SIZE'] = 2
+        app.config['SEARCH_CACHE_TTL'] = 300
+        self.cache_dir = tempfile.TemporaryDirectory()
+        app.config['CACHE_LOCATION'] = self.cache_dir.name
+        cache.reset()
+        query.reset()
+        self.app = app.test_client()
+
+    def tearDown(self):
+        self.cache_dir.cleanup()
+        cache.reset()
+
+    def test_cache_hit(self):
+        # Is a repeated search served from the cache without querying SOLR again?
+        with patch("whiiif.solr.post") as mock_request:
+            mock_request.return_value = FakeResponse(test="iiif")
+            first = self.app.get('/search/test-manifest?q=myquery').get_json()
+            second = self.app.get('/search/test-manifest?q=%20myquery%20&motivation=').get_json()
+            self.assertEqual(mock_request.call_count, 2)  # ignored params are part of the key
+            third = self.app.get('/search/test-manifest?q=myquery%20%20').get_json()
+            self.assertEqual(mock_request.call_count, 2)
+            self.assertEqual(first["resources"], third["resources"])
+            self.assertEqual(third["@id"], "http://testserver:5000/search/test-manifest?q=myquery%20%20")
+            self.assertEqual(second["within"]["ignored"], ["motivation"])
+            self.assertEqual(cache.get_cache("search").stats()["hits"], 1)
+            self.assertEqual(cache.get_cache("search").stats()["misses"], 2)
+
+    def test_cache_hit_paging(self):
+        # Are a cached page's paging links built from the request it's served to, not the one that filled the cache?
+        self.addCleanup(app.config.__setitem__, 'SEARCH_PAGE_SIZE', app.config['SEARCH_PAGE_SIZE'])
+        app.config['SEARCH_PAGE_SIZE'] = 1
+        with patch("whiiif.solr.post") as mock_request:
+            mock_request.return_value = FakeResponse(test="iiif")
+            first = self.app.get('/search/test-manifest?q=myquery%20%20&page=1').get_json()
+            second = self.app.get('/search/test-manifest?q=myquery&page=1').get_json()
+            self.assertEqual(mock_request.call_count, 1)
+        url = "http://testserver:5000/search/test-manifest?q=myquery&page={}"
+        self.assertEqual(second["@id"], url.format(1))
+        self.assertEqual((second["within"]["first"], second["within"]["last"]), (url.format(0), url.format(2)))
+        self.assertEqual((second["prev"], second["next"]), (url.format(0), url.format(2)))
+        self.assertEqual(second["startIndex"], 1)
+        self.assertEqual(second["within"]["total"], 3)
+        self.assertEqual(list(second), list(first))
+        self.assertEqual(second["hits"], first["hits"])
+
+    def test_cache_skips_errors(self):
+        # Are failed SOLR queries left out of the cache?
+        with patch("whiiif.solr.post") as mock_request, self.assertLogs(level='ERROR'):
+            mock_request.return_value = FakeResponse(test="solr_error")
+            self.app.get('/search/test-manifest?q=myquery')
+            self.app.get('/search/test-manifest?q=myquery')
+            self.assertEqual(mock_request.call_count, 2)
+
+    def test_cache_lru_eviction(self):
+        # Is the least recently used entry evicted once the cache is full?
+        lru = cache.get_cache("search")
+        lru.set(("a", "q", ()), 1)
+        lru.set(("b", "q", ()), 2)
+        lru.get(("a", "q", ()))
+        lru.set(("c", "q", ()), 3)
+        self.assertIsNone(lru.get(("b", "q", ())))
+        self.assertEqual(lru.get(("a", "q", ())), 1)
+        self.assertEqual(lru.stats()["evictions"], 1)
+
+    def test_cache_ttl(self):
+        # Do entries expire after the TTL?
+        lru = cache.get_cache("search")
+        with patch("time.monotonic", return_value=1000):
+            lru.set(("a", "q", ()), 1)
+        with patch("time.monotonic", return_value=1301):
+            self.assertIsNone(lru.get(("a", "q", ())))
+
+    def test_cache_invalidate_document(self):
+        # Does reindexing a document drop its cached responses, but not those of other documents?
+        lru = cache.get_cache("search")
+        lru.set(("a", "q", ()), 1)
+        lru.set(("b", "q", ()), 2)
+        cache.touch_document("a")  # as the indexer would, from another process
+        self.assertIsNone(lru.get(("a", "q", ())))
+        self.assertEqual(lru.get(("b", "q", ())), 2)
+        cache.invalidate_document("b")
+        self.assertIsNone(lru.get(("b", "q", ())))
+
+
+class SqliteCacheTestCase(unittest.TestCase):
+    """Tests for the shared SQLite response cache backend"""
+    def setUp(self):
+        app.config['TESTING'] = True
+        app.config['DEBUG'] = False
+        app.config['SERVER_NAME'] = 'testserver:5000'
+        app.config['SOLR_URL'] = 'http://testserver/solr'
+        app.config['SOLR_CORE'] = 'whiiiftest'
+        app.config['CACHE_BACKEND'] = 'sqlite'
+        app.config['SNIPPETS_CACHE_SIZE'] = 2
+        app.config['SNIPPETS_CACHE_TTL'] = 300
+        self.cache_dir = tempfile.TemporaryDirectory()
+        app.config['CACHE_LOCATION'] = self.cache_dir.name
+        cache.reset()
+        query.reset()
+        self.app = app.test_client()
+
+    def tearDown(self):
+        cache.reset()
+        app.config['CACHE_BACKEND'] = 'memory'
+        self.cache_dir.cleanup()
+
+    def test_sqlite_cache_hit(self):
+        # Is a repeated snippet search served from the shared cache, including by another worker's backend?
+        with patch("whiiif.solr.post") as mock_request:
+            mock_request.return_value = FakeResponse(test="snippet")
+            first = self.app.get('/snippets/test-manifest?q=myquery').get_json()
+            cache.reset()  # as if a different worker process served the second request
+            second = self.app.get('/snippets/test-manifest?q=myquery').get_json()
+            self.assertEqual(mock_request.call_count, 1)
+            self.assertEqual(first, second)
+
+    def test_sqlite_cache_lru_eviction(self):
+        # Are the least recently used entries trimmed once the cache is over its size?
+        shared = cache.get_cache("snippets")
+        with patch("time.time", return_value=1000):
+            shared.set(("a", "q", "3"), [1])
+        with patch("time.time", return_value=1001):
+            shared.set(("b", "q", "3"), [2])
+        with patch("time.time", return_value=1100):
+            shared.get(("a", "q", "3"))
+            shared.set(("c", "q", "3"), [3])
+            shared.trim()
+            self.assertIsNone(shared.get(("b", "q", "3")))
+            self.assertEqual(shared.get(("a", "q", "3")), [1])
+            self.assertEqual(shared.stats()["size"], 2)
+
+    def test_sqlite_cache_hit_read_only(self):
+        # Does a hit only write the entry's access time once it's older than the touch interval?
+        shared = cache.get_cache("snippets")
+        with patch("time.time", return_value=1000):
+            shared.set(("a", "q", "3"), [1])
+
+        def accessed():
+            return shared._connection().execute("SELECT accessed FROM entries").fetchone()[0]
+        with patch("time.time", return_value=1000 + shared.touch_interval - 1):
+            self.assertEqual(shared.get(("a", "q", "3")), [1])
+            self.assertEqual(accessed(), 1000)
+        with patch("time.time", return_value=1000 + shared.touch_interval):
+            self.assertEqual(shared.get(("a", "q", "3")), [1])
+            self.assertEqual(accessed(), 1000 + shared.touch_interval)
+
+    def test_sqlite_cache_ttl(self):
+        # Do entries expire after the TTL?
+        shared = cache.get_cache("snippets")
+        with patch("time.time", return_value=1000):
+            shared.set(("a", "q", "3"), [1])
+        with patch("time.time", return_value=1301):
+            self.assertIsNone(shared.get(("a", "q", "3")))
+
+    def test_sqlite_cache_invalidate_document(self):
+        # Does reindexing a document drop its entries and all collection entries?
+        cache.get_cache("snippets").set(("a", "q", "3"), [1])
+        cache.get_cache("snippets").set(("b", "q", "3"), [2])
+        cache.get_cache("collection").set(cache.collection_key("q"), [3])
+        cache.invalidate_document("a")
+        self.assertIsNone(cache.get_cache("snippets").get(("a", "q", "3")))
+        self.assertEqual(cache.get_cache("snippets").get(("b", "q", "3")), [2])
+        self.assertIsNone(cache.get_cache("collection").get(cache.collection_key("q")))
+
+    def test_unknown_backend(self):
+        # Is a misconfigured backend reported?
+        app.config['CACHE_BACKEND'] = 'nosuchbackend'
+        with self.assertRaises(ValueError):
+            cache.get_cache("search")
+
+
+class ManifestCacheTestCase(unittest.TestCase):
+    """Tests for the cache of per-canvas image URLs read from manifests"""
+    def setUp(self):
+        app.config['MANIFEST_CACHE_MAX_BYTES'] = 64 * 1024
+        manifest_cache.reset()
+        self.manifest_dir = tempfile.TemporaryDirectory()
+        self.manifest_path = os.path.join(self.manifest_dir.name, "collection-manifest.json")
+        with open(self.manifest_path, "w") as manifest_file:
+            manifest_file.write(manifests.COLLECTION_ONE)
+
+    def tearDown(self):
+        manifest_cache.reset()
+        self.manifest_dir.cleanup()
+
+    def test_canvas_images(self):
+        # Is the per-canvas image URL table read from the manifest?
+        images = manifest_cache.canvas_images(self.manifest_path)
+        self.assertEqual(images[0], "https://test-iiif-endpoint/iiif/collectionimage0/full/full/0/default.jpg")
+        self.assertEqual(images[1], "https://test-iiif-endpoint/iiif/collectionimage1/full/full/0/default.jpg")
+
+    def test_canvas_images_cached(self):
+        # Is an unchanged manifest only parsed once?
+        with patch("whiiif.manifests.read_canvas_images", wraps=manifest_cache.read_canvas_images) as mock_read:
+            first = manifest_cache.canvas_images(self.manifest_path)
+            second = manifest_cache.canvas_images(self.manifest_path)
+            self.assertIs(first, second)
+            self.assertEqual(mock_read.call_count, 1)
+
+    def test_canvas_images_rewritten(self):
+        # Is a rewritten manifest (e.g. by index_with_plugin.py --modify) read again?
+        manifest_cache.canvas_images(self.manifest_path)
+        with open(self.manifest_path, "w") as manifest_file:
+            manifest_file.write(manifests.COLLECTION_ONE.replace("collectionimage0", "rewrittenimage0"))
+        os.utime(self.manifest_path, ns=(1, 1))
+        images = manifest_cache.canvas_images(self.manifest_path)
+        self.assertEqual(images[0], "https://test-iiif-endpoint/iiif/rewrittenimage0/full/full/0/default.jpg")
+
+    def test_canvas_images_memory_bound(self):
+        # Are the least recently used tables evicted to keep within the memory bound?
+        image_cache = manifest_cache.canvas_image_cache()
+        table_size = manifest_cache.table_size(manifest_cache.read_canvas_images(self.manifest_path))
+        image_cache.max_bytes = table_size * 2
+        other_paths = []
+        for name in ("another", "third"):
+            other_paths.append(os.path.join(self.manifest_dir.name, name + ".json"))
+            with open(other_paths[-1], "w") as manifest_file:
+                manifest_file.write(manifests.COLLECTION_ONE)
+        manifest_cache.canvas_images(self.manifest_path)
+        for other_path in other_paths:
+            manifest_cache.canvas_images(other_path)
+        self.assertLessEqual(image_cache.size_bytes, image_cache.max_bytes)
+        self.assertNotIn(self.manifest_path, image_cache._entries)
+
+    def test_canvas_images_missing(self):
+        # Is a missing manifest reported as such?
+        with self.assertRaises(FileNotFoundError):
+            manifest_cache.canvas_images(os.path.join(self.manifest_dir.name, "missing.json"))
+
+
+class CanvasIndexTestCase(unittest.TestCase):
+    """Tests for the canvas image indexes written at ingest time"""
+    def setUp(self):
+        app.config['TESTING'] = True
+        app.config['DEBUG'] = False
+        app.config['SERVER_NAME'] = 'testserver:5000'
+        app.config['SOLR_URL'] = 'http://testserver/solr'
+        app.config['SOLR_CORE'] = 'whiiiftest'
+        app.config['MANIFEST_LOCATION'] = '/test/manifests'
+        self.index_dir = tempfile.TemporaryDirectory()
+        app.config['CANVAS_INDEX_LOCATION'] = self.index_dir.name
+        cache.reset()
+        query.reset()
+        manifest_cache.reset()
+        self.app = app.test_client()
+
+    def tearDown(self):
+        app.config['CANVAS_INDEX_LOCATION'] = '/opt/whiiif/resources/canvases'
+        self.index_dir.cleanup()
+
+    def write_indexes(self):
+        for document, manifest in (("collection-manifest", manifests.COLLECTION_ONE),
+                                   ("collection-another", manifests.COLLECTION_TWO)):
+            manifest_cache.write_canvas_index(manifest_cache.canvas_index_path(document),
+                                              manifest_cache.manifest_canvas_images(json.loads(manifest)))
+
+    def test_canvas_index_lookup(self):
+        # Does a canvas index return the same image URLs, and empty entries, as the manifest?
+        index_path = manifest_cache.canvas_index_path("test")
+        manifest_cache.write_canvas_index(index_path, ["http://a/full/full/0/default.jpg", None, "http://é"])
+        index = manifest_cache.CanvasIndex(index_path)
+        self.assertEqual(len(index), 3)
+        self.assertEqual(index[0], "http://a/full/full/0/default.jpg")
+        self.assertIsNone(index[1])
+        self.assertEqual(index[2], "http://é")
+        with self.assertRaises(IndexError):
+            index[3]
+
+    def test_canvas_index_opened_once(self):
+        # Is the index file opened once, however many lookups there are, and read consistently if it's replaced?
+        index_path = manifest_cache.canvas_index_path("test")
+        manifest_cache.write_canvas_index(index_path, ["http://a", "http://b"])
+        with patch("builtins.open", wraps=open) as mock_file:
+            index = manifest_cache.CanvasIndex(index_path)
+            self.assertEqual([index[1], index[0], index[1]], ["http://b", "http://a", "http://b"])
+            self.assertEqual(mock_file.call_count, 1)
+        manifest_cache.write_canvas_index(index_path, ["http://c"])
+        self.assertEqual(index[1], "http://b")
+        self.assertEqual(manifest_cache.CanvasIndex(index_path)[0], "http://c")
+
+    def test_canvas_index_replaced(self):
+        # Is an index written through a temporary file of its own, leaving only the readable index behind?
+        index_path = manifest_cache.canvas_index_path("test")
+        for images in (["http://a"], ["http://b"]):
+            manifest_cache.write_canvas_index(index_path, images)
+            pages.write_page_index(os.path.join(self.index_dir.name, "test.pages"), [("P1", 0, 10)])
+        self.assertEqual(sorted(os.listdir(self.index_dir.name)), ["test.idx", "test.pages"])
+        self.assertEqual(os.stat(index_path).st_mode & 0o777, 0o644)
+        open(index_path, "wb").close()
+        with self.assertRaises(FileNotFoundError):  # an empty index falls back to the (missing) manifest
+            manifest_cache.canvas_lookup("test")
+
+    def test_collection_search_canvas_index(self):
+        # Does the Collection Search endpoint use the canvas indexes without reading any manifests?
+        self.write_indexes()
+        with patch("whiiif.solr.post") as mock_request, \
+                patch("whiiif.manifests.read_canvas_images") as mock_read:
+            mock_request.return_value = FakeResponse(test="collection")
+            rv = self.app.get('/collection/search?q=myquery')
+            json_response = rv.get_json()
+            mock_read.assert_not_called()
+            self.assertEqual(json_response[0]["canvases"][1]["url"], "https://test-iiif-endpoint/iiif/collectionimage1"
+                                                                     "/951,3626,3018,226/754,/0/default.jpg")
+            self.assertEqual(json_response[1]["canvases"][0]["url"], "https://test-iiif-endpoint/iiif/collectionimage3"
+                                                                     "/697,2690,3132,1220/783,/0/default.jpg")
+
+
+class PageIndexTestCase(unittest.TestCase):
+    """Tests for the OCR page indexes written at ingest time"""
+    def setUp(self):
+        app.config['TESTING'] = True
+        app.config['DEBUG'] = False
+        app.config['SERVER_NAME'] = 'testserver:5000'
+        app.config['SOLR_URL'] = 'http://testserver/solr'
+        app.config['SOLR_CORE'] = 'whiiiftest'
+        app.config['MANIFEST_LOCATION'] = '/test/manifests'
+        self.index_dir = tempfile.TemporaryDirectory()
+        app.config['CANVAS_INDEX_LOCATION'] = self.index_dir.name
+        app.config['XML_LOCATION'] = self.index_dir.name
+        cache.reset()
+        query.reset()
+        manifest_cache.reset()
+        self.app = app.test_client()
+
+    def tearDown(self):
+        app.config['CANVAS_INDEX_LOCATION'] = '/opt/whiiif/resources/canvases'
+        app.config['XML_LOCATION'] = '/opt/whiiif/resources/xml'
+        self.index_dir.cleanup()
+
+    def test_page_index_lookup(self):
+        # Does a page index find each page's position and read just its OCR?
+        ocr = b'<alto><Layout><Page ID="P1"></Page><Page ID="PAGE.2">caf&#233;</Page></Layout></alto>'
+        with open(pages.ocr_path("test"), "wb") as ocr_file:
+            ocr_file.write(ocr)
+        first, second = ocr.index(b'<Page ID="P1">'), ocr.index(b'<Page ID="PAGE.2">')
+        pages.write_page_index(pages.page_index_path("test"), [("P1", first, second),
+                                                               ("PAGE.2", second, ocr.index(b"</Layout>"))])
+        index = pages.page_lookup("test")
+        self.assertEqual(len(index), 2)
+        self.assertEqual(index.position("PAGE.2"), 1)
+        self.assertEqual(index.read("P1"), b'<Page ID="P1"></Page>')
+        self.assertEqual(index.read("PAGE.2"), b'<Page ID="PAGE.2">caf&#233;</Page>')
+        self.assertNotIn("P3", index)
+        self.assertIsNone(pages.page_lookup("missing"))
+
+    def test_canvas_number(self):
+        # Are page_N IDs still canvas N, and other IDs placed by the page index?
+        pages.write_page_index(pages.page_index_path("test"), [("P1", 0, 0), ("P2", 0, 0)])
+        index = pages.page_lookup("test")
+        self.assertEqual(pages.canvas_number("page_7"), 7)
+        self.assertEqual(pages.canvas_number("page_7", index), 7)
+        self.assertEqual(pages.canvas_number("P2", index), 1)
+        with self.assertRaises(ValueError):
+            pages.canvas_number("P2")
+        with self.assertRaises(ValueError):
+            pages.canvas_number("P3", index)
+
+    def test_collection_search_page_index(self):
+        # Does the Collection Search endpoint find the canvases for page IDs that aren't page_N?
+        for document, manifest in (("collection-manifest", manifests.COLLECTION_ONE),
+                                   ("collection-another", manifests.COLLECTION_TWO)):
+            manifest_cache.write_canvas_index(manifest_cache.canvas_index_path(document),
+                                              manifest_cache.manifest_canvas_images(json.loads(manifest)))
+            pages.write_page_index(pages.page_index_path(document), [("P0", 0, 0), ("P1", 0, 0)])
+        response = FakeResponse(test="collection")
+        response.json_data = json.loads(json.dumps(solr_responses.COLLECTION).replace('"page_', '"P'))
+        with patch("whiiif.solr.post", return_value=response):
+            rv = self.app.get('/collection/search?q=myquery')
+            json_response = rv.get_json()
+            self.assertEqual(json_response[0]["canvases"][1]["canvas"], "P1")
+            self.assertEqual(json_response[0]["canvases"][1]["url"], "https://test-iiif-endpoint/iiif/collectionimage1"
+                                                                     "/951,3626,3018,226/754,/0/default.jpg")
+            self.assertEqual(json_response[1]["canvases"][0]["url"], "https://test-iiif-endpoint/iiif/collectionimage3"
+                                                                     "/697,2690,3132,1220/783,/0/default.jpg")
+
+
+class MetricsTestCase(unittest.TestCase):
+    """Tests for the Prometheus metrics endpoint"""
+    def setUp(self):
+        app.config['TESTING'] = True
+        app.config['DEBUG'] = False
+        app.config['SERVER_NAME'] = 'testserver:5000'
+        app.config['SOLR_URL'] = 'http://testserver/solr'
+        app.config['SOLR_CORE'] = 'whiiiftest'
+        app.config['CACHE_BACKEND'] = 'memory'
+        self.metrics_dir = tempfile.TemporaryDirectory()
+        cache.reset()
+        query.reset()
+        metrics.reset()
+        self.app = app.test_client()
+
+    def tearDown(self):
+        app.config['METRICS_ENABLED'] = True
+        app.config['METRICS_DIR'] = ''
+        self.metrics_dir.cleanup()
+        cache.reset()
+        metrics.reset()
+
+    def test_search_stages(self):
+        # Is each stage of a search timed, and are the response cache counters collected?
+        with patch("whiiif.solr.post", return_value=FakeResponse(test="iiif")):
+            self.app.get('/search/test-manifest?q=myquery')
+            self.app.get('/search/test-manifest?q=myquery')
+        rv = self.app.get('/metrics')
+        self.assertEqual(rv.content_type, metrics.CONTENT_TYPE)
+        body = rv.get_data(as_text=True)
+        self.assertIn('whiiif_request_duration_seconds_count{endpoint="search"} 2', body)
+        for stage, count in (("query", 1), ("solr", 1), ("parse", 1), ("transform", 1), ("encode", 2)):
+            self.assertIn('whiiif_stage_duration_seconds_count{{endpoint="search",stage="{}"}} {}'
+                          .format(stage, count), body)
+        self.assertIn('whiiif_hits_count{endpoint="search"} 1', body)  # the second search was a cache hit
+        self.assertIn('whiiif_cache_hits_total{cache="search"} 1', body)
+        self.assertIn('whiiif_cache_misses_total{cache="search"} 1', body)
+        self.assertIn('whiiif_response_bytes_bucket{endpoint="search",le="+Inf"} 2', body)
+
+    def test_aggregate_processes(self):
+        # Are the snapshots of other processes added in, leaving out the gauges of those that have exited?
+        app.config['METRICS_DIR'] = self.metrics_dir.name
+        with patch("whiiif.solr.post", return_value=FakeResponse(test="iiif")):
+            self.app.get('/search/test-manifest?q=myquery')
+        with patch("whiiif.metrics.process_alive", return_value=False):
+            other = {"pid": os.getpid() + 1,
+                     "histograms": [["whiiif_request_duration_seconds", [["endpoint", "search"]],
+                                     [0] * len(metrics.LATENCY_BUCKETS) + [1], 60.0]],
+                     "values": [["counter", "whiiif_cache_misses_total", [["cache", "search"]], 4],
+                                ["gauge", "whiiif_cache_entries", [["cache", "search"]], 4]]}
+            with open(metrics.snapshot_path(other["pid"]), "w") as snapshot_file:
+                json.dump(other, snapshot_file)
+            body = self.app.get('/metrics').get_data(as_text=True)
+        self.assertIn('whiiif_request_duration_seconds_count{endpoint="search"} 2', body)
+        self.assertIn('whiiif_request_duration_seconds_bucket{endpoint="search",le="30"} 1', body)
+        self.assertIn('whiiif_cache_misses_total{cache="search"} 5', body)
+        self.assertIn('whiiif_cache_entries{cache="search"} 1', body)
+        self.assertTrue(os.path.exists(metrics.snapshot_path(os.getpid())))
+
+    def test_flush(self):
+        # Is only one snapshot write claimed per interval, written without a leftover temporary file, and the latest
+        # observations written when the process exits?
+        app.config['METRICS_DIR'] = self.metrics_dir.name
+        self.assertTrue(metrics.registry.flush_due(60))
+        self.assertFalse(metrics.registry.flush_due(60))
+        with patch("whiiif.solr.post", return_value=FakeResponse(test="iiif")):
+            self.app.get('/search/test-manifest?q=myquery')
+        self.assertEqual(os.listdir(self.metrics_dir.name), [])
+        metrics.flush_at_exit()
+        self.assertEqual(os.listdir(self.metrics_dir.name), [os.path.basename(metrics.snapshot_path(os.getpid()))])
+        with open(metrics.snapshot_path(os.getpid())) as snapshot_file:
+            snapshot = json.load(snapshot_file)
+        self.assertIn(["whiiif_request_duration_seconds", [["endpoint", "search"]]],
+                      [histogram[:2] for histogram in snapshot["histograms"]])
+
+    def test_metrics_disabled(self):
+        # Is nothing recorded, and the endpoint hidden, when metrics are turned off?
+        app.config['METRICS_ENABLED'] = False
+        with patch("whiiif.solr.post", return_value=FakeResponse(test="iiif")):
+            self.app.get('/search/test-manifest?q=myquery')
+        self.assertEqual(self.app.get('/metrics').status_code, 404)
+        self.assertEqual(metrics.registry.histograms, {})
+
+
+class ProfilingTestCase(unittest.TestCase):
+    """Tests for the slow request profiler"""
+    def setUp(self):
+        app.config['TESTING'] = True
+        app.config['DEBUG'] = False
+        app.config['SERVER_NAME'] = 'testserver:5000'
+        app.config['SOLR_URL'] = 'http://testserver/solr'
+        app.config['SOLR_CORE'] = 'whiiiftest'
+        app.config['CACHE_BACKEND'] = 'memory'
+        app.config['PROFILE_SAMPLE_RATE'] = 1
+        app.config['PROFILE_THRESHOLD'] = 0
+        self.log_dir = tempfile.TemporaryDirectory()
+        app.config['LOG_DIR'] = self.log_dir.name
+        cache.reset()
+        query.reset()
+        self.app = app.test_client()
+
+    def tearDown(self):
+        app.config['PROFILE_SAMPLE_RATE'] = 0.01
+        app.config['PROFILE_THRESHOLD'] = 2
+        app.config['LOG_DIR'] = '.'
+        self.log_dir.cleanup()
+
+    def test_slow_request_profiled(self):
+        # Is a slow search's profile written to LOG_DIR with its query, manifest and hit count?
+        with patch("whiiif.solr.post", return_value=FakeResponse(test="iiif")), self.assertLogs(level='WARNING'):
+            self.app.get('/search/test-manifest?q=myquery')
+        written = sorted(os.listdir(self.log_dir.name))
+        self.assertEqual(len(written), 2)
+        self.assertTrue(written[0].startswith("whiiif-profile-search-") and written[0].endswith(".prof"))
+        with open(os.path.join(self.log_dir.name, written[1])) as summary_file:
+            summary = summary_file.read()
+        self.assertIn("url: /search/test-manifest?q=myquery\n", summary)
+        self.assertIn("manifest: test-manifest\n", summary)
+        self.assertIn("hits: 3\n", summary)
+        self.assertIn("solr_query: http://testserver/solr/whiiiftest/select?", summary)
+        self.assertIn("function calls", summary)
+
+    def test_fast_request_discarded(self):
+        # Are the profiles of requests under the threshold thrown away?
+        app.config['PROFILE_THRESHOLD'] = 60
+        with patch("whiiif.solr.post", return_value=FakeResponse(test="iiif")):
+            rv = self.app.get('/search/test-manifest?q=myquery')
+        self.assertEqual(rv.status_code, 200)
+        self.assertEqual(os.listdir(self.log_dir.name), [])
+
+    def test_sampling(self):
+        # Are requests outside the sample left unprofiled, and only one request profiled at a time?
+        app.config['PROFILE_SAMPLE_RATE'] = 0
+        with patch("cProfile.Profile") as mock_profile:
+            self.assertEqual(profiling.profiled("test")(lambda: "result")(), "result")
+            app.config['PROFILE_SAMPLE_RATE'] = 1
+            with profiling._lock:
+                profiling.profiled("test")(lambda: "result")()
+            self.assertFalse(mock_profile.called)
+
+
+@unittest.skipIf(aio is None, "aiohttp is not installed")
+class AsyncSearchTestCase(AioHTTPTestCase):
+    """Tests for the asyncio serving mode of the search endpoints"""
+    async def get_application(self):
+        app.config['TESTING'] = True
+        app.config['DEBUG'] = False
+        app.config['SERVER_NAME'] = 'testserver:5000'
+        app.config['SOLR_URL'] = 'http://testserver/solr'
+        app.config['SOLR_CORE'] = 'whiiiftest'
+        app.config['OCR_TEXT_FIELD'] = 'ocr_text'
+        app.config['MANIFEST_URL_FIELD'] = 'manifest_url'
+        app.config['DOCUMENT_ID_FIELD'] = 'id'
+        app.config['SNIPPETS_MAX_RESULTS'] = 3
+        app.config['SNIPPET_CONTEXT'] = 'word'
+        app.config['SNIPPET_CONTEXT_SIZE'] = 5
+        app.config['SNIPPET_CONTEXT_LIMIT'] = 'line'
+        cache.reset()
+        query.reset()
+        return aio.create_app()
+
+    async def test_async_search(self):
+        # Does the async IIIF endpoint query SOLR without blocking, and build the same AnnotationList?
+        async def fetch(url, read):
+            return await read(FakeAsyncResponse(solr_responses.IIIF))
+
+        with patch("whiiif.aio.AsyncSolrClient.fetch") as mock_request:
+            mock_request.side_effect = fetch
+            rv = await self.client.get('/search/test-manifest?q=myquery')
+            json_response = await rv.json()
+            mock_request.assert_called_once_with(query.SolrQuery("http://testserver/solr/whiiiftest/select",
+                                                                 "hl=on&hl.ocr.absoluteHighlights=true"
+                                                                 "&hl.weightMatches=true&hl.ocr.limitBlock=page"
+                                                                 "&hl.ocr.contextSize=1&hl.ocr.contextBlock=word"
+                                                                 "&df=ocr_text&hl.ocr.fl=ocr_text&hl.snippets=4096"
+                                                                 "&fq=id%3Atest-manifest&q=myquery"), ANY)
+            self.assertEqual(rv.headers["Access-Control-Allow-Origin"], "*")
+            self.assertTrue(json_response["@id"].endswith("/search/test-manifest?q=myquery"))
+            self.assertEqual(json_response["within"]["total"], 3)
+            self.assertEqual(len(json_response["resources"]), 4)
+            self.assertEqual(json_response["resources"][2]["on"],
+                             'http://mytestserver/manifests/test-manifest/canvas/page_537#xywh=3133,1319,303,123')
+
+    async def test_async_snippets(self):
+        # Does the async Snippet Search endpoint return the same structure as the Flask one?
+        with patch("whiiif.aio.AsyncSolrClient.get_json") as mock_request:
+            mock_request.return_value = solr_responses.SNIPPET
+            rv = await self.client.get('/snippets/test-manifest?q=myquery')
+            json_response = await rv.json()
+            self.assertEqual(json_response[0]["total_results"], 4)
+            self.assertEqual(json_response[0]["canvases"][1]["highlights"][1]["coords"], "0,140,544,161")
+
+    async def test_async_snippets_batch(self):
+        # Does the async batch Snippet Search endpoint make one SOLR query for all of the documents?
+        with patch("whiiif.aio.AsyncSolrClient.get_json") as mock_request:
+            mock_request.return_value = solr_responses.SNIPPET
+            rv = await self.client.get('/snippets?ids=test-manifest,other-manifest&q=myquery')
+            json_response = await rv.json()
+            self.assertEqual(mock_request.call_count, 1)
+            self.assertEqual(len(json_response), 1)
+            self.assertEqual(json_response[0]["total_results"], 4)
+
+    async def test_async_connection_failure(self):
+        # Does the async endpoint register the error and return gracefully when SOLR doesn't respond?
+        with patch("whiiif.aio.AsyncSolrClient.get_json") as mock_request, \
+                self.assertLogs(level='ERROR') as log_catcher:
+            mock_request.side_effect = ClientConnectionError()
+            rv = await self.client.get('/collection/search?q=myquery')
+            self.assertIn("ERROR:whiiif:Error occurred with SOLR query: "
+                          "<class 'aiohttp.client_exceptions.ClientConnectionError'>", log_catcher.output)
+            self.assertEqual(await rv.json(), [])
+
+    async def test_async_blocking_io(self):
+        # Are the cache and manifest reads of a Collection Search run off the event loop's thread?
+        loop_thread = threading.current_thread()
+        threads = []
+
+        def cache_get(cache_self, key):
+            threads.append(threading.current_thread())
+
+        def collection_results(results_json, docs):
+            threads.append(threading.current_thread())
+            return [], True
+
+        with patch("whiiif.aio.AsyncSolrClient.get_json") as mock_request, \
+                patch("whiiif.cache.MemoryCache.get", autospec=True, side_effect=cache_get), \
+                patch("whiiif.views.collection_results", side_effect=collection_results):
+            mock_request.return_value = solr_responses.COLLECTION
+            rv = await self.client.get('/collection/search?q=myquery')
+            self.assertEqual(await rv.json(), [])
+        self.assertEqual(len(threads), 2)
+        self.assertNotIn(loop_thread, threads)
+
+
+class SerializerTestCase(unittest.TestCase):
+    """Tests for the pluggable JSON serializer"""
+    def tearDown(self):
+        serializer.use("auto")
+
+    def test_backends_identical(self):
+        # Does every installed backend write exactly the same JSON?
+        body = {"@id": "http://testserver:5000/search/test-manifest?q=myquery", "chars": "café ſ",
+                "total": 3, "ignored": [], "scale": 1.5}
+        encoded = set()
+        for name in serializer.backends:
+            serializer.use(name)
+            encoded.add(serializer.dumpb(body))
+            self.assertEqual(serializer.dumps(body).encode("utf8"), serializer.dumpb(body))
+            self.assertEqual(serializer.loads(serializer.dumpb(body)), body)
+        self.assertEqual(len(encoded), 1)
+
+    def test_stdlib_fallback(self):
+        # Do the views still work with only the standard library json module?
+        serializer.use("json")
+        self.assertEqual(serializer.backend, "json")
+        with patch("whiiif.solr.post") as mock_request:
+            mock_request.return_value = FakeResponse(test="snippet")
+            cache.reset()
+            rv = app.test_client().get('/snippets/test-manifest?q=myquery')
+            self.assertEqual(rv.get_json()[0]["total_results"], 4)
+
+    def test_unknown_backend(self):
+        # Is asking for a backend that isn't installed reported?
+        with self.assertRaises(ValueError):
+            serializer.use("nosuchjson")
+
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
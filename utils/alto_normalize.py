@@ -0,0 +1,151 @@
+""" alto_normalize.py: single pass ALTO normalization for solr-ocrhighlighting, recording where each page and block is
+
+The ALTO is parsed once with lxml's iterparse, clearing elements as they are finished, so memory use doesn't grow
+with the file, and written out ASCII-escaped (so that the plugin's byte offsets stay valid) without comments,
+processing instructions or whitespace between elements. Every element and attribute is kept by default, so the
+stored file is still complete ALTO that other tools (and a later reindex) can use. With strip, only what the plugin
+reads is kept: the Layout elements from Page down to String, with their ID, position, size and content attributes.
+
+The byte range of each Page, and of each TextBlock and ComposedBlock, in the output is returned for the page index.
+
+Normalizing costs far more than escaping, as every element is parsed and written out rather than the text copied:
+around 0.2s per MB of ALTO, stripped or not, about 20x the time of escape_stream (see tests/benchmarks/bench_escape.py).
+"""
+
+from lxml import etree
+
+KEPT_ELEMENTS = frozenset(["Layout", "Page", "PrintSpace", "TopMargin", "LeftMargin", "RightMargin", "BottomMargin",
+                           "ComposedBlock", "TextBlock", "TextLine", "String", "SP", "HYP"])
+EMPTY_ELEMENTS = frozenset(["String", "SP", "HYP"])  # self-closing when stripping, as their children are all dropped
+KEPT_ATTRIBUTES = frozenset(["ID", "HPOS", "VPOS", "WIDTH", "HEIGHT", "CONTENT", "SUBS_TYPE", "SUBS_CONTENT",
+                             "PHYSICAL_IMG_NR"])
+BLOCK_ELEMENTS = frozenset(["TextBlock", "ComposedBlock"])
+TEXT_ESCAPES = str.maketrans({"&": "&amp;", "<": "&lt;", ">": "&gt;", "\r": "&#13;"})
+ATTRIBUTE_ESCAPES = str.maketrans({"&": "&amp;", "<": "&lt;", ">": "&gt;", '"': "&quot;", "\n": "&#10;", "\r": "&#13;",
+                                   "\t": "&#9;"})
+
+
+def local_name(tag):
+    return tag.rpartition("}")[2]
+
+
+def ascii_bytes(text):
+    return text.encode("ascii", "xmlcharrefreplace")
+
+
+def text_bytes(text):
+    """Escape element text or tail for the output, dropping it if it's only whitespace between elements"""
+    if not text or text.isspace():
+        return b""
+    return ascii_bytes(text.translate(TEXT_ESCAPES))
+
+
+def qualified_name(name, nsmap, attribute=False):
+    """Return a {namespace}name tag or attribute name in prefix:name form, using the element's namespace prefixes"""
+    if name[0] != "{":
+        return name
+    namespace, _, local = name[1:].partition("}")
+    if namespace == "http://www.w3.org/XML/1998/namespace":
+        return "xml:" + local
+    for prefix, uri in nsmap.items():
+        if uri == namespace and not (attribute and prefix is None):  # attributes have no default namespace
+            return local if prefix is None else "{}:{}".format(prefix, local)
+    raise ValueError("No namespace prefix for {}".format(name))
+
+
+def start_tag(elem, parent_nsmap):
+    """Return the start tag for an element, with every attribute and the namespaces it declares, but without its
+    closing > (or />, if it turns out to be empty)"""
+    nsmap = elem.nsmap
+    namespaces = "".join(' xmlns{}="{}"'.format("" if prefix is None else ":" + prefix,
+                                                uri.translate(ATTRIBUTE_ESCAPES))
+                         for prefix, uri in nsmap.items() if parent_nsmap.get(prefix) != uri)
+    attributes = "".join(' {}="{}"'.format(key if key[0] != "{" else qualified_name(key, nsmap, True),
+                                           value.translate(ATTRIBUTE_ESCAPES)) for key, value in elem.items())
+    return ascii_bytes("<" + qualified_name(elem.tag, nsmap) + namespaces + attributes)
+
+
+def stripped_start_tag(name, elem):
+    attributes = "".join(' %s="%s"' % (key, value.translate(ATTRIBUTE_ESCAPES))
+                         for key, value in elem.items() if key in KEPT_ATTRIBUTES)
+    return ascii_bytes("<{}{}{}>".format(name, attributes, "/" if name in EMPTY_ELEMENTS else ""))
+
+
+def end_tag(out_file, elem, unclosed):
+    """Write the end of an element: its text (or its last child's tail) and end tag, or close its start tag if it
+    turned out to be empty"""
+    text = text_bytes(elem.text if len(elem) == 0 else elem[-1].tail)
+    if unclosed and not text:
+        out_file.write(unclosed + b"/>")
+        return
+    out_file.write(unclosed + b">" if unclosed else b"")
+    out_file.write(text)
+    out_file.write(ascii_bytes("</{}>".format(qualified_name(elem.tag, elem.nsmap))))
+
+
+def normalize_alto(alto_path, out_file, strip=False):
+    """Write a normalized copy of an ALTO file to a binary file object.
+
+    Returns two lists, in document order: the (page ID, start, end) byte ranges of each Page element in the output,
+    and the (block ID, page position, start, end) of each TextBlock and ComposedBlock. Raises lxml.etree.XMLSyntaxError
+    if the ALTO isn't well-formed, and OSError if it can't be read.
+    """
+    pages = []
+    blocks = []
+    starts = []  # output offsets of the open Page and block elements
+    skipping = 0  # depth inside an element that is being dropped
+    unclosed = b""  # start tag of the last element started, until it's known whether it's empty
+    out_file.write(b'<?xml version="1.0" encoding="ASCII"?>\n')
+    for event, elem in etree.iterparse(alto_path, events=("start", "end"), remove_comments=True, remove_pis=True,
+                                       huge_tree=True):
+        parent = elem.getparent()
+        if event == "start":
+            if parent is None:
+                if strip:
+                    namespace = etree.QName(elem).namespace
+                    out_file.write(ascii_bytes('<alto{}>'.format(' xmlns="{}"'.format(namespace) if namespace else "")))
+                else:
+                    unclosed = start_tag(elem, {})
+                continue
+            name = local_name(elem.tag)
+            if strip:
+                if skipping or name not in KEPT_ELEMENTS:
+                    skipping += 1
+                    continue
+            else:
+                # once an element has started, its parent's text (or its previous sibling's tail) is complete
+                previous = elem.getprevious()
+                out_file.write(unclosed + b">" if unclosed else b"")
+                out_file.write(text_bytes(parent.text if previous is None else previous.tail))
+            if name == "Page" or name in BLOCK_ELEMENTS:
+                starts.append(out_file.tell())
+            if strip:
+                out_file.write(stripped_start_tag(name, elem))
+            else:
+                unclosed = start_tag(elem, parent.nsmap)
+            continue
+
+        if parent is None:
+            if strip:
+                out_file.write(b"</alto>\n")
+            else:
+                end_tag(out_file, elem, unclosed)
+                out_file.write(b"\n")
+            continue
+        if skipping:
+            skipping -= 1
+        else:
+            name = local_name(elem.tag)
+            if not strip:
+                end_tag(out_file, elem, unclosed)
+                unclosed = b""
+            elif name not in EMPTY_ELEMENTS:
+                out_file.write(ascii_bytes("</{}>".format(name)))
+            if name == "Page":
+                pages.append((elem.get("ID", ""), starts.pop(), out_file.tell()))
+            elif name in BLOCK_ELEMENTS:
+                blocks.append((elem.get("ID", ""), len(pages), starts.pop(), out_file.tell()))
+        elem.clear(keep_tail=True)  # its tail is written when the next sibling starts, or the parent ends
+        while elem.getprevious() is not None:
+            del parent[0]
+    return pages, blocks
@@ -2,7 +2,7 @@
 
 """ iiif_order.py: tools for ordering the json structure of IIIF objects """
 
-from collections import OrderedDict
+import json
 
 start_keys = ["@context", "@id", "@type"]
 descriptive_keys = ["label", "metadata", "description", "thumbnail", "attribution", "license", "logo"]
@@ -53,23 +53,86 @@ recursive_keys = {"collection": [("collections", "collection"),
                   "resource": [("service", "service")]
                   }
 
+# rank of each key in its object type's canonical order; keys that aren't listed sort after all of them
+key_ranks = {object_type: {key: rank for rank, key in enumerate(keys)} for object_type, keys in object_keys.items()}
+
+
+def ordered_keys(object, object_type):
+    """Return an object's keys in canonical order, with unlisted keys last in their original order"""
+    ranks = key_ranks[object_type]
+    try:
+        return sorted(object, key=ranks.__getitem__)
+    except KeyError:
+        unlisted = len(ranks)
+        return sorted(object, key=lambda key: ranks.get(key, unlisted))
+
+
+def ordered_copy(object, object_type):
+    """Return a dict of an object's items in canonical order"""
+    keys = ordered_keys(object, object_type)
+    return dict(zip(keys, map(object.__getitem__, keys)))
+
+
+def in_order(object, object_type):
+    """Return an object with its keys in canonical order: the object itself if they already are, or an ordered copy"""
+    keys = ordered_keys(object, object_type)
+    if keys == list(object):
+        return object
+    return dict(zip(keys, map(object.__getitem__, keys)))
+
+
 def order_object(object, object_type, recursive = False):
-    ordered = OrderedDict()
-    for key in object_keys[object_type]:
-        if key in object:
-            ordered[key] = object[key]
-
-    # copy over any other keys that might exist
-    for key in set(object.keys()) - set(object_keys[object_type]):
-        ordered[key] = object[key]
-
-    if recursive and object_type in recursive_keys:
-        for key, subtype in recursive_keys[object_type]:
-            if key in ordered:
-                if type(ordered[key]) == list:
-                    for idx, val in enumerate(ordered[key]):
-                        ordered[key][idx] = order_object(ordered[key][idx], subtype, recursive=True)
-                elif type(ordered[key]) == dict or type(ordered[key]) == OrderedDict:
-                    ordered[key] = order_object(ordered[key], subtype, recursive=True)
-
-    return ordered
\ No newline at end of file
+    """Return an IIIF object with its keys in canonical order (and its children's, if recursive).
+
+    The tree is walked iteratively. Objects whose keys are already in order are kept rather than copied, and children
+    are replaced in place, so the original object shouldn't be used afterwards.
+    """
+    ordered = in_order(object, object_type)
+    if not recursive:
+        return ordered
+
+    stack = [(ordered, object_type)]
+    while stack:
+        parent, parent_type = stack.pop()
+        for key, subtype in recursive_keys.get(parent_type, ()):
+            value = parent.get(key)
+            if isinstance(value, list):
+                for idx, child in enumerate(value):
+                    if isinstance(child, dict):
+                        value[idx] = in_order(child, subtype)
+                        stack.append((value[idx], subtype))
+            elif isinstance(value, dict):
+                parent[key] = in_order(value, subtype)
+                stack.append((parent[key], subtype))
+    return ordered
+
+
+class _Unordered(object):
+    """An IIIF object waiting to be ordered, as it's reached by the JSON encoder"""
+    __slots__ = ("object", "object_type")
+
+    def __init__(self, object, object_type):
+        self.object = object
+        self.object_type = object_type
+
+
+def _order_on_encode(value):
+    if not isinstance(value, _Unordered):
+        raise TypeError("Object of type {} is not JSON serializable".format(type(value).__name__))
+    ordered = ordered_copy(value.object, value.object_type)
+    for key, subtype in recursive_keys.get(value.object_type, ()):
+        child = ordered.get(key)
+        if isinstance(child, list):
+            ordered[key] = [_Unordered(item, subtype) if isinstance(item, dict) else item for item in child]
+        elif isinstance(child, dict):
+            ordered[key] = _Unordered(child, subtype)
+    return ordered
+
+
+def dump_ordered(object, object_type, fp, **kwargs):
+    """json.dump an IIIF object with its keys (and its children's) in canonical order.
+
+    Each object is ordered as the encoder reaches it, and dropped once written, so no ordered copy of the whole tree
+    is built. The output is the same as json.dump(order_object(object, object_type, recursive=True), fp, **kwargs).
+    """
+    json.dump(_Unordered(object, object_type), fp, default=_order_on_encode, **kwargs)
@@ -4,95 +4,478 @@
 
 import argparse
 import json
+import os
+import stat
+import tempfile
+import time
 from collections import OrderedDict
-from os import path
+from functools import partial
+from multiprocessing import Pool
+from os import makedirs, path
 
-import requests
+from alto_normalize import normalize_alto
 from iiif_order import order_object
+from ingest_ledger import IngestLedger, file_hash
+from lxml import etree
+from update_scheduler import UpdateScheduler
 
 from whiiif import app
+from whiiif.cache import invalidate_document
+from whiiif.manifests import canvas_index_path, manifest_canvas_images, replacing_file, write_canvas_index
+from whiiif.pages import ocr_path, page_index_path, write_page_index
 
 __version__ = '0.3.0'
 DEBUG = True
+ESCAPE_CHUNK_SIZE = 1024 * 1024  # characters of ALTO read, escaped and written at a time
+ENCODING_DECLARATION = ("encoding=\"UTF-8\"", "encoding=\"ASCII\"")
 
 def dprint(*args):
     if DEBUG:
         print(*args)
 
 
-def pipeline(alto, manifest, identifier, modify):
+def pipeline(alto, manifest, identifier, modify, ledger=None, force=False, commit_within=0, strip=False):
     dprint("Starting pipeline...")
+    if not identifier:
+        identifier = path.splitext(path.basename(alto))[0]
+        dprint("No identifier supplied, using", identifier)
+
+    hashes = content_hashes(ledger, alto, manifest)
+    if not force and already_indexed(ledger, identifier, hashes, manifest, modify):
+        print("{} is unchanged since it was last indexed, skipping (use --force to reindex)".format(identifier))
+        return True
+
+    solr_doc, manifest_json = prepare(alto, manifest, identifier, strip)
+    if solr_doc is False:
+        return False
+
+    dprint("Posting to SOLR")
+    dprint("Document:", json.dumps(solr_doc, indent=4))
+
+    committed = []
+    with UpdateScheduler(batch_size=1, commit_within=commit_within, on_commit=committed.extend,
+                         soft_commit=True) as scheduler:
+        scheduler.add(identifier, solr_doc)
+    if not committed:
+        return False
+    dprint("Successfully added to SOLR")
+
+    dprint("Invalidating cached search responses for", identifier)
+    try:
+        invalidate_document(identifier)
+    except OSError as e:
+        print("ERROR invalidating cache:", e)
+
+    if modify and not add_search_service(manifest, manifest_json, identifier):
+        return False
+
+    record_indexed(ledger, identifier, hashes, manifest)
+    return True
+
+
+def content_hashes(ledger, alto, manifest):
+    """Hash an ALTO / manifest pair for the ledger, or return None if there's no ledger or the files can't be read"""
+    if ledger is None:
+        return None
+    try:
+        return ledger.hashes(alto, manifest)
+    except OSError:
+        return None
+
+
+def already_indexed(ledger, identifier, hashes, manifest, modify):
+    """Does the ledger show this content was indexed, and (with modify) is the search service in the manifest?
+
+    The ledger doesn't record whether the manifest was modified, so a pair indexed without modify isn't skipped when
+    it's indexed again with it.
+    """
+    if hashes is None or not ledger.unchanged(identifier, *hashes):
+        return False
+    if not modify:
+        return True
+    manifest_json = load_manifest(manifest)
+    return manifest_json is not False and has_service(manifest_json, search_service(identifier))
+
+
+def record_indexed(ledger, identifier, hashes, manifest):
+    """Record the indexed content in the ledger, rehashing the manifest as adding the search service changes it"""
+    if ledger is None or hashes is None:
+        return
+    try:
+        ledger.record(identifier, hashes[0], file_hash(manifest))
+    except OSError as e:
+        print("ERROR updating ingest ledger:", e)
+
+
+def escape_alto(alto, identifier):
+    """Write an ASCII-escaped copy of an ALTO file for SOLR to index, returning its path (or False on error)"""
     dprint("Loading ALTO file:", alto)
     try:
-        with open(alto, "r", encoding="utf8") as alto_file:
-            alto_in = alto_file.read()
+        alto_file = open(alto, "r", encoding="utf8")
     except FileNotFoundError:
         print("ERROR: File {} not found".format(alto))
         return False
 
-    if not identifier:
-        identifier = path.splitext(path.basename(alto))[0]
-        dprint("No identifier supplied, using", identifier)
-
-    dprint("Escaping non-ASCII characters in ALTO")
-    alto_out = alto_in.replace("encoding=\"UTF-8\"", "encoding=\"ASCII\"").encode('ascii', 'xmlcharrefreplace')
-    out_path = path.join(app.config["XML_LOCATION"], identifier) + "_escaped.xml"
-    dprint("Writing escaped file to:", out_path)
+    out_path = ocr_path(identifier)
+    dprint("Escaping non-ASCII characters in ALTO, writing escaped file to:", out_path)
     try:
-        with open(out_path, 'wb') as out_file:
-            out_file.write(alto_out)
+        with alto_file, replacing_file(out_path) as out_file:
+            escape_stream(alto_file, out_file)
     except Exception as e:
         print("ERROR:", e)
         return False
+    return out_path
+
+
+def normalize_ocr(alto, identifier, strip=False):
+    """Write a normalized copy of an ALTO file for SOLR to index, and its page index, returning its path (or False).
+
+    With strip, only what the OCR highlighting plugin reads of the ALTO is kept. ALTO that lxml can't parse is indexed
+    as a plain escaped copy instead, without a page index.
+    """
+    dprint("Normalizing ALTO file:", alto)
+    out_path = ocr_path(identifier)
+    try:
+        with replacing_file(out_path) as out_file:
+            page_ranges, block_ranges = normalize_alto(alto, out_file, strip)
+    except (OSError, etree.XMLSyntaxError) as e:
+        if not path.isfile(alto):
+            print("ERROR: File {} not found".format(alto))
+            return False
+        print("WARNING: Can't normalize {} ({}), indexing an escaped copy instead".format(alto, e))
+        try:
+            os.remove(page_index_path(identifier))
+        except OSError:
+            pass
+        return escape_alto(alto, identifier)
+
+    dprint("Writing page index for {} pages and {} blocks to:".format(len(page_ranges), len(block_ranges)),
+           page_index_path(identifier))
+    try:
+        write_page_index(page_index_path(identifier), page_ranges, block_ranges)
+    except OSError as e:
+        print("ERROR writing page index:", e)
+    return out_path
+
+
+def escape_stream(alto_file, out_file, chunk_size=ESCAPE_CHUNK_SIZE):
+    """Copy a text mode ALTO file to a binary one, ASCII-escaped, a chunk at a time so memory use stays bounded.
+
+    The text mode file decodes UTF-8 incrementally, so characters split across chunk boundaries arrive whole. The last
+    few characters of each chunk are held back, so that an encoding declaration split across a boundary is still
+    replaced.
+    """
+    declaration, ascii_declaration = ENCODING_DECLARATION
+    hold = len(declaration) - 1
+    carry = ""
+    while True:
+        chunk = alto_file.read(chunk_size)
+        if not chunk:
+            break
+        text = (carry + chunk).replace(declaration, ascii_declaration)
+        carry = text[-hold:]
+        out_file.write(text[:-hold].encode('ascii', 'xmlcharrefreplace'))
+    out_file.write(carry.encode('ascii', 'xmlcharrefreplace'))
+
+
+def prepare(alto, manifest, identifier, strip=False):
+    """Normalize the ALTO and write the canvas index for an ALTO / manifest pair, and build its SOLR document.
+
+    Returns the SOLR document and the loaded manifest, or (False, None) on error.
+    """
+    out_path = normalize_ocr(alto, identifier, strip)
+    if out_path is False:
+        return False, None
 
     dprint("Loading manifest:", manifest)
     manifest_json = load_manifest(manifest)
     if manifest_json is False:
-        return False
+        return False, None
+
+    index_path = canvas_index_path(identifier)
+    dprint("Writing canvas index to:", index_path)
+    try:
+        makedirs(app.config["CANVAS_INDEX_LOCATION"], exist_ok=True)
+        write_canvas_index(index_path, manifest_canvas_images(manifest_json))
+    except (OSError, KeyError, IndexError, TypeError) as e:
+        print("ERROR writing canvas index:", e)
+        return False, None
 
     solr_doc = {app.config["DOCUMENT_ID_FIELD"]: identifier,
                 app.config["MANIFEST_URL_FIELD"]: manifest_json["@id"],
                 app.config["OCR_TEXT_FIELD"]: out_path }
+    return solr_doc, manifest_json
 
-    solr_url = "{}/{}/update/json/docs".format(app.config["SOLR_URL"], app.config["SOLR_CORE"])
 
-    dprint("Posting to SOLR:", solr_url)
-    dprint("Document:", json.dumps(solr_doc, indent=4))
+def add_search_service(manifest, manifest_json, identifier):
+    """Add the search service to a manifest file unless it is already there, returning False if it can't be written"""
+    dprint("Adding IIIF service to manifest file")
+    app.app_context().push()
+    if not set_service(manifest_json, search_service(identifier)):
+        dprint("Search service already in manifest, leaving it unchanged")
+        return True
 
-    r = requests.post(solr_url, json=solr_doc, params=dict(softCommit="true"))
-    if r.status_code == requests.codes.ok:
-        dprint("Successfully added to SOLR")
-    else:
-        print("ERROR posting to solr: ", r.content)
+    ordered_manifest = order_object(manifest_json, "manifest", recursive=True)
+    try:
+        write_manifest(manifest, ordered_manifest)
+        dprint("Added!")
+    except Exception as e:
+        print("ERROR writing manifest {}: {}".format(manifest, e))
         return False
+    return True
 
-    if modify:
-        dprint("Adding IIIF service to manifest file")
-        app.app_context().push()
-        search_url = "{}/search/{}".format(app.config["SERVER_NAME"], identifier)
-        service_doc = {"@context": "http://iiif.io/api/search/1/context.json",
-                       "@id": search_url,
-                       "profile": "http://iiif.io/api/search/1/search"
-                       }
-        if "service" in manifest_json:
-            if type(manifest_json["service"]) == list:
-                manifest_json["service"].append(service_doc)
-            elif type(manifest_json["service"]) == dict or type(manifest_json["service"]) == OrderedDict:
-                manifest_json["service"] = [manifest_json["service"], service_doc]
-            else:
-                manifest_json["service"] = [manifest_json["service"], service_doc]
-        else:
-            manifest_json["service"] = service_doc
 
-        ordered_manifest = order_object(manifest_json, "manifest", recursive=True)
+def search_service(identifier):
+    search_url = "{}/search/{}".format(app.config["SERVER_NAME"], identifier)
+    return {"@context": "http://iiif.io/api/search/1/context.json",
+            "@id": search_url,
+            "profile": "http://iiif.io/api/search/1/search"
+            }
+
+
+def has_service(manifest_json, service_doc):
+    services = manifest_json.get("service")
+    return service_doc in (services if isinstance(services, list) else [services])
+
+
+def set_service(manifest_json, service_doc):
+    """Add a service to a manifest, or replace one with the same @id, returning whether the manifest changed"""
+    services = manifest_json.get("service")
+    if isinstance(services, list):
+        entries = services
+    elif services is None:
+        entries = []
+    else:
+        entries = [services]
+
+    for idx, service in enumerate(entries):
+        if isinstance(service, dict) and service.get("@id") == service_doc["@id"]:
+            if service == service_doc:
+                return False
+            entries[idx] = service_doc
+            break
+    else:
+        entries.append(service_doc)
+    manifest_json["service"] = entries if isinstance(services, list) or len(entries) > 1 else entries[0]
+    return True
+
+
+def write_manifest(manifest, manifest_json):
+    """Replace a manifest file atomically, so that readers see either the old or the new manifest, never part of one"""
+    directory, name = path.split(path.abspath(manifest))
+    fd, tmp_path = tempfile.mkstemp(prefix="." + name + ".", suffix=".tmp", dir=directory)
+    try:
+        with os.fdopen(fd, 'w', encoding="UTF8") as manifest_file:
+            json.dump(manifest_json, manifest_file, indent=2)
+            manifest_file.flush()
+            os.fsync(manifest_file.fileno())
+        try:
+            os.chmod(tmp_path, stat.S_IMODE(os.stat(manifest).st_mode))
+        except FileNotFoundError:
+            os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, manifest)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+def find_pairs(source, manifest_dir=None):
+    """Yield (alto, manifest, identifier) for each ALTO / manifest pair in a bulk import source.
+
+    The source is either a directory of ALTO files named <identifier>.xml, with manifests named <identifier>.json
+    alongside them (or in manifest_dir), or a list file with one "ALTO MANIFEST [IDENTIFIER]" line per pair.
+    """
+    if path.isdir(source):
+        for name in sorted(os.listdir(source)):
+            identifier, ext = path.splitext(name)
+            if ext.lower() != ".xml" or identifier.endswith("_escaped"):
+                continue
+            yield (path.join(source, name), path.join(manifest_dir or source, identifier + ".json"), identifier)
+        return
+
+    with open(source, "r", encoding="utf8") as list_file:
+        for line_number, line in enumerate(list_file, 1):
+            fields = line.split()
+            if not fields or fields[0].startswith("#"):
+                continue
+            if len(fields) not in (2, 3):
+                print("ERROR: {} line {} should be ALTO MANIFEST [IDENTIFIER]".format(source, line_number))
+                continue
+            if len(fields) == 2:
+                fields.append(path.splitext(path.basename(fields[0]))[0])
+            yield tuple(fields)
+
+
+def prepare_job(job, ledger=None, force=False, modify=False, strip=False):
+    """Pool worker: prepare one pair.
+
+    Returns the job, its SOLR document (False on error, None if the ledger shows it's unchanged), its content hashes
+    and the ALTO size in bytes.
+    """
+    alto, manifest, identifier = job
+    hashes = content_hashes(ledger, alto, manifest)
+    if not force and already_indexed(ledger, identifier, hashes, manifest, modify):
+        return job, None, hashes, 0
+    try:
+        solr_doc, _ = prepare(alto, manifest, identifier, strip)
+    except Exception as e:  # one bad pair mustn't take down the worker
+        print("ERROR preparing {}: {}".format(identifier, e))
+        solr_doc = False
+    try:
+        alto_size = path.getsize(alto)
+    except OSError:
+        alto_size = 0
+    return job, solr_doc, hashes, alto_size
+
+
+def set_debug(debug):
+    """Pool initializer: pass on the debug setting, which spawned workers don't inherit from this process"""
+    global DEBUG
+    DEBUG = debug
+
+
+def modify_job(item, ledger=None):
+    """Pool worker: add the search service to a committed document's manifest and, if that worked, record it in the
+    ledger.
+
+    Returns the document's identifier and whether its manifest has the service.
+    """
+    (alto, manifest, identifier), hashes = item
+    modified = False
+    try:
+        manifest_json = load_manifest(manifest)
+        modified = manifest_json is not False and add_search_service(manifest, manifest_json, identifier)
+    except Exception as e:  # one bad manifest mustn't take down the worker
+        print("ERROR modifying manifest for {}: {}".format(identifier, e))
+    if modified:
+        record_indexed(ledger, identifier, hashes, manifest)
+    return identifier, modified
+
+
+class Checkpoint(object):
+    """Append-only record of the identifiers committed to SOLR by a bulk import, so that it can be resumed"""
+
+    def __init__(self, checkpoint_path):
+        self.path = checkpoint_path
+        self.done = set()
+        if path.exists(checkpoint_path):
+            with open(checkpoint_path, "r", encoding="utf8") as checkpoint_file:
+                self.done = set(line.strip() for line in checkpoint_file if line.strip())
+
+    def __contains__(self, identifier):
+        return identifier in self.done
+
+    def add(self, identifiers):
+        with open(self.path, "a", encoding="utf8") as checkpoint_file:
+            for identifier in identifiers:
+                checkpoint_file.write(identifier + "\n")
+            checkpoint_file.flush()
+            os.fsync(checkpoint_file.fileno())
+        self.done.update(identifiers)
+
+    def clear(self):
         try:
-            json.dump(ordered_manifest,open(manifest, 'w', encoding="UTF8"), indent=2)
-            dprint("Added!")
-        except Exception as e:
-            dprint("ERROR:", e)
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+        self.done = set()
 
+
+class Throughput(object):
+    def __init__(self):
+        self.start = time.monotonic()
+        self.documents = 0
+        self.failed = 0
+        self.skipped = 0
+        self.bytes = 0
+
+    def report(self, final=False):
+        elapsed = max(time.monotonic() - self.start, 1e-9)
+        print("{}{} documents indexed, {} failed, {} skipped in {:.1f}s: {:.1f} docs/s, {:.2f} MB/s of ALTO".format(
+            "Finished: " if final else "", self.documents, self.failed, self.skipped, elapsed,
+            self.documents / elapsed, self.bytes / elapsed / 1024 / 1024))
+
+
+def bulk(source, manifest_dir=None, modify=False, workers=None, batch_size=500, commit_interval=0,
+         checkpoint_path=None, ledger=None, force=False, commit_docs=0, commit_within=0, strip=False):
+    """Import every ALTO / manifest pair in a directory or list file.
+
+    ALTO escaping and canvas indexes are done across a process pool, documents are posted to SOLR in batches and
+    committed as the UpdateScheduler decides: every commit_docs documents or commit_interval seconds, by SOLR within
+    commit_within ms (counted as committed, and their cached responses invalidated, once that has passed), and at the
+    end. Each commit is recorded in the checkpoint file, and pairs already in it are skipped, so an interrupted or
+    failed import can be resumed by running it again; the checkpoint is removed once an import finishes with no
+    failures, so the next one starts afresh. Pairs whose content the ledger shows is unchanged since they were last
+    indexed are skipped too. With modify, committed documents' manifests are rewritten across the pool as well, and
+    they are only checkpointed and recorded in the ledger once that has worked.
+    """
+    if checkpoint_path is None:
+        checkpoint_path = path.join(app.config["XML_LOCATION"], "bulk_index.checkpoint")
+    checkpoint = Checkpoint(checkpoint_path)
+    throughput = Throughput()
+    makedirs(app.config["XML_LOCATION"], exist_ok=True)
+
+    jobs = []
+    for job in find_pairs(source, manifest_dir):
+        if job[2] in checkpoint:
+            throughput.skipped += 1
+        else:
+            jobs.append(job)
+    print("Importing {} documents ({} already done according to {})".format(len(jobs), throughput.skipped,
+                                                                            checkpoint_path))
+
+    modifications = []
+
+    def committed(items):
+        for (alto, manifest, identifier), hashes in items:
+            try:
+                invalidate_document(identifier)
+            except OSError as e:
+                print("ERROR invalidating cache:", e)
+        if modify:
+            modifications.append(pool.map_async(partial(modify_job, ledger=ledger), items, callback=modified))
+        else:
+            checkpoint.add([job[2] for job, hashes in items])
+            for (alto, manifest, identifier), hashes in items:
+                record_indexed(ledger, identifier, hashes, manifest)
+        throughput.report()
+
+    def modified(results):
+        checkpoint.add([identifier for identifier, ok in results if ok])
+        failed([identifier for identifier, ok in results if not ok])
+
+    def failed(items):
+        throughput.failed += len(items)
+        throughput.documents -= len(items)
+
+    scheduler = UpdateScheduler(batch_size, commit_docs, commit_interval, commit_within, committed, failed)
+    with Pool(workers, initializer=set_debug, initargs=(DEBUG,)) as pool:
+        with scheduler:  # entered after the pool starts, so workers don't inherit its signal handlers
+            for job, solr_doc, hashes, alto_size in pool.imap_unordered(
+                    partial(prepare_job, ledger=ledger, force=force, modify=modify, strip=strip), jobs, chunksize=4):
+                if solr_doc is None:
+                    throughput.skipped += 1
+                    continue
+                if solr_doc is False:
+                    throughput.failed += 1
+                    continue
+                throughput.documents += 1
+                throughput.bytes += alto_size
+                scheduler.add((job, hashes), solr_doc)
+        if modifications:
+            print("Waiting for manifests to be modified")
+        for modification in modifications:
+            modification.wait()
+    throughput.report(final=True)
+    if throughput.failed:
+        return False
+    checkpoint.clear()
     return True
 
+
 def load_manifest(manifest):
     try:
         manifest_json = json.load(open(manifest, 'r', encoding="UTF8"), object_pairs_hook=OrderedDict)
@@ -105,9 +488,9 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(
         description="Import an ALTO XML / IIIF manifest pair to Solr, using the solr-ocrhighlighting plugin",
         add_help=True)
-    parser.add_argument('ALTO',
+    parser.add_argument('ALTO', nargs='?',
                         help='path to ALTO XML file')
-    parser.add_argument('MANIFEST',
+    parser.add_argument('MANIFEST', nargs='?',
                         help='path to IIIF manifest file')
     parser.add_argument('-i',
                         metavar='<ID>',
@@ -116,6 +499,50 @@ if __name__ == "__main__":
                         help='modify the IIIF manifest to include the search service (this will overwrite \
                         the existing file)',
                         action='store_true')
+    parser.add_argument('-b', '--bulk',
+                        metavar='<SOURCE>',
+                        help='bulk import every pair in a directory of <ID>.xml ALTO and <ID>.json manifest files, \
+                        or in a list file of "ALTO MANIFEST [ID]" lines, instead of a single ALTO / MANIFEST pair')
+    parser.add_argument('--manifest-dir',
+                        metavar='<DIR>',
+                        help='bulk: directory containing the manifests, if not alongside the ALTO files')
+    parser.add_argument('--workers',
+                        type=int,
+                        help='bulk: number of worker processes preparing documents (default: one per CPU)')
+    parser.add_argument('--batch-size',
+                        type=int,
+                        default=500,
+                        help='bulk: documents per SOLR update request (default: 500)')
+    parser.add_argument('--commit-docs',
+                        type=int,
+                        default=0,
+                        help='bulk: also commit every n documents, rather than only at the end (default: 0)')
+    parser.add_argument('--commit-interval',
+                        type=float,
+                        default=0,
+                        help='bulk: also commit every n seconds, rather than only at the end (default: 0)')
+    parser.add_argument('--commit-within',
+                        type=int,
+                        default=0,
+                        metavar='<MS>',
+                        help='leave commits to SOLR, asking it to commit each update within this many milliseconds, \
+                        and invalidate cached responses once they have passed (default: 0, soft commit each single \
+                        import, commit bulk imports explicitly)')
+    parser.add_argument('--checkpoint',
+                        metavar='<FILE>',
+                        help='bulk: file recording committed documents, to resume from \
+                        (default: bulk_index.checkpoint in XML_LOCATION)')
+    parser.add_argument('--ledger',
+                        metavar='<FILE>',
+                        help='database of the content indexed for each document, used to skip unchanged pairs \
+                        (default: ingest_ledger.sqlite3 in XML_LOCATION)')
+    parser.add_argument('-f', '--force',
+                        action='store_true',
+                        help='reindex documents even if the ledger shows they are unchanged')
+    parser.add_argument('--strip-alto',
+                        action='store_true',
+                        help='keep only the layout elements and attributes the OCR highlighting plugin reads in the \
+                        stored ALTO, rather than a complete copy (use --force to apply it to unchanged documents)')
     parser.add_argument('-v', '--version',
                         action='version',
                         version=__version__,
@@ -126,9 +553,16 @@ if __name__ == "__main__":
 
     args = parser.parse_args()
     DEBUG = args.debug
+    ledger = IngestLedger(args.ledger or path.join(app.config["XML_LOCATION"], "ingest_ledger.sqlite3"))
 
-    process = pipeline(args.ALTO, args.MANIFEST, args.i, args.modify)
+    if args.bulk:
+        process = bulk(args.bulk, args.manifest_dir, args.modify, args.workers, args.batch_size,
+                       args.commit_interval, args.checkpoint, ledger, args.force, args.commit_docs, args.commit_within,
+                       args.strip_alto)
+    elif args.ALTO and args.MANIFEST:
+        process = pipeline(args.ALTO, args.MANIFEST, args.i, args.modify, ledger, args.force, args.commit_within,
+                           args.strip_alto)
+    else:
+        parser.error("ALTO and MANIFEST are required unless --bulk is used")
     if process:
         print("Completed successfully")
-
-
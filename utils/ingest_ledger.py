@@ -0,0 +1,57 @@
+""" ingest_ledger.py: persistent record of what was indexed for each document, so unchanged pairs can be skipped """
+
+import hashlib
+import os
+import sqlite3
+import time
+
+
+def file_hash(file_path, chunk_size=1024 * 1024):
+    """Return the SHA-256 of a file's contents, read in chunks"""
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as hashed_file:
+        for chunk in iter(lambda: hashed_file.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class IngestLedger(object):
+    """The content hashes of the ALTO and manifest last indexed for each identifier, stored in an SQLite database.
+
+    Connections are opened per process, so a ledger can be handed to pool workers.
+    """
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self._connection = None
+        self._pid = None
+
+    def __getstate__(self):
+        return {"db_path": self.db_path, "_connection": None, "_pid": None}
+
+    def connection(self):
+        if self._pid != os.getpid():
+            os.makedirs(os.path.dirname(os.path.abspath(self.db_path)), exist_ok=True)
+            self._connection = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute("CREATE TABLE IF NOT EXISTS documents (identifier TEXT PRIMARY KEY, "
+                                     "alto_hash TEXT, manifest_hash TEXT, indexed REAL)")
+            self._pid = os.getpid()
+        return self._connection
+
+    @staticmethod
+    def hashes(alto, manifest):
+        return file_hash(alto), file_hash(manifest)
+
+    def unchanged(self, identifier, alto_hash, manifest_hash):
+        """Is this exactly the ALTO and manifest content last indexed for the identifier?"""
+        row = self.connection().execute("SELECT alto_hash, manifest_hash FROM documents WHERE identifier = ?",
+                                        (identifier,)).fetchone()
+        return row is not None and tuple(row) == (alto_hash, manifest_hash)
+
+    def record(self, identifier, alto_hash, manifest_hash):
+        self.connection().execute("INSERT OR REPLACE INTO documents VALUES (?, ?, ?, ?)",
+                                  (identifier, alto_hash, manifest_hash, time.time()))
+
+    def forget(self, identifier):
+        self.connection().execute("DELETE FROM documents WHERE identifier = ?", (identifier,))
@@ -0,0 +1,146 @@
+""" update_scheduler.py: batched SOLR updates and commit scheduling for the indexing tool """
+
+import signal
+import time
+
+import requests
+
+from whiiif import app, solr
+
+
+def update_url(handler=""):
+    return "{}/{}/update{}".format(app.config["SOLR_URL"], app.config["SOLR_CORE"], handler)
+
+
+def post_documents(solr_docs, params=None):
+    """Post a batch of documents to SOLR in a single /update/json/docs request"""
+    # No read timeout: SOLR reads and indexes every OCR file in the batch before it responds
+    r = solr.get_session().post(update_url("/json/docs"), json=solr_docs, params=params,
+                                timeout=(app.config["SOLR_CONNECT_TIMEOUT"], None))
+    if r.status_code != requests.codes.ok:
+        print("ERROR posting to solr: ", r.content)
+        return False
+    return True
+
+
+def commit():
+    r = solr.get_session().post(update_url(), params=dict(commit="true"),
+                                timeout=(app.config["SOLR_CONNECT_TIMEOUT"], None))
+    if r.status_code != requests.codes.ok:
+        print("ERROR committing to solr: ", r.content)
+        return False
+    return True
+
+
+class UpdateScheduler(object):
+    """Accumulates documents into batched SOLR updates, and decides when they are committed.
+
+    Documents are posted batch_size at a time. They are then committed by an explicit commit once commit_docs of them
+    are waiting, or commit_seconds have passed since the last commit (both checked as documents are added), or left to
+    SOLR with commitWithin if commit_within (milliseconds) is set, or soft committed by the update request itself if
+    soft_commit is set. on_commit is called with the items of the documents once they are committed, and on_failure
+    with those whose post or commit failed. For commitWithin that is once commit_within ms have passed since the post
+    (checked as documents are added, and waited for on flushing), as SOLR doesn't say when it has committed them, and
+    searches before then would cache results without them.
+
+    Use it as a context manager: on leaving the block, including by an exception, Ctrl-C or SIGTERM / SIGHUP, whatever
+    is pending is posted and committed.
+    """
+
+    signals = [getattr(signal, name) for name in ("SIGTERM", "SIGHUP") if hasattr(signal, name)]
+
+    def __init__(self, batch_size=500, commit_docs=0, commit_seconds=0, commit_within=0, on_commit=None,
+                 on_failure=None, soft_commit=False):
+        self.batch_size = batch_size
+        self.commit_docs = commit_docs
+        self.commit_seconds = commit_seconds
+        self.commit_within = commit_within
+        self.soft_commit = soft_commit
+        self.on_commit = on_commit or (lambda items: None)
+        self.on_failure = on_failure or (lambda items: None)
+        self.pending = []
+        self.uncommitted = []
+        self.awaiting = []  # (due time, items) of updates posted with commitWithin, in the order they are due
+        self.last_commit = time.monotonic()
+        self._previous_handlers = {}
+
+    def __enter__(self):
+        for signum in self.signals:
+            self._previous_handlers[signum] = signal.signal(signum, self._exit_on_signal)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        for signum, handler in self._previous_handlers.items():
+            signal.signal(signum, handler)
+        self._previous_handlers = {}
+        if exc_type is not None:
+            print("Flushing pending SOLR updates before exiting")
+        self.flush()
+        return False
+
+    @staticmethod
+    def _exit_on_signal(signum, frame):
+        raise SystemExit(128 + signum)
+
+    def add(self, item, solr_doc):
+        self.pending.append((item, solr_doc))
+        if len(self.pending) >= self.batch_size:
+            self.post()
+        self.settle()
+        if self.commit_due():
+            self.commit()
+
+    def commit_due(self):
+        if not self.uncommitted:
+            return False
+        if self.commit_docs and len(self.uncommitted) >= self.commit_docs:
+            return True
+        return bool(self.commit_seconds) and time.monotonic() - self.last_commit >= self.commit_seconds
+
+    def post(self):
+        if not self.pending:
+            return
+        items = [item for item, solr_doc in self.pending]
+        if self.commit_within:
+            params = dict(commitWithin=self.commit_within)
+        elif self.soft_commit:
+            params = dict(softCommit="true")
+        else:
+            params = None
+        posted = post_documents([solr_doc for item, solr_doc in self.pending], params)
+        self.pending = []
+        if not posted:
+            self.on_failure(items)
+        elif self.commit_within:
+            self.awaiting.append((time.monotonic() + self.commit_within / 1000, items))
+        elif self.soft_commit:
+            self.on_commit(items)  # searchable as soon as SOLR responds
+        else:
+            self.uncommitted.extend(items)
+
+    def settle(self, wait=False):
+        """Call on_commit for the updates posted with commitWithin that SOLR must have committed by now, first waiting
+        for those still to come if wait is set"""
+        while self.awaiting:
+            delay = self.awaiting[0][0] - time.monotonic()
+            if delay > 0:
+                if not wait:
+                    return
+                time.sleep(delay)
+            self.on_commit(self.awaiting.pop(0)[1])
+
+    def commit(self):
+        self.post()
+        if not self.uncommitted:
+            return
+        items, self.uncommitted = self.uncommitted, []
+        if commit():
+            self.on_commit(items)
+        else:
+            self.on_failure(items)
+        self.last_commit = time.monotonic()
+
+    def flush(self):
+        """Post anything pending and commit, so that everything added so far is searchable"""
+        self.commit()
+        self.settle(wait=True)
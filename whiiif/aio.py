@@ -0,0 +1,260 @@
+""" aio.py: asyncio serving mode for the search endpoints, using aiohttp
+
+The Flask app remains the default way of serving Whiiif. This module serves the same /search, /snippets and
+/collection/search endpoints from an aiohttp application instead, so that a single process can hold many SOLR queries
+in flight at once rather than tying up a worker thread for each one. Query building and result transforms are shared
+with the Flask views. Cache lookups and writes (SQLite, and the invalidation stamp files) and manifest and page index
+reads are blocking, so they are run in the event loop's default thread pool rather than on the loop itself.
+
+Run it directly:
+
+    WHIIIF_SETTINGS=../settings.cfg python -m whiiif.aio --host 127.0.0.1 --port 5000
+
+or under gunicorn:
+
+    gunicorn 'whiiif.aio:create_app()' --worker-class aiohttp.GunicornWebWorker
+"""
+
+import argparse
+import asyncio
+import time
+
+import aiohttp
+from aiohttp import web
+
+from whiiif import app, cache, coalesce, highlights, metrics, profiling, serializer, views
+
+
+class AsyncSolrClient(object):
+    """Non-blocking SOLR client with a keep-alive connection pool, timeouts and retries, mirroring whiiif.solr"""
+
+    retry_statuses = (502, 503, 504)
+    form_headers = {"Content-Type": "application/x-www-form-urlencoded; charset=UTF-8"}
+
+    def __init__(self):
+        self.session = None
+
+    async def start(self):
+        connector = aiohttp.TCPConnector(limit=app.config["ASYNC_SOLR_MAX_CONNECTIONS"],
+                                         limit_per_host=app.config["ASYNC_SOLR_MAX_CONNECTIONS"])
+        timeout = aiohttp.ClientTimeout(sock_connect=app.config["SOLR_CONNECT_TIMEOUT"],
+                                        sock_read=app.config["SOLR_READ_TIMEOUT"])
+        self.session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    async def fetch(self, solr_query, read):
+        """POST a SOLR query and return `await read(response)`, retrying connection failures and gateway errors"""
+        retries = app.config["SOLR_RETRIES"]
+        for attempt in range(retries + 1):
+            try:
+                start = time.perf_counter()
+                async with self.session.post(solr_query.url, data=solr_query.data.encode("utf8"),
+                                             headers=self.form_headers) as solr_results:
+                    metrics.observe_stage("solr", time.perf_counter() - start)
+                    app.logger.debug("Solr request response code: {}".format(solr_results.status))
+                    if solr_results.status not in self.retry_statuses or attempt == retries:
+                        with metrics.stage("parse"):
+                            return await read(solr_results)
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+                if attempt == retries:
+                    raise
+            await asyncio.sleep(app.config["SOLR_RETRY_BACKOFF"] * (2 ** attempt))
+
+    async def get_json(self, solr_query):
+        """POST a SOLR query and return the decoded JSON body, shared with identical concurrent queries"""
+        async def read(solr_results):
+            return serializer.loads(await solr_results.read())
+        return await coalesce.async_flights.do(("json", solr_query), lambda: self.fetch(solr_query, read))
+
+    async def get_search_results(self, solr_query, first_hit=0, hit_limit=None):
+        """POST a IIIF Search SOLR query and return its hits, parsing the body as it arrives when ijson is available"""
+        if not highlights.streaming_enabled():
+            results_json = await self.get_json(solr_query)
+            return views.search_results(results_json, views.solr_docs(results_json), first_hit, hit_limit)
+
+        async def read(solr_results):
+            return await highlights.SearchResultsParser(first_hit, hit_limit).parse_async(solr_results.content)
+        return await coalesce.async_flights.do(("search", solr_query, first_hit, hit_limit),
+                                               lambda: self.fetch(solr_query, read))
+
+
+solr_client = web.AppKey("solr_client", AsyncSolrClient)
+
+
+async def run_query(request, solr_query):
+    """Run a SOLR query, returning the response JSON, its docs and whether the results can be cached"""
+    try:
+        results_json = await request.app[solr_client].get_json(solr_query)
+        return results_json, views.solr_docs(results_json), True
+    except (aiohttp.ClientError, asyncio.TimeoutError, KeyError, ValueError, AttributeError) as e:
+        views.log_solr_error(e)
+        return {}, [], False
+
+
+async def blocking(func, *args):
+    """Run blocking cache or file I/O in a worker thread, in the current context so that metrics keep their labels"""
+    return await asyncio.to_thread(func, *args)
+
+
+def json_response(body):
+    with metrics.stage("encode"):
+        body = serializer.dumpb(body)
+    metrics.observe_size(len(body))
+    return web.Response(body=body, content_type='application/json', headers={'Access-Control-Allow-Origin': '*'})
+
+
+async def stream_response(request, chunks):
+    response = web.StreamResponse(headers={'Access-Control-Allow-Origin': '*'})
+    response.content_type = 'application/json'
+    await response.prepare(request)
+    for chunk in chunks:
+        await response.write(chunk.encode("utf8"))
+    await response.write_eof()
+    return response
+
+
+@metrics.timed("search")
+@profiling.profiled("search")
+async def search(request):
+    manifest = request.match_info["manifest"]
+    app.logger.info("Processing IIIF Search request for document {}".format(manifest))
+
+    manifest, q, ignored = views.search_params(manifest, request.query)
+    page = views.search_page(request.query)
+
+    cache_key = cache.search_key(manifest, q, ignored, page)
+    cached = await blocking(cache.get_cache("search").get, cache_key)
+    if cached is not None:
+        app.logger.info("Serving cached IIIF Search response for document {}".format(manifest))
+        return json_response(views.cached_search_response(cached, str(request.url), page))
+
+    solr_query = views.search_query(manifest, q, views.search_snippets(page))
+    try:
+        results, total_results, start_index = await request.app[solr_client].get_search_results(
+            solr_query, *views.search_hits(page))
+        cacheable = True
+    except (aiohttp.ClientError, asyncio.TimeoutError, KeyError, ValueError, AttributeError,
+            highlights.ParseError) as e:
+        views.log_solr_error(e)
+        results, total_results, start_index = [], 0, 0
+        cacheable = False
+    metrics.observe_hits(len(results))
+
+    paging = views.search_paging(str(request.url), page, total_results, start_index)
+    if views.stream_annotations(len(results)):
+        app.logger.info("Streaming IIIF Search response with {} hits".format(len(results)))
+        return await stream_response(request, views.iter_annotations(results, total_results, ignored,
+                                                                     str(request.url),
+                                                                     app.config["SEARCH_STREAM_CHUNK_SIZE"], paging))
+
+    response_dict = views.make_annotations(results, total_results, ignored, search_id=str(request.url),
+                                           paging=paging)
+    if cacheable:
+        await blocking(cache.get_cache("search").set, cache_key, response_dict)
+
+    return json_response(response_dict)
+
+
+@metrics.timed("collection")
+@profiling.profiled("collection")
+async def collection_search(request):
+    app.logger.info("Processing Collection Search request")
+
+    q = views.collection_params(request.query)
+
+    cache_key = cache.collection_key(q)
+    cached = await blocking(cache.get_cache("collection").get, cache_key)
+    if cached is not None:
+        app.logger.info("Serving cached Collection Search response")
+        return json_response(cached)
+
+    results_json, docs, cacheable = await run_query(request, views.collection_query(q))
+
+    results, complete = await blocking(views.collection_results, results_json, docs)
+    metrics.observe_hits(views.canvas_count(results))
+    if cacheable and complete:
+        await blocking(cache.get_cache("collection").set, cache_key, results)
+
+    return json_response(results)
+
+
+@metrics.timed("snippets")
+@profiling.profiled("snippets")
+async def snippet_search(request):
+    id = request.match_info["id"]
+    app.logger.info("Processing Snippet Search request for document {}".format(id))
+
+    q, snips = views.snippets_params(request.query)
+
+    cache_key = cache.snippets_key(id, q, snips)
+    cached = await blocking(cache.get_cache("snippets").get, cache_key)
+    if cached is not None:
+        app.logger.info("Serving cached Snippet Search response for document {}".format(id))
+        return json_response(cached)
+
+    results_json, docs, cacheable = await run_query(request, views.snippets_query(id, q, snips))
+
+    results = views.snippets_results(results_json, docs)
+    metrics.observe_hits(views.canvas_count(results))
+    if cacheable:
+        await blocking(cache.get_cache("snippets").set, cache_key, results)
+
+    return json_response(results)
+
+
+@metrics.timed("snippets_batch")
+@profiling.profiled("snippets_batch")
+async def snippet_batch_search(request):
+    ids, q, snips = views.snippets_batch_params(request.query)
+    app.logger.info("Processing batch Snippet Search request for {} documents".format(len(ids)))
+
+    found = await blocking(views.cached_snippets, ids, q, snips)
+    missing = [id for id in ids if id not in found]
+    if missing:
+        results_json, docs, cacheable = await run_query(request, views.snippets_batch_query(missing, q, snips))
+        found.update(await blocking(views.snippets_by_document, missing, views.snippets_results(results_json, docs),
+                                    q, snips, cacheable))
+
+    results = [result for id in ids for result in found[id]]
+    metrics.observe_hits(views.canvas_count(results))
+    return json_response(results)
+
+
+async def prometheus_metrics(request):
+    if not metrics.enabled():
+        raise web.HTTPNotFound()
+    return web.Response(body=metrics.render().encode("utf8"), headers={"Content-Type": metrics.CONTENT_TYPE})
+
+
+async def start_solr_client(aio_app):
+    await aio_app[solr_client].start()
+
+
+async def close_solr_client(aio_app):
+    await aio_app[solr_client].close()
+
+
+def create_app():
+    aio_app = web.Application()
+    aio_app[solr_client] = AsyncSolrClient()
+    aio_app.on_startup.append(start_solr_client)
+    aio_app.on_cleanup.append(close_solr_client)
+    aio_app.router.add_get('/search/{manifest}', search)
+    aio_app.router.add_get('/collection/search', collection_search)
+    aio_app.router.add_get('/snippets/{id}', snippet_search)
+    aio_app.router.add_get('/snippets', snippet_batch_search)
+    aio_app.router.add_get('/metrics', prometheus_metrics)
+    return aio_app
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve the Whiiif search endpoints using asyncio", add_help=True)
+    parser.add_argument('--host', default='127.0.0.1', help='interface to listen on')
+    parser.add_argument('--port', type=int, default=5000, help='port to listen on')
+    args = parser.parse_args()
+
+    web.run_app(create_app(), host=args.host, port=args.port)
@@ -0,0 +1,285 @@
+""" cache.py: response caches for the search, snippet and collection views, with pluggable backends """
+
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from os import path
+
+from whiiif import app, serializer
+
+COLLECTION_DOCUMENT = "@collection"  # pseudo document id for collection search entries, dropped on any reindex
+_stamp_regexp = re.compile(r'[^A-Za-z0-9-_@]')
+
+
+class CacheBackend(object):
+    """Interface for response cache backends.
+
+    Keys are tuples whose first element is the document id, so that all of the entries for a document can be dropped
+    when it is reindexed. Values must be JSON serialisable, as shared backends store them outside of the process.
+    """
+
+    def get(self, key):
+        raise NotImplementedError
+
+    def set(self, key, value):
+        raise NotImplementedError
+
+    def invalidate(self, document):
+        raise NotImplementedError
+
+    def clear(self):
+        raise NotImplementedError
+
+    def stats(self):
+        raise NotImplementedError
+
+
+class MemoryCache(CacheBackend):
+    """A size-bounded, thread-safe LRU cache, private to the process, whose entries also expire after a TTL.
+
+    As the indexer runs in a different process to the web workers, every entry also remembers the document's
+    invalidation stamp (see `touch_document`) and is discarded if the stamp has since changed.
+    """
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()  # key -> (expiry time, document stamp, value)
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        if self.maxsize <= 0:
+            return None
+        stamp = document_stamp(key[0])
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                expires, entry_stamp, value = entry
+                if expires > time.monotonic() and entry_stamp == stamp:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._entries[key]
+            self.misses += 1
+            return None
+
+    def set(self, key, value):
+        if self.maxsize <= 0:
+            return
+        stamp = document_stamp(key[0])
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, stamp, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, document):
+        with self._lock:
+            for key in [key for key in self._entries if key[0] == document]:
+                del self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+
+    def stats(self):
+        return {"size": len(self._entries),
+                "maxsize": self.maxsize,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions}
+
+
+class SqliteCache(CacheBackend):
+    """A size-bounded LRU/TTL cache stored in an SQLite database, shared by every worker process on the host.
+
+    Each namespace (search, snippets, collection) shares the one database file, which is opened in WAL mode so that
+    readers don't block the writer. Connections are per thread and are never carried across a fork. Hit and miss
+    counters are kept per process.
+
+    Recency is only recorded to the nearest touch_interval seconds, so that most hits are read-only and don't queue
+    for the database's single writer lock; eviction is least recently used at that granularity.
+    """
+
+    trim_interval = 64  # only check the size bound every n writes, as counting rows isn't free
+    touch_interval = 60  # only update an entry's access time on a hit if it's older than this many seconds
+
+    def __init__(self, db_path, namespace, maxsize, ttl):
+        self.db_path = db_path
+        self.namespace = namespace
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._writes = 0
+        self._local = threading.local()
+
+    def _connection(self):
+        pid = os.getpid()
+        if getattr(self._local, "pid", None) != pid:
+            os.makedirs(path.dirname(self.db_path), exist_ok=True)
+            connection = sqlite3.connect(self.db_path, timeout=5, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.execute("CREATE TABLE IF NOT EXISTS entries (namespace TEXT, key TEXT, document TEXT, "
+                               "expires REAL, accessed REAL, value TEXT, PRIMARY KEY (namespace, key))")
+            connection.execute("CREATE INDEX IF NOT EXISTS entries_document ON entries (namespace, document)")
+            connection.execute("CREATE INDEX IF NOT EXISTS entries_accessed ON entries (namespace, accessed)")
+            self._local.connection = connection
+            self._local.pid = pid
+        return self._local.connection
+
+    def get(self, key):
+        if self.maxsize <= 0:
+            return None
+        connection = self._connection()
+        db_key = json.dumps(key)
+        now = time.time()
+        row = connection.execute("SELECT expires, accessed, value FROM entries WHERE namespace = ? AND key = ?",
+                                 (self.namespace, db_key)).fetchone()
+        if row is not None:
+            if row[0] > now:
+                if now - row[1] >= self.touch_interval:
+                    connection.execute("UPDATE entries SET accessed = ? WHERE namespace = ? AND key = ?",
+                                       (now, self.namespace, db_key))
+                self.hits += 1
+                return serializer.loads(row[2])
+            connection.execute("DELETE FROM entries WHERE namespace = ? AND key = ?", (self.namespace, db_key))
+        self.misses += 1
+        return None
+
+    def set(self, key, value):
+        if self.maxsize <= 0:
+            return
+        connection = self._connection()
+        now = time.time()
+        connection.execute("INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?)",
+                           (self.namespace, json.dumps(key), key[0], now + self.ttl, now, serializer.dumps(value)))
+        self._writes += 1
+        if self._writes % self.trim_interval == 0:
+            self.trim()
+
+    def trim(self):
+        """Delete expired entries, then the least recently used ones until the cache is back within maxsize"""
+        connection = self._connection()
+        connection.execute("DELETE FROM entries WHERE namespace = ? AND expires <= ?", (self.namespace, time.time()))
+        deleted = connection.execute("DELETE FROM entries WHERE rowid IN (SELECT rowid FROM entries "
+                                     "WHERE namespace = ? ORDER BY accessed DESC LIMIT -1 OFFSET ?)",
+                                     (self.namespace, self.maxsize)).rowcount
+        self.evictions += max(deleted, 0)
+
+    def invalidate(self, document):
+        self._connection().execute("DELETE FROM entries WHERE namespace = ? AND document = ?",
+                                   (self.namespace, document))
+
+    def clear(self):
+        self._connection().execute("DELETE FROM entries WHERE namespace = ?", (self.namespace,))
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def stats(self):
+        size = self._connection().execute("SELECT COUNT(*) FROM entries WHERE namespace = ?",
+                                          (self.namespace,)).fetchone()[0]
+        return {"size": size,
+                "maxsize": self.maxsize,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions}
+
+
+cache_settings = {"search": ("SEARCH_CACHE_SIZE", "SEARCH_CACHE_TTL"),
+                  "snippets": ("SNIPPETS_CACHE_SIZE", "SNIPPETS_CACHE_TTL"),
+                  "collection": ("COLLECTION_CACHE_SIZE", "COLLECTION_CACHE_TTL")}
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def make_cache(name):
+    """Build the cache for one of the views using the backend selected by CACHE_BACKEND"""
+    size_setting, ttl_setting = cache_settings[name]
+    backend = app.config["CACHE_BACKEND"]
+    if backend == "memory":
+        return MemoryCache(app.config[size_setting], app.config[ttl_setting])
+    elif backend == "sqlite":
+        return SqliteCache(path.join(app.config["CACHE_LOCATION"], "responses.sqlite3"), name,
+                           app.config[size_setting], app.config[ttl_setting])
+    raise ValueError("Unknown CACHE_BACKEND: {}".format(backend))
+
+
+def get_cache(name):
+    """Return the named response cache for this process, creating it from the app config on first use"""
+    cache = _caches.get(name)
+    if cache is None:
+        with _caches_lock:
+            cache = _caches.get(name)
+            if cache is None:
+                cache = _caches[name] = make_cache(name)
+    return cache
+
+
+def caches():
+    """Return the response caches this process has created so far, by name"""
+    return dict(_caches)
+
+
+def reset():
+    """Throw away the caches, so that they are rebuilt from the (possibly changed) app config"""
+    _caches.clear()
+
+
+def search_key(manifest, q, ignored, page=0):
+    """Build the cache key for a IIIF Search request: (document, normalised query, ignored params, page)"""
+    return manifest, " ".join(q.split()), tuple(sorted(ignored)), page
+
+
+def snippets_key(document, q, snips):
+    return document, " ".join(q.split()), snips
+
+
+def collection_key(q):
+    return COLLECTION_DOCUMENT, " ".join(q.split())
+
+
+def stamp_path(document):
+    return path.join(app.config["CACHE_LOCATION"], _stamp_regexp.sub("_", document)) + ".stamp"
+
+
+def document_stamp(document):
+    """Return the invalidation stamp for a document, or 0 if it has never been reindexed"""
+    try:
+        return os.stat(stamp_path(document)).st_mtime_ns
+    except OSError:
+        return 0
+
+
+def touch_document(document):
+    """Update the invalidation stamp for a document, so every process drops its cached responses for it"""
+    os.makedirs(app.config["CACHE_LOCATION"], exist_ok=True)
+    stamp_file = stamp_path(document)
+    with open(stamp_file, "a"):
+        pass
+    now = time.time_ns()
+    os.utime(stamp_file, ns=(now, now))
+
+
+def invalidate_document(document):
+    """Drop every cached response that a reindex of the document could change, in every worker process"""
+    touch_document(document)
+    touch_document(COLLECTION_DOCUMENT)
+    for name in cache_settings:
+        get_cache(name).invalidate(document)
+    get_cache("collection").invalidate(COLLECTION_DOCUMENT)
@@ -0,0 +1,108 @@
+""" coalesce.py: single-flight coalescing of identical concurrent SOLR queries
+
+When a popular document is shared, bursts of identical searches can arrive together. Rather than each sending the same
+query to SOLR, the first request for a key runs it and any identical requests that arrive while it is in flight wait
+for it and share its parsed result. Results are shared, not copied, so callers must treat them as read-only.
+Coalescing is per process: SingleFlight is for the threaded Flask views, AsyncSingleFlight for the aiohttp mode.
+"""
+
+import asyncio
+import threading
+
+from whiiif import app
+
+
+class _Call(object):
+    __slots__ = ("done", "result", "error")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight(object):
+    """Run a function once for all of the threads that ask for the same key at the same time"""
+
+    def __init__(self):
+        self.leaders = 0
+        self.coalesced = 0
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, func):
+        if not app.config["SOLR_COALESCE"]:
+            return func()
+        with self._lock:
+            call = self._calls.get(key)
+            if call is None:
+                call = self._calls[key] = _Call()
+                self.leaders += 1
+                leader = True
+            else:
+                self.coalesced += 1
+                leader = False
+
+        if not leader:
+            app.logger.debug("Waiting on in-flight SOLR query for {}".format(key))
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = func()
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result
+
+    def stats(self):
+        return {"in_flight": len(self._calls),
+                "leaders": self.leaders,
+                "coalesced": self.coalesced}
+
+
+class AsyncSingleFlight(object):
+    """Await a coroutine function once for all of the tasks that ask for the same key at the same time.
+
+    The query runs in its own task, so a client disconnecting only cancels its own wait, not the query the others are
+    waiting on.
+    """
+
+    def __init__(self):
+        self.leaders = 0
+        self.coalesced = 0
+        self._calls = {}
+
+    async def do(self, key, func):
+        if not app.config["SOLR_COALESCE"]:
+            return await func()
+        task = self._calls.get(key)
+        if task is None:
+            task = self._calls[key] = asyncio.ensure_future(func())
+            task.add_done_callback(lambda done: self._finished(key, done))
+            self.leaders += 1
+        else:
+            self.coalesced += 1
+            app.logger.debug("Waiting on in-flight SOLR query for {}".format(key))
+        return await asyncio.shield(task)
+
+    def _finished(self, key, task):
+        if self._calls.get(key) is task:
+            del self._calls[key]
+        if not task.cancelled():
+            task.exception()  # mark it retrieved, in case every caller has gone away
+
+    def stats(self):
+        return {"in_flight": len(self._calls),
+                "leaders": self.leaders,
+                "coalesced": self.coalesced}
+
+
+flights = SingleFlight()
+async_flights = AsyncSingleFlight()
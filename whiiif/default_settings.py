@@ -16,20 +16,60 @@ DOCUMENT_ID_FIELD = 'id'  # the id field used for search urls
 # External files
 XML_LOCATION = '/opt/whiiif/resources/xml'  # location to store ALTO-XML files
 MANIFEST_LOCATION = '/opt/whiiif/resources/manifests'  # location of the IIIF manifests
+CANVAS_INDEX_LOCATION = '/opt/whiiif/resources/canvases'  # location of the canvas image indexes written by the indexer
+CACHE_LOCATION = '/opt/whiiif/resources/cache'  # location for the shared response cache and invalidation stamps
 
 # OPTIONAL SETTINGS (i.e if they are missing the application won't die!)
+# JSON
+JSON_BACKEND = 'auto'  # can be one of auto (fastest installed), orjson, ujson or json
+# Response caching
+CACHE_BACKEND = 'memory'  # can be one of memory (per process) or sqlite (shared by all workers, in CACHE_LOCATION)
 # Search within
 WITHIN_MAX_RESULTS = 4096  # Max results when searching inside using IIIF Search, so should be quite high
+SEARCH_PAGE_SIZE = 0  # split IIIF Search results into pages of this many hits (0 returns them all at once)
+SEARCH_CACHE_SIZE = 1024  # Max IIIF Search responses to cache (0 disables the cache)
+SEARCH_CACHE_TTL = 300  # seconds before a cached IIIF Search response expires
+# Streaming keeps the memory of very large responses down, but streamed responses aren't cached, and aren't counted in
+# the encode time and response size metrics, so it's off by default; set a threshold if memory matters more than those
+SEARCH_STREAM_THRESHOLD = -1  # stream responses with more hits than this in chunks, uncached (-1 never streams)
+SEARCH_STREAM_CHUNK_SIZE = 64 * 1024  # approximate size in characters of each streamed chunk
+# Parsing as the response arrives was measured at 2-3x slower than loading it whole with orjson, for the same peak
+# memory (tests/benchmarks/bench_endpoints.py), as every JSON event is handled in Python, so it's off by default
+SOLR_STREAM_PARSE = False  # parse IIIF Search SOLR responses incrementally as they arrive (needs ijson installed)
 # Snippet search
 SNIPPETS_MAX_RESULTS = 10  # Max results when retrieving snippets for an individual document
 SNIPPET_CONTEXT = 'word'  # context for the returned snippets - can be one of word, line or block
 SNIPPET_CONTEXT_SIZE = 5  # number of context objects to return either side of the result
 SNIPPET_CONTEXT_LIMIT = 'block'  # don't extend the context beyond this container object
+SNIPPETS_CACHE_SIZE = 4096  # Max Snippet Search responses to cache (0 disables the cache)
+SNIPPETS_CACHE_TTL = 300  # seconds before a cached Snippet Search response expires
+SNIPPETS_BATCH_MAX_IDS = 50  # Max documents in one batch Snippet Search request (/snippets?ids=a,b&q=...)
 # Collection search
 COLLECTION_MAX_DOCUMENT_RESULTS = 5  # Max results per document, *not* overall
 COLLECTION_MAX_RESULTS = 200  # Max number of documents returned overall
 COLLECTION_SNIPPET_CONTEXT = 'word'  # context for the returned snippets - can be one of word, line or block
 COLLECTION_SNIPPET_CONTEXT_SIZE = 5  # number of context objects to return either side of the result
 COLLECTION_SNIPPET_CONTEXT_LIMIT = 'block'  # don't extend the context beyond this container object
+COLLECTION_CACHE_SIZE = 256  # Max Collection Search responses to cache (0 disables the cache)
+COLLECTION_CACHE_TTL = 300  # seconds before a cached Collection Search response expires
+MANIFEST_CACHE_MAX_BYTES = 64 * 1024 * 1024  # memory to use for the per-canvas image URLs read from manifests
+# SOLR connection pool
+SOLR_CONNECT_TIMEOUT = 3.05  # seconds to wait for a connection to SOLR to be established
+SOLR_READ_TIMEOUT = 30  # seconds to wait for SOLR to send a response once connected
+SOLR_RETRIES = 2  # number of times to retry a failed connection or a 502/503/504 response
+SOLR_RETRY_BACKOFF = 0.1  # backoff factor between retries (0.1 -> 0.1s, 0.2s, 0.4s...)
+SOLR_POOL_CONNECTIONS = 4  # number of distinct SOLR hosts to keep connection pools for
+SOLR_POOL_MAXSIZE = 16  # max keep-alive connections per SOLR host, per process (set >= threads per worker)
+SOLR_COALESCE = True  # identical concurrent queries in a process share one SOLR request and its result
+# Metrics (served at /metrics in the Prometheus text format)
+METRICS_ENABLED = True  # time each stage of the search views and record response sizes and hit counts
+METRICS_DIR = ''  # directory for per-process metrics snapshots, summed by /metrics (set when running several workers)
+METRICS_FLUSH_INTERVAL = 1  # seconds between each process's snapshot writes to METRICS_DIR
+# Slow request profiling
+PROFILE_SAMPLE_RATE = 0.01  # fraction of search requests to run under cProfile (0 to disable, 1 for every request)
+PROFILE_THRESHOLD = 2  # seconds; a profiled request that takes at least this long has its profile written to LOG_DIR
+PROFILE_SUMMARY_LINES = 40  # functions listed in the text summary written alongside each profile
+# Async serving mode (python -m whiiif.aio, requires the whiiif[async] extra)
+ASYNC_SOLR_MAX_CONNECTIONS = 100  # max concurrent SOLR queries in flight per process
 
 
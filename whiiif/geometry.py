@@ -0,0 +1,37 @@
+""" geometry.py: batched conversion of ocrhighlighting boxes to IIIF xywh regions
+
+Every view turns SOLR's ulx/uly/lrx/lry boxes into x,y,w,h and, for documents whose OCR was run on a different
+resolution to the IIIF images, scales them. `xywh()` does this for a whole batch of boxes at once: with NumPy when
+there is scaling to do on a batch large enough to outweigh its per-call overhead, and in pure Python otherwise or when
+NumPy isn't installed. (Unscaled boxes are only a subtraction each, which pure Python does faster than building an
+array.) Both give the same results: width and height are taken before scaling, and scaled values are truncated to ints.
+"""
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+numpy_min_boxes = 64  # smaller batches are scaled in pure Python, as NumPy's setup cost outweighs the saving
+
+
+def xywh(boxes, scale=1):
+    """Convert a sequence of boxes (mappings with ulx, uly, lrx and lry) to a list of (x, y, w, h) sequences"""
+    if numpy is not None and scale != 1 and len(boxes) >= numpy_min_boxes:
+        return _numpy_xywh(boxes, scale)
+    return _python_xywh(boxes, scale)
+
+
+def _python_xywh(boxes, scale):
+    if scale == 1:
+        return [(box["ulx"], box["uly"], box["lrx"] - box["ulx"], box["lry"] - box["uly"]) for box in boxes]
+    return [(int(box["ulx"] * scale), int(box["uly"] * scale),
+             int((box["lrx"] - box["ulx"]) * scale), int((box["lry"] - box["uly"]) * scale)) for box in boxes]
+
+
+def _numpy_xywh(boxes, scale):
+    coords = numpy.array([(box["ulx"], box["uly"], box["lrx"], box["lry"]) for box in boxes])
+    coords[:, 2:] -= coords[:, :2]
+    if scale != 1:
+        coords = numpy.trunc(coords * scale).astype(numpy.int64)
+    return coords.tolist()
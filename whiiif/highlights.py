@@ -0,0 +1,161 @@
+""" highlights.py: compact IIIF Search hit records, and incremental parsing of SOLR responses into them
+
+A hit is a list of HighlightPart records, one per word box. They use __slots__ and keep the box's (already scaled)
+canvas coordinates as numbers, so that nothing is formatted into a string until the annotation is written. This trades
+build time for memory: against per-part dicts, the hits of a large response take less than half the memory, and are
+quicker to turn into annotations, but are slower to build (see tests/benchmarks/bench_highlights.py).
+
+Rather than loading the whole SOLR reply (every snippet with its text, score, regions and highlights) into memory
+before transforming it, SearchResultsParser can be fed ijson events as the response is read, building one snippet at a
+time and keeping only the hits that the AnnotationList needs. It's only used when SOLR_STREAM_PARSE is set and ijson is
+installed: handling every event in Python makes it slower than loading the response whole, and the hits kept, rather
+than the reply, set the peak memory. Otherwise the views parse the whole response and use `views.search_results()`,
+which gives the same results.
+"""
+
+from whiiif import app, geometry
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+if ijson is not None:
+    ParseError = ijson.JSONError
+else:
+    class ParseError(Exception):
+        pass
+
+
+class HighlightPart(object):
+    """One word box of a IIIF Search hit, with its region on the canvas"""
+
+    __slots__ = ("manifest_id", "manifest_url", "canvas_id", "x", "y", "w", "h", "chars")
+
+    def __init__(self, manifest_id, manifest_url, canvas_id, x, y, w, h, chars):
+        self.manifest_id = manifest_id
+        self.manifest_url = manifest_url
+        self.canvas_id = canvas_id
+        self.x = x
+        self.y = y
+        self.w = w
+        self.h = h
+        self.chars = chars
+
+    def __eq__(self, other):
+        if not isinstance(other, HighlightPart):
+            return NotImplemented
+        return all(getattr(self, slot) == getattr(other, slot) for slot in self.__slots__)
+
+    def __repr__(self):
+        return "HighlightPart({})".format(", ".join(repr(getattr(self, slot)) for slot in self.__slots__))
+
+
+def fragment_hits(doc, fragment_highlights):
+    """Build the hits for the highlights of one ocrhighlighting snippet, converting all of its boxes in one batch"""
+    manifest_id = doc[app.config["DOCUMENT_ID_FIELD"]]
+    manifest_url = doc[app.config["MANIFEST_URL_FIELD"]]
+    boxes = iter(geometry.xywh([part for highlight in fragment_highlights for part in highlight],
+                               doc.get("scale", 1)))
+    hits = []
+    for highlight in fragment_highlights:
+        hit = []
+        for part in highlight:
+            x, y, w, h = next(boxes)
+            hit.append(HighlightPart(manifest_id, manifest_url, part["page"], x, y, w, h, part["text"]))
+        hits.append(hit)
+    return hits
+
+
+def page_highlights(fragment_highlights, seen, first_hit=0, hit_limit=None):
+    """Return those of a snippet's highlights (one per hit) that are on the page of hit_limit hits from first_hit, when
+    seen hits came before the snippet"""
+    end = len(fragment_highlights) if hit_limit is None else max(first_hit + hit_limit - seen, 0)
+    return fragment_highlights[max(first_hit - seen, 0):end]
+
+
+def streaming_enabled():
+    return ijson is not None and app.config["SOLR_STREAM_PARSE"]
+
+
+class SearchResultsParser(object):
+    """Build IIIF Search hits from a stream of ijson (prefix, event, value) events.
+
+    SOLR writes the docs before the ocrHighlighting block, so each document's manifest URL and scale are known by the
+    time its snippets arrive. Only the hits on the page of hit_limit hits from first_hit are kept; the rest are counted.
+    """
+
+    def __init__(self, first_hit=0, hit_limit=None):
+        self.first_hit = first_hit
+        self.hit_limit = hit_limit
+        self.docs = None
+        self.results = []
+        self.total_results = 0
+        self.hit_count = 0
+        self._builder = None
+        self._depth = 0
+        self._building = None
+        self._building_doc = None
+
+    def parse(self, fp):
+        for prefix, event, value in ijson.parse(fp, use_float=True):
+            self.event(prefix, event, value)
+        return self.finish()
+
+    async def parse_async(self, fp):
+        async for prefix, event, value in ijson.parse_async(fp, use_float=True):
+            self.event(prefix, event, value)
+        return self.finish()
+
+    def finish(self):
+        """Return the hits, the total hit count and the index of the first hit, as `views.search_results()` does"""
+        if self.docs is None:
+            raise KeyError("response")
+        return self.results, max(self.total_results, self.hit_count), min(self.first_hit, self.hit_count)
+
+    def event(self, prefix, event, value):
+        if self._builder is not None:
+            self._builder.event(event, value)
+            if event in ("start_map", "start_array"):
+                self._depth += 1
+            elif event in ("end_map", "end_array"):
+                self._depth -= 1
+                if self._depth == 0:
+                    self._built(self._builder.value)
+            return
+
+        if event == "start_map":
+            if prefix == "response.docs.item":
+                self._start("doc", None, event, value)
+            elif prefix.startswith("ocrHighlighting.") and prefix.endswith(".snippets.item"):
+                doc_id, field = prefix[len("ocrHighlighting."):-len(".snippets.item")].rsplit(".", 1)
+                if field == app.config["OCR_TEXT_FIELD"]:
+                    self._start("snippet", doc_id, event, value)
+        elif prefix == "response.docs" and event == "start_array":
+            self.docs = {}
+        elif prefix == "responseHeader.status":
+            app.logger.debug("Solr JSON response code: {}".format(value))
+        elif prefix.startswith("ocrHighlighting.") and prefix.endswith(".numTotal"):
+            doc_id, field = prefix[len("ocrHighlighting."):-len(".numTotal")].rsplit(".", 1)
+            if field == app.config["OCR_TEXT_FIELD"] and self.docs is not None and doc_id in self.docs:
+                self.total_results += int(value)
+
+    def _start(self, building, doc_id, event, value):
+        self._builder = ijson.ObjectBuilder()
+        self._builder.event(event, value)
+        self._depth = 1
+        self._building = building
+        self._building_doc = doc_id
+
+    def _built(self, obj):
+        self._builder = None
+        if self._building == "doc":
+            self.docs[obj[app.config["DOCUMENT_ID_FIELD"]]] = obj
+        elif self.docs is not None and self._building_doc in self.docs:
+            self.add_snippet(self.docs[self._building_doc], obj)
+
+    def add_snippet(self, doc, fragment):
+        on_page = page_highlights(fragment["highlights"], self.hit_count, self.first_hit, self.hit_limit)
+        self.hit_count += len(fragment["highlights"])
+        if on_page:
+            self.results.extend(fragment_hits(doc, on_page))
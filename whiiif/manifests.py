@@ -0,0 +1,199 @@
+""" manifests.py: per-canvas image URL lookups, from ingest-time canvas indexes or a cache of the IIIF manifests """
+
+import mmap
+import os
+import struct
+import sys
+import tempfile
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from os import path
+
+from whiiif import app, serializer
+
+
+class CanvasImageCache(object):
+    """LRU cache of manifest path -> tuple of image URLs, one per canvas of the first sequence, in page order.
+
+    Only the image table is kept, not the parsed manifest. Entries are keyed on the file's mtime and size as well as
+    its path, so a manifest rewritten by `index_with_plugin.py --modify` is re-read on its next use.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # path -> (file stamp, image table, approximate size in bytes)
+        self._lock = threading.Lock()
+
+    def get(self, manifest_path):
+        stamp = file_stamp(manifest_path)
+        with self._lock:
+            entry = self._entries.get(manifest_path)
+            if entry is not None and entry[0] == stamp:
+                self._entries.move_to_end(manifest_path)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+
+        images = read_canvas_images(manifest_path)
+        size = table_size(images)
+        with self._lock:
+            old = self._entries.pop(manifest_path, None)
+            if old is not None:
+                self.size_bytes -= old[2]
+            if size <= self.max_bytes:
+                self._entries[manifest_path] = (stamp, images, size)
+                self.size_bytes += size
+                while self.size_bytes > self.max_bytes:
+                    _, (_, _, evicted_size) = self._entries.popitem(last=False)
+                    self.size_bytes -= evicted_size
+        return images
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size_bytes = 0
+            self.hits = 0
+            self.misses = 0
+
+
+def file_stamp(manifest_path):
+    stat = os.stat(manifest_path)
+    return stat.st_mtime_ns, stat.st_size
+
+
+def read_canvas_images(manifest_path):
+    """Parse a manifest and return the image @id of each canvas in its first sequence (None if it has no image)"""
+    with open(manifest_path, 'rb') as manifest_file:
+        mani_json = serializer.loads(manifest_file.read())
+    return manifest_canvas_images(mani_json)
+
+
+def manifest_canvas_images(mani_json):
+    images = []
+    for canvas in mani_json["sequences"][0]["canvases"]:
+        try:
+            images.append(canvas["images"][0]["resource"]["@id"])
+        except (KeyError, IndexError, TypeError):
+            images.append(None)
+    return tuple(images)
+
+
+def table_size(images):
+    return sys.getsizeof(images) + sum(sys.getsizeof(image) for image in images if image is not None)
+
+
+_canvas_images = None
+_canvas_images_lock = threading.Lock()
+
+
+def canvas_image_cache():
+    global _canvas_images
+    if _canvas_images is None:
+        with _canvas_images_lock:
+            if _canvas_images is None:
+                _canvas_images = CanvasImageCache(app.config["MANIFEST_CACHE_MAX_BYTES"])
+    return _canvas_images
+
+
+def reset():
+    global _canvas_images
+    _canvas_images = None
+
+
+def canvas_images(manifest_path):
+    """Return the per-canvas image URL table for a manifest file, raising FileNotFoundError if it is missing"""
+    return canvas_image_cache().get(manifest_path)
+
+
+# Canvas index files are written by the indexer alongside each document, so that the image for page_N can be found
+# without reading the manifest at all. Layout (little-endian):
+#   b"WCIX", uint32 canvas count N, (N + 1) uint32 offsets into the string table, string table of UTF-8 image URLs
+# A canvas without an image has an empty string.
+CANVAS_INDEX_MAGIC = b"WCIX"
+_header = struct.Struct("<4sI")
+_offset = struct.Struct("<I")
+_offset_pair = struct.Struct("<II")
+
+
+class CanvasIndex(object):
+    """Read-only view of a canvas index file, resolving canvas number -> image URL.
+
+    The file is opened once and memory mapped, so a lookup reads just its offsets and URL, without a system call. The
+    mapping outlives the file descriptor, and still reads the same index if the indexer replaces the file.
+    """
+
+    def __init__(self, index_path):
+        self.index_path = index_path
+        with open(index_path, "rb") as index_file:
+            self._data = mmap.mmap(index_file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.count = _header.unpack_from(self._data)
+        if magic != CANVAS_INDEX_MAGIC:
+            raise ValueError("Not a canvas index file: {}".format(index_path))
+        self.strings_start = _header.size + (self.count + 1) * _offset.size
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, canvas):
+        if not 0 <= canvas < self.count:
+            raise IndexError("canvas {} out of range".format(canvas))
+        start, end = _offset_pair.unpack_from(self._data, _header.size + canvas * _offset.size)
+        if start == end:
+            return None
+        return self._data[self.strings_start + start:self.strings_start + end].decode("utf8")
+
+
+def canvas_index_path(document):
+    return path.join(app.config["CANVAS_INDEX_LOCATION"], document) + ".idx"
+
+
+def write_canvas_index(index_path, images):
+    """Write a canvas index file for a sequence of image URLs, replacing any existing one atomically"""
+    encoded = [(image or "").encode("utf8") for image in images]
+    offsets = [0]
+    for image in encoded:
+        offsets.append(offsets[-1] + len(image))
+    replace_file(index_path, b"".join([_header.pack(CANVAS_INDEX_MAGIC, len(encoded)),
+                                       struct.pack("<{}I".format(len(offsets)), *offsets)] + encoded))
+
+
+def replace_file(file_path, data):
+    """Replace a file with new contents atomically, writing them to a uniquely named temporary file in the same
+    directory first, so that readers and concurrent writers never see part of one"""
+    with replacing_file(file_path) as tmp_file:
+        tmp_file.write(data)
+
+
+@contextmanager
+def replacing_file(file_path):
+    """Give a binary file to write a file's new contents to a bit at a time, replacing it atomically as replace_file()
+    does once the block exits, or leaving it untouched if the block raises"""
+    directory, name = path.split(path.abspath(file_path))
+    fd, tmp_path = tempfile.mkstemp(prefix="." + name + ".", suffix=".tmp", dir=directory)
+    try:
+        with os.fdopen(fd, "wb") as tmp_file:
+            yield tmp_file
+        os.chmod(tmp_path, 0o644)  # mkstemp only lets the owner read it
+        os.replace(tmp_path, file_path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+def canvas_lookup(document):
+    """Return a page number -> image URL lookup for a document.
+
+    The canvas index written at ingest time is used where there is one, falling back to the cached manifest table.
+    Raises FileNotFoundError if there is neither.
+    """
+    try:
+        return CanvasIndex(canvas_index_path(document))
+    except (OSError, ValueError, struct.error):
+        return canvas_images(path.join(app.config["MANIFEST_LOCATION"], document) + ".json")
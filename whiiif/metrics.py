@@ -0,0 +1,320 @@
+""" metrics.py: per-stage latency histograms and counters for the search views, exposed in Prometheus text format
+
+Each request to the search, snippet and collection views is timed as a whole and by stage: building the SOLR query,
+waiting for SOLR to respond, reading and parsing its response, transforming it into the response body, and encoding
+that as JSON. Response sizes and hit counts are recorded too, and the response cache and request coalescing counters
+are collected when the metrics are read.
+
+Metrics are kept per process. With METRICS_DIR set, every process also writes a snapshot of its own metrics there
+(at most once every METRICS_FLUSH_INTERVAL seconds after a request, and when it exits) and the /metrics endpoint adds
+up the snapshots of all of them, so that any gunicorn worker can answer a scrape for the whole server. Empty the
+directory when the server is (re)started, as the snapshots of old processes are kept so that counters never go
+backwards.
+"""
+
+import atexit
+import contextvars
+import functools
+import glob
+import inspect
+import json
+import os
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from os import path
+
+from whiiif import app, cache, coalesce, manifests, profiling
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+HIT_BUCKETS = (0, 1, 5, 10, 50, 100, 500, 1000, 5000)
+
+histograms = {"whiiif_request_duration_seconds": (LATENCY_BUCKETS, "Time to handle a request, by endpoint"),
+              "whiiif_stage_duration_seconds": (LATENCY_BUCKETS, "Time spent in each stage of a request"),
+              "whiiif_response_bytes": (SIZE_BUCKETS, "Size of the (unstreamed) JSON responses"),
+              "whiiif_hits": (HIT_BUCKETS, "Hits (IIIF Search) or highlighted canvases returned per request")}
+
+counters = {"whiiif_cache_hits_total": "Response cache hits",
+            "whiiif_cache_misses_total": "Response cache misses",
+            "whiiif_cache_evictions_total": "Response cache entries evicted to stay within the size bound",
+            "whiiif_manifest_cache_hits_total": "Manifest image table cache hits",
+            "whiiif_manifest_cache_misses_total": "Manifest image table cache misses",
+            "whiiif_solr_queries_total": "SOLR queries sent on behalf of a group of identical concurrent requests",
+            "whiiif_solr_coalesced_total": "Requests that shared an identical in-flight SOLR query"}
+
+gauges = {"whiiif_cache_entries": "Entries in the response cache",
+          "whiiif_solr_in_flight": "Distinct SOLR queries in flight"}
+
+_endpoint = contextvars.ContextVar("whiiif_metrics_endpoint", default="other")
+
+
+class Histogram(object):
+    __slots__ = ("buckets", "counts", "sum")
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # the last count is for values above every bucket
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+
+class Registry(object):
+    """The histograms recorded by one process"""
+
+    def __init__(self):
+        self.histograms = {}  # (name, labels) -> Histogram, where labels is a tuple of (name, value) pairs
+        self.last_flush = 0
+        self._lock = threading.Lock()
+        self.flush_lock = threading.Lock()  # held while writing a snapshot, so an older one can't replace a newer one
+
+    def observe(self, name, labels, value):
+        key = (name, labels)
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram(histograms[name][0])
+            histogram.observe(value)
+
+    def snapshot(self):
+        """Return this process's metrics in a JSON serialisable form"""
+        with self._lock:
+            recorded = [[name, labels, list(histogram.counts), histogram.sum]
+                        for (name, labels), histogram in self.histograms.items()]
+        return {"pid": os.getpid(), "histograms": recorded, "values": process_values()}
+
+    def flush_due(self, interval):
+        """Claim the next snapshot write if interval seconds have passed since the last, so only one request does it"""
+        now = time.monotonic()
+        with self._lock:
+            if now - self.last_flush < interval:
+                return False
+            self.last_flush = now
+            return True
+
+
+registry = Registry()
+
+
+def enabled():
+    return app.config["METRICS_ENABLED"]
+
+
+def observe(name, value, **labels):
+    if enabled():
+        registry.observe(name, tuple(sorted(labels.items())), value)
+
+
+def observe_stage(stage, seconds):
+    observe("whiiif_stage_duration_seconds", seconds, endpoint=_endpoint.get(), stage=stage)
+
+
+@contextmanager
+def stage(name):
+    """Time the enclosed block as a stage of the current request"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe_stage(name, time.perf_counter() - start)
+
+
+def observe_size(size):
+    observe("whiiif_response_bytes", size, endpoint=_endpoint.get())
+
+
+def observe_hits(hits):
+    profiling.note(hits=hits)
+    observe("whiiif_hits", hits, endpoint=_endpoint.get())
+
+
+def timed(endpoint):
+    """Decorate a view (or aiohttp handler) to time it, and label the stages recorded while it runs"""
+    def decorator(view):
+        if inspect.iscoroutinefunction(view):
+            @functools.wraps(view)
+            async def async_wrapper(*args, **kwargs):
+                token = _endpoint.set(endpoint)
+                start = time.perf_counter()
+                try:
+                    return await view(*args, **kwargs)
+                finally:
+                    finish(endpoint, start)
+                    _endpoint.reset(token)
+            return async_wrapper
+
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            token = _endpoint.set(endpoint)
+            start = time.perf_counter()
+            try:
+                return view(*args, **kwargs)
+            finally:
+                finish(endpoint, start)
+                _endpoint.reset(token)
+        return wrapper
+    return decorator
+
+
+def finish(endpoint, start):
+    observe("whiiif_request_duration_seconds", time.perf_counter() - start, endpoint=endpoint)
+    if enabled() and app.config["METRICS_DIR"] and registry.flush_due(app.config["METRICS_FLUSH_INTERVAL"]):
+        try:
+            flush()
+        except OSError as e:
+            app.logger.error("Couldn't write metrics snapshot: {}".format(e))
+
+
+def process_values():
+    """Collect this process's cache and coalescing counters and gauges, as [kind, name, labels, value] lists"""
+    values = []
+    for name, response_cache in sorted(cache.caches().items()):
+        stats = response_cache.stats() if isinstance(response_cache, cache.MemoryCache) else {
+            "hits": response_cache.hits, "misses": response_cache.misses, "evictions": response_cache.evictions}
+        labels = [["cache", name]]
+        values.append(["counter", "whiiif_cache_hits_total", labels, stats["hits"]])
+        values.append(["counter", "whiiif_cache_misses_total", labels, stats["misses"]])
+        values.append(["counter", "whiiif_cache_evictions_total", labels, stats["evictions"]])
+        if "size" in stats:  # the SQLite cache's size is shared, so it's read when the metrics are rendered instead
+            values.append(["gauge", "whiiif_cache_entries", labels, stats["size"]])
+    image_cache = manifests.canvas_image_cache()
+    values.append(["counter", "whiiif_manifest_cache_hits_total", [], image_cache.hits])
+    values.append(["counter", "whiiif_manifest_cache_misses_total", [], image_cache.misses])
+    for mode, flights in (("threaded", coalesce.flights), ("async", coalesce.async_flights)):
+        stats = flights.stats()
+        labels = [["mode", mode]]
+        values.append(["counter", "whiiif_solr_queries_total", labels, stats["leaders"]])
+        values.append(["counter", "whiiif_solr_coalesced_total", labels, stats["coalesced"]])
+        values.append(["gauge", "whiiif_solr_in_flight", labels, stats["in_flight"]])
+    return values
+
+
+def shared_values():
+    values = []
+    for name, response_cache in sorted(cache.caches().items()):
+        if not isinstance(response_cache, cache.MemoryCache):
+            values.append(["gauge", "whiiif_cache_entries", [["cache", name]], response_cache.stats()["size"]])
+    return values
+
+
+def snapshot_path(pid):
+    return path.join(app.config["METRICS_DIR"], "whiiif_metrics_{}.json".format(pid))
+
+
+def flush():
+    """Write this process's metrics snapshot to METRICS_DIR, replacing its previous one atomically"""
+    with registry.flush_lock:
+        manifests.replace_file(snapshot_path(os.getpid()), json.dumps(registry.snapshot()).encode("utf8"))
+
+
+@atexit.register
+def flush_at_exit():
+    """Write a last snapshot as the process exits, so that a recycled worker's latest requests aren't lost"""
+    if enabled() and app.config["METRICS_DIR"] and registry.histograms:
+        try:
+            flush()
+        except OSError as e:
+            app.logger.error("Couldn't write metrics snapshot: {}".format(e))
+
+
+def process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        pass
+    return True
+
+
+def snapshots():
+    """Return the metrics snapshots of every process: this one, and those in METRICS_DIR if it's set"""
+    own = registry.snapshot()
+    if not app.config["METRICS_DIR"]:
+        return [own]
+    found = [own]
+    for snapshot_file in glob.glob(path.join(app.config["METRICS_DIR"], "whiiif_metrics_*.json")):
+        try:
+            with open(snapshot_file, "r", encoding="utf8") as metrics_file:
+                snapshot = json.load(metrics_file)
+        except (OSError, ValueError) as e:
+            app.logger.warning("Skipping unreadable metrics snapshot {}: {}".format(snapshot_file, e))
+            continue
+        if snapshot["pid"] != own["pid"]:
+            found.append(snapshot)
+    return found
+
+
+def aggregate(all_snapshots):
+    """Add up the histograms and counters of every snapshot, and the gauges of those from live processes"""
+    hists = {}
+    values = {}
+    for snapshot in all_snapshots:
+        for name, labels, counts, total in snapshot["histograms"]:
+            key = (name, tuple(tuple(label) for label in labels))
+            if key in hists:
+                hists[key] = ([a + b for a, b in zip(hists[key][0], counts)], hists[key][1] + total)
+            else:
+                hists[key] = (counts, total)
+        live = snapshot["pid"] == os.getpid() or process_alive(snapshot["pid"])
+        for kind, name, labels, value in snapshot["values"]:
+            if kind == "gauge" and not live:
+                continue
+            key = (name, tuple(tuple(label) for label in labels))
+            values[key] = values.get(key, 0) + value
+    return hists, values
+
+
+def format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(name, str(value).replace("\\", "\\\\").replace('"', '\\"')
+                                           .replace("\n", "\\n")) for name, value in pairs) + "}"
+
+
+def format_bound(bound):
+    return "{:g}".format(bound) if isinstance(bound, float) else str(bound)
+
+
+def render():
+    """Render the metrics of every process in the Prometheus text exposition format"""
+    all_snapshots = snapshots()
+    all_snapshots.append({"pid": os.getpid(), "histograms": [], "values": shared_values()})
+    hists, values = aggregate(all_snapshots)
+
+    lines = []
+    for name, (buckets, help_text) in histograms.items():
+        lines.append("# HELP {} {}".format(name, help_text))
+        lines.append("# TYPE {} histogram".format(name))
+        for (hist_name, labels), (counts, total) in sorted(hists.items()):
+            if hist_name != name:
+                continue
+            cumulative = 0
+            for bound, count in zip(buckets, counts):
+                cumulative += count
+                lines.append("{}_bucket{} {}".format(name, format_labels(labels, [("le", format_bound(bound))]),
+                                                     cumulative))
+            cumulative += counts[-1]
+            lines.append("{}_bucket{} {}".format(name, format_labels(labels, [("le", "+Inf")]), cumulative))
+            lines.append("{}_sum{} {}".format(name, format_labels(labels), total))
+            lines.append("{}_count{} {}".format(name, format_labels(labels), cumulative))
+    for kind, described in (("counter", counters), ("gauge", gauges)):
+        for name, help_text in described.items():
+            lines.append("# HELP {} {}".format(name, help_text))
+            lines.append("# TYPE {} {}".format(name, kind))
+            for (value_name, labels), value in sorted(values.items()):
+                if value_name == name:
+                    lines.append("{}{} {}".format(name, format_labels(labels), value))
+    return "\n".join(lines) + "\n"
+
+
+def reset():
+    """Forget every recorded histogram (for tests)"""
+    global registry
+    registry = Registry()
@@ -0,0 +1,145 @@
+""" pages.py: per-page byte-offset indexes of the normalized OCR files written by the indexer """
+
+import struct
+from os import path
+
+from whiiif import app
+from whiiif.manifests import replace_file
+
+# Page index files are written by the indexer alongside each normalized OCR file, so that a page can be found (and
+# read, with a single seek) without parsing the whole file. Layout (little-endian):
+#   b"WPIX", uint32 page count N, N (uint64 start, uint64 end) byte ranges of each <Page> element in the OCR file,
+#   (N + 1) uint32 offsets into the string table, string table of UTF-8 page IDs
+# then, optionally (older indexes stop after the page IDs):
+#   b"WBLK", uint32 block count M, M (uint32 page position, uint64 start, uint64 end) of each <TextBlock> and
+#   <ComposedBlock> element, (M + 1) uint32 offsets into the string table, string table of UTF-8 block IDs
+# Pages are in document order, so a page's position in the index is its position in the document.
+PAGE_INDEX_MAGIC = b"WPIX"
+BLOCK_INDEX_MAGIC = b"WBLK"
+_header = struct.Struct("<4sI")
+_range = struct.Struct("<QQ")
+_block_range = struct.Struct("<IQQ")
+_offset = struct.Struct("<I")
+
+
+def _read_strings(data, offsets_start, count):
+    """Return the strings of a string table, and the offset just past it"""
+    offsets = struct.unpack_from("<{}I".format(count + 1), data, offsets_start)
+    strings_start = offsets_start + (count + 1) * _offset.size
+    return ([data[strings_start + offsets[idx]:strings_start + offsets[idx + 1]].decode("utf8")
+             for idx in range(count)], strings_start + offsets[count])
+
+
+def _string_table(strings):
+    encoded = [string.encode("utf8") for string in strings]
+    offsets = [0]
+    for string in encoded:
+        offsets.append(offsets[-1] + len(string))
+    return struct.pack("<{}I".format(len(offsets)), *offsets) + b"".join(encoded)
+
+
+class PageIndex(object):
+    """Page ID -> (position, byte range) and block ID -> (page position, byte range) lookup for one document's OCR
+    file, loaded whole as it's only small"""
+
+    def __init__(self, index_path, ocr_path=None):
+        self.index_path = index_path
+        self.ocr_path = ocr_path
+        with open(index_path, "rb") as index_file:
+            data = index_file.read()
+        magic, count = _header.unpack_from(data)
+        if magic != PAGE_INDEX_MAGIC:
+            raise ValueError("Not a page index file: {}".format(index_path))
+        ranges_start = _header.size
+        ranges = struct.unpack_from("<{}Q".format(2 * count), data, ranges_start)
+        self.ids, blocks_start = _read_strings(data, ranges_start + count * _range.size, count)
+        self.ranges = [(ranges[2 * idx], ranges[2 * idx + 1]) for idx in range(count)]
+        self._positions = {page_id: idx for idx, page_id in enumerate(self.ids)}
+
+        self._blocks = {}
+        if len(data) > blocks_start:
+            magic, block_count = _header.unpack_from(data, blocks_start)
+            if magic != BLOCK_INDEX_MAGIC:
+                raise ValueError("Bad block index in page index file: {}".format(index_path))
+            ranges_start = blocks_start + _header.size
+            block_ids, _ = _read_strings(data, ranges_start + block_count * _block_range.size, block_count)
+            for idx, block_id in enumerate(block_ids):
+                self._blocks[block_id] = _block_range.unpack_from(data, ranges_start + idx * _block_range.size)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, page_id):
+        return page_id in self._positions
+
+    def position(self, page_id):
+        """Return the 0-based position of a page in the document, raising KeyError for an unknown page ID"""
+        return self._positions[page_id]
+
+    def byte_range(self, page_id):
+        return self.ranges[self._positions[page_id]]
+
+    def block_page(self, block_id):
+        """Return the 0-based position of the page a block is on, raising KeyError for an unknown block ID"""
+        return self._blocks[block_id][0]
+
+    def block_range(self, block_id):
+        return self._blocks[block_id][1:]
+
+    def read(self, page_id):
+        """Return the normalized OCR of a single page, as bytes"""
+        return self._read_range(*self.byte_range(page_id))
+
+    def read_block(self, block_id):
+        """Return the normalized OCR of a single block, as bytes"""
+        return self._read_range(*self.block_range(block_id))
+
+    def _read_range(self, start, end):
+        with open(self.ocr_path, "rb") as ocr_file:
+            ocr_file.seek(start)
+            return ocr_file.read(end - start)
+
+
+def ocr_path(document):
+    return path.join(app.config["XML_LOCATION"], document) + "_escaped.xml"
+
+
+def page_index_path(document):
+    return path.join(app.config["XML_LOCATION"], document) + ".pages"
+
+
+def write_page_index(index_path, pages, blocks=()):
+    """Write a page index file for a sequence of (page ID, start, end), and optionally one of (block ID, page position,
+    start, end), replacing any existing one atomically"""
+    parts = [_header.pack(PAGE_INDEX_MAGIC, len(pages))]
+    parts.extend(_range.pack(start, end) for page_id, start, end in pages)
+    parts.append(_string_table(page_id for page_id, start, end in pages))
+    if blocks:
+        parts.append(_header.pack(BLOCK_INDEX_MAGIC, len(blocks)))
+        parts.extend(_block_range.pack(page, start, end) for block_id, page, start, end in blocks)
+        parts.append(_string_table(block_id for block_id, page, start, end in blocks))
+    replace_file(index_path, b"".join(parts))
+
+
+def page_lookup(document):
+    """Return the page index for a document, or None if it was indexed without one"""
+    try:
+        return PageIndex(page_index_path(document), ocr_path(document))
+    except (OSError, ValueError, struct.error):
+        return None
+
+
+def canvas_number(page_id, page_index=None):
+    """Return the canvas number for an OCR page ID.
+
+    IDs of the form page_N are canvas N, as they always have been; any other ID is looked up in the document's page
+    index, by its position in the document. Raises ValueError if the page can't be placed.
+    """
+    if page_id.startswith("page_"):
+        try:
+            return int(page_id[5:])
+        except ValueError:
+            pass
+    if page_index is not None and page_id in page_index:
+        return page_index.position(page_id)
+    raise ValueError("Can't find the canvas for page {}".format(page_id))
@@ -0,0 +1,135 @@
+""" profiling.py: profiles a sample of search requests, keeping those of the slow ones for diagnosis
+
+A fraction (PROFILE_SAMPLE_RATE) of requests to the search, snippet and collection views are run under cProfile. If
+one takes PROFILE_THRESHOLD seconds or more, its profile is written to LOG_DIR along with what was asked for: the
+request URL, the SOLR query, and the number of hits. Only one request per process is profiled at a time, so the
+overhead is bounded by the sample rate, and a profile isn't muddled by another request's calls. In the async serving
+mode a profile covers whatever else the event loop ran while the request was waiting on SOLR.
+
+Load a profile with pstats, or view it with a tool such as snakeviz; the .txt file next to it lists the request
+details and the functions with the most cumulative time.
+"""
+
+import contextvars
+import cProfile
+import functools
+import inspect
+import io
+import json
+import os
+import pstats
+import random
+import threading
+import time
+from os import path
+
+from flask import has_request_context, request
+
+from whiiif import app
+
+_details = contextvars.ContextVar("whiiif_profile_details", default=None)
+_lock = threading.Lock()  # held by the request being profiled
+
+
+def sampled():
+    rate = app.config["PROFILE_SAMPLE_RATE"]
+    return rate > 0 and (rate >= 1 or random.random() < rate)
+
+
+def note(**details):
+    """Record details of the current request, for its profile if it's being profiled"""
+    current = _details.get()
+    if current is not None:
+        current.update(details)
+
+
+def request_details(endpoint, args, kwargs):
+    details = {"endpoint": endpoint}
+    if has_request_context():
+        details["url"] = request.full_path
+    elif args and hasattr(args[0], "path_qs"):  # an aiohttp request
+        details["url"] = args[0].path_qs
+        details.update(args[0].match_info)
+    details.update(kwargs)
+    return details
+
+
+def profiled(endpoint):
+    """Decorate a view (or aiohttp handler) to profile a sample of its requests, keeping the profiles of slow ones"""
+    def decorator(view):
+        if inspect.iscoroutinefunction(view):
+            @functools.wraps(view)
+            async def async_wrapper(*args, **kwargs):
+                if not sampled() or not _lock.acquire(blocking=False):
+                    return await view(*args, **kwargs)
+                profile, token, start = begin(request_details(endpoint, args, kwargs))
+                try:
+                    return await view(*args, **kwargs)
+                finally:
+                    end(profile, token, start)
+            return async_wrapper
+
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            if not sampled() or not _lock.acquire(blocking=False):
+                return view(*args, **kwargs)
+            profile, token, start = begin(request_details(endpoint, args, kwargs))
+            try:
+                return view(*args, **kwargs)
+            finally:
+                end(profile, token, start)
+        return wrapper
+    return decorator
+
+
+def begin(details):
+    token = _details.set(details)
+    profile = cProfile.Profile()
+    start = time.perf_counter()
+    try:
+        profile.enable()
+    except ValueError:  # another profiler (or debugger) is already active
+        profile = None
+    return profile, token, start
+
+
+def end(profile, token, start):
+    elapsed = time.perf_counter() - start
+    details = _details.get()
+    _details.reset(token)
+    try:
+        if profile is None:
+            return
+        profile.disable()
+        if elapsed >= app.config["PROFILE_THRESHOLD"]:
+            details["seconds"] = round(elapsed, 6)
+            try:
+                profile_path = dump(profile, details)
+            except OSError as e:
+                app.logger.error("Couldn't write request profile: {}".format(e))
+            else:
+                app.logger.warning("Slow {} request ({:.2f}s) profiled to {}".format(details["endpoint"], elapsed,
+                                                                                   profile_path))
+    finally:
+        _lock.release()
+
+
+def dump(profile, details):
+    """Write a profile and its request details to LOG_DIR, returning the path of the profile"""
+    now = time.time()
+    details["time"] = time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(now))
+    details["pid"] = os.getpid()
+    name = "whiiif-profile-{}-{}{:03d}-{}".format(details["endpoint"],
+                                                  time.strftime("%Y%m%d-%H%M%S", time.localtime(now)),
+                                                  int(now * 1000) % 1000, os.getpid())
+    profile_path = path.join(app.config["LOG_DIR"], name + ".prof")
+    profile.dump_stats(profile_path)
+
+    summary = io.StringIO()
+    for key, value in details.items():
+        summary.write("{}: {}\n".format(key, value if isinstance(value, str) else json.dumps(value)))
+    summary.write("\n")
+    pstats.Stats(profile, stream=summary).sort_stats("cumulative").print_stats(app.config["PROFILE_SUMMARY_LINES"])
+    with open(path.join(app.config["LOG_DIR"], name + ".txt"), "w", encoding="utf8") as summary_file:
+        summary_file.write(summary.getvalue())
+    return profile_path
@@ -0,0 +1,111 @@
+""" query.py: SOLR query builder, with each endpoint's static parameters encoded once
+
+A SOLR query for one of the endpoints is mostly made up of parameters fixed by the app config (highlighter settings,
+fields and row limits), plus a few that change per request (q, fq and snippet counts). The static part is urlencoded
+the first time an endpoint is used and reused for every request after that, so a request only encodes its own
+parameters. Queries are sent as POST form bodies, so that long queries don't run into URL length limits, and the
+parameters are always in the same order so that identical searches reach SOLR (and its queryResultCache) identically.
+"""
+
+import threading
+from collections import namedtuple
+from urllib.parse import urlencode
+
+from whiiif import app
+
+SolrQuery = namedtuple("SolrQuery", ["url", "data"])
+
+
+class QueryTemplate(object):
+    """The select url and pre-encoded static parameters for one endpoint's SOLR query"""
+
+    def __init__(self, url, static_params):
+        self.url = url
+        self.static_data = urlencode(static_params)
+
+    def build(self, params):
+        return SolrQuery(self.url, "{}&{}".format(self.static_data, urlencode(params)))
+
+
+def search_params():
+    return [("hl", "on"),
+            ("hl.ocr.absoluteHighlights", "true"),
+            ("hl.weightMatches", "true"),
+            ("hl.ocr.limitBlock", "page"),
+            ("hl.ocr.contextSize", 1),
+            ("hl.ocr.contextBlock", "word"),
+            ("df", app.config["OCR_TEXT_FIELD"]),
+            ("hl.ocr.fl", app.config["OCR_TEXT_FIELD"])]
+
+
+def collection_params():
+    return [("hl", "on"),
+            ("hl.weightMatches", "true"),
+            ("rows", app.config["COLLECTION_MAX_RESULTS"]),
+            ("df", app.config["OCR_TEXT_FIELD"]),
+            ("hl.ocr.fl", app.config["OCR_TEXT_FIELD"]),
+            ("hl.snippets", app.config["COLLECTION_MAX_DOCUMENT_RESULTS"]),
+            ("hl.ocr.contextBlock", app.config["COLLECTION_SNIPPET_CONTEXT"]),
+            ("hl.ocr.contextSize", app.config["COLLECTION_SNIPPET_CONTEXT_SIZE"]),
+            ("hl.ocr.limitBlock", app.config["COLLECTION_SNIPPET_CONTEXT_LIMIT"])]
+
+
+def snippets_params():
+    return [("hl", "on"),
+            ("hl.weightMatches", "true"),
+            ("df", app.config["OCR_TEXT_FIELD"]),
+            ("hl.ocr.fl", app.config["OCR_TEXT_FIELD"]),
+            ("hl.ocr.contextBlock", app.config["SNIPPET_CONTEXT"]),
+            ("hl.ocr.contextSize", app.config["SNIPPET_CONTEXT_SIZE"]),
+            ("hl.ocr.limitBlock", app.config["SNIPPET_CONTEXT_LIMIT"])]
+
+
+template_params = {"search": search_params,
+                   "collection": collection_params,
+                   "snippets": snippets_params}
+
+_templates = {}
+_templates_lock = threading.Lock()
+
+
+def select_url():
+    return "{}/{}/select".format(app.config["SOLR_URL"], app.config["SOLR_CORE"])
+
+
+def get_template(name):
+    """Return the named endpoint's query template, building it from the app config on first use"""
+    template = _templates.get(name)
+    if template is None:
+        with _templates_lock:
+            template = _templates.get(name)
+            if template is None:
+                template = _templates[name] = QueryTemplate(select_url(), template_params[name]())
+    return template
+
+
+def reset():
+    """Throw away the templates, so that they are rebuilt from the (possibly changed) app config"""
+    _templates.clear()
+
+
+def document_filter(document):
+    return "{}:{}".format(app.config["DOCUMENT_ID_FIELD"], document)
+
+
+def search(manifest, q, snippets):
+    return get_template("search").build([("hl.snippets", snippets), ("fq", document_filter(manifest)), ("q", q)])
+
+
+def collection(q):
+    return get_template("collection").build([("q", q)])
+
+
+def snippets(document, q, snips):
+    return get_template("snippets").build([("hl.snippets", snips), ("fq", document_filter(document)), ("q", q)])
+
+
+def snippets_batch(documents, q, snips):
+    """Build one Snippet Search query over several documents, filtered with SOLR's terms query parser"""
+    terms_filter = "{{!terms f={}}}{}".format(app.config["DOCUMENT_ID_FIELD"], ",".join(documents))
+    return get_template("snippets").build([("hl.snippets", snips), ("rows", len(documents)), ("fq", terms_filter),
+                                           ("q", q)])
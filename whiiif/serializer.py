@@ -0,0 +1,66 @@
+""" serializer.py: JSON encoding and decoding for responses and SOLR results, using the fastest installed backend
+
+orjson is preferred, then ujson, falling back to the standard library json module. Every backend writes the same
+compact, UTF-8 (not ASCII-escaped) JSON, so responses don't change depending on what is installed. Use the module
+level functions (`serializer.dumps(...)`), as `use()` rebinds them when the backend changes.
+"""
+
+import json
+
+from whiiif import app
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+
+def _json_dumps(obj):
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":"))
+
+
+def _json_dumpb(obj):
+    return _json_dumps(obj).encode("utf8")
+
+
+def _orjson_dumps(obj):
+    return orjson.dumps(obj).decode("utf8")
+
+
+def _ujson_dumps(obj):
+    return ujson.dumps(obj, ensure_ascii=False, escape_forward_slashes=False)
+
+
+def _ujson_dumpb(obj):
+    return _ujson_dumps(obj).encode("utf8")
+
+
+backends = {"json": (_json_dumps, _json_dumpb, json.loads)}
+if ujson is not None:
+    backends["ujson"] = (_ujson_dumps, _ujson_dumpb, ujson.loads)
+if orjson is not None:
+    backends["orjson"] = (_orjson_dumps, orjson.dumps, orjson.loads)
+
+backend = None
+dumps = None  # object -> str
+dumpb = None  # object -> UTF-8 bytes, for response bodies
+loads = None  # str or bytes -> object
+
+
+def use(name="auto"):
+    """Switch to the named backend, or the fastest installed one for 'auto'"""
+    global backend, dumps, dumpb, loads
+    if name == "auto":
+        name = next(name for name in ("orjson", "ujson", "json") if name in backends)
+    if name not in backends:
+        raise ValueError("JSON backend {} is not installed".format(name))
+    backend = name
+    dumps, dumpb, loads = backends[name]
+
+
+use(app.config["JSON_BACKEND"])
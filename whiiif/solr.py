@@ -0,0 +1,72 @@
+""" solr.py: pooled, keep-alive HTTP client shared by all of the views for talking to SOLR """
+
+import os
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from whiiif import app
+
+_session = None
+_session_pid = None
+_session_lock = threading.Lock()
+
+
+def make_session():
+    """Build a requests Session with a connection pool and retry policy taken from the app config"""
+    retries = Retry(total=app.config["SOLR_RETRIES"],
+                    backoff_factor=app.config["SOLR_RETRY_BACKOFF"],
+                    status_forcelist=(502, 503, 504),
+                    allowed_methods=frozenset(["GET", "POST"]),
+                    raise_on_status=False)
+    adapter = HTTPAdapter(pool_connections=app.config["SOLR_POOL_CONNECTIONS"],
+                          pool_maxsize=app.config["SOLR_POOL_MAXSIZE"],
+                          max_retries=retries)
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def get_session():
+    """Return the Session for this process, creating it on first use.
+
+    Sessions are never shared across a fork: pre-fork WSGI servers (gunicorn, uwsgi) import the app in the master
+    process, so a child that inherits a Session would otherwise share the master's sockets.
+    """
+    global _session, _session_pid
+    pid = os.getpid()
+    if _session is None or _session_pid != pid:
+        with _session_lock:
+            if _session is None or _session_pid != pid:
+                _session = make_session()
+                _session_pid = pid
+    return _session
+
+
+def reset_session():
+    """Drop the current Session, so that the next request builds a fresh one"""
+    global _session, _session_pid
+    _session = None
+    _session_pid = None
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=reset_session)
+
+
+def timeout():
+    return app.config["SOLR_CONNECT_TIMEOUT"], app.config["SOLR_READ_TIMEOUT"]
+
+
+def post(url, data, **kwargs):
+    """POST a SOLR query as a urlencoded form body through the pooled Session, applying the configured timeouts.
+
+    The body is streamed, so that it can be parsed as it arrives; reading `.content` still loads it all at once.
+    """
+    kwargs.setdefault("timeout", timeout())
+    kwargs.setdefault("stream", True)
+    kwargs.setdefault("headers", {"Content-Type": "application/x-www-form-urlencoded; charset=UTF-8"})
+    return get_session().post(url, data=data.encode("utf8"), **kwargs)
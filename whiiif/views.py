@@ -1,12 +1,15 @@
-import json
+import math
 import re
 from os import path
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
 
 import bleach
 import requests
-from flask import render_template, request
+import urllib3
+from flask import abort, render_template, request
 
-from whiiif import app
+from whiiif import (app, cache, coalesce, geometry, highlights, manifests, metrics, pages, profiling, query, serializer,
+                    solr)
 
 
 @app.route('/')
@@ -15,82 +18,310 @@ def index():
     return render_template('index.html')
 
 
-@app.route('/search/<manifest>')
-def search(manifest):
-    app.logger.info("Processing IIIF Search request for document {}".format(manifest))
+@app.route('/metrics')
+def prometheus_metrics():
+    if not metrics.enabled():
+        abort(404)
+    return app.response_class(response=metrics.render(), content_type=metrics.CONTENT_TYPE)
+
+
+def json_response(body):
+    with metrics.stage("encode"):
+        body = serializer.dumpb(body)
+    metrics.observe_size(len(body))
+    return app.response_class(
+        response=body,
+        mimetype='application/json',
+        headers=[('Access-Control-Allow-Origin', '*')]
+    )
+
 
-    q = bleach.clean(request.args.get("q", default=""), strip=True, tags=[])
+def search_params(manifest, args):
+    """Clean up the document id and query for a IIIF Search request, and find the unimplemented params it used"""
+    q = bleach.clean(args.get("q", default=""), strip=True, tags=[])
     manifest_regexp = re.compile(r'[^A-Za-z0-9-_]')
     manifest = manifest_regexp.sub("", manifest)
     unimplemented = {"motivation", "date", "user"}
-    ignored = list(set(request.args.keys()) & unimplemented)
+    ignored = list(set(args.keys()) & unimplemented)
 
-    app.logger.debug("Request original q: {}".format(request.args.get("q", default="")))
+    app.logger.debug("Request original q: {}".format(args.get("q", default="")))
     app.logger.debug("Request bleached q: {}".format(q))
     app.logger.debug("Regexed manifest ID: {}".format(manifest))
+    return manifest, q, ignored
 
-    query_url = "{}/{}".format(app.config["SOLR_URL"], app.config["SOLR_CORE"])
-    query_url += "/select?hl=on&hl.ocr.absoluteHighlights=true&hl.weightMatches=true"
-    query_url += "&hl.ocr.limitBlock=page&hl.ocr.contextSize=1&hl.ocr.contextBlock=word"
-    query_url += "&df={}".format(app.config["OCR_TEXT_FIELD"])
-    query_url += "&hl.ocr.fl={}".format(app.config["OCR_TEXT_FIELD"])
-    query_url += "&hl.snippets={}".format(app.config["WITHIN_MAX_RESULTS"])
-    query_url += "&fq={0}:{1}".format(app.config["DOCUMENT_ID_FIELD"], manifest)
-    query_url += "&q={}".format(q)
-
-    app.logger.info("Built query: {}".format(query_url))
 
+def search_page(args):
+    """Return the requested page of IIIF Search results, or 0 if paging is off or the page isn't a number"""
+    if app.config["SEARCH_PAGE_SIZE"] <= 0:
+        return 0
     try:
-        solr_results = requests.get(query_url)
+        return max(int(args.get("page", default=0)), 0)
+    except ValueError:
+        return 0
+
+
+def search_snippets(page):
+    """Return how many snippets SOLR has to highlight to produce the requested page.
+
+    Pages are counted in hits, as startIndex and total are. Every snippet has at least one hit, so the first
+    (page + 1) * SEARCH_PAGE_SIZE snippets hold all of the hits up to the end of the page. The ocrhighlighting plugin
+    has no offset for snippets, though, so SOLR highlights every snippet before the page too: page N costs as much as
+    N + 1 pages, and the deepest pages cost as much as an unpaged search of WITHIN_MAX_RESULTS.
+    """
+    page_size = app.config["SEARCH_PAGE_SIZE"]
+    if page_size <= 0:
+        return app.config["WITHIN_MAX_RESULTS"]
+    return min((page + 1) * page_size, app.config["WITHIN_MAX_RESULTS"])
+
+
+def search_hits(page):
+    """Return the index of the first hit on the requested page, and how many hits it holds (None if paging is off)"""
+    page_size = app.config["SEARCH_PAGE_SIZE"]
+    if page_size <= 0:
+        return 0, None
+    return page * page_size, page_size
+
+
+def search_paging(search_id, page, hit_count, start_index):
+    """Build the IIIF Search paging properties for a page of results, or None if paging is off.
+
+    Pages hold SEARCH_PAGE_SIZE hits. The hit count is SOLR's total, or the hits counted in the snippets read if that's
+    more, so while a page's startIndex is exact, last can move further on as deeper pages find snippets with more than
+    one hit.
+    """
+    page_size = app.config["SEARCH_PAGE_SIZE"]
+    if page_size <= 0:
+        return None
+    last_page = max(math.ceil(min(hit_count, app.config["WITHIN_MAX_RESULTS"]) / page_size) - 1, 0)
+    paging = {"first": page_url(search_id, 0),
+              "last": page_url(search_id, last_page),
+              "startIndex": start_index}
+    if page < last_page:
+        paging["next"] = page_url(search_id, page + 1)
+    if page > 0:
+        paging["prev"] = page_url(search_id, min(page - 1, last_page))
+    return paging
+
+
+def cached_search_response(cached, search_id, page):
+    """Address a cached IIIF Search response to the request serving it.
+
+    Its @id and paging links were built from the URL of the request that filled the cache, which can have a different
+    host or spelling of the query, so they're rebuilt from search_id.
+    """
+    hit_count, start_index = cached["within"]["total"], cached.get("startIndex", 0)
+    response = annotation_list_base(hit_count, cached["within"]["ignored"], search_id,
+                                    search_paging(search_id, page, hit_count, start_index))
+    response.update((key, value) for key, value in cached.items() if key not in _paged_keys)
+    return response
+
+
+_paged_keys = {"@id", "within", "next", "prev", "startIndex"}
+
+
+def page_url(url, page):
+    scheme, netloc, url_path, query, fragment = urlsplit(url)
+    args = [(key, value) for key, value in parse_qsl(query, keep_blank_values=True) if key != "page"]
+    args.append(("page", str(page)))
+    return urlunsplit((scheme, netloc, url_path, urlencode(args), fragment))
+
+
+@metrics.stage("query")
+def search_query(manifest, q, snippets=None):
+    if snippets is None:
+        snippets = app.config["WITHIN_MAX_RESULTS"]
+
+    solr_query = query.search(manifest, q, snippets)
+    log_query(solr_query)
+    return solr_query
+
+
+def log_query(solr_query):
+    app.logger.info("Built query: {}?{}".format(*solr_query))
+    profiling.note(solr_query="{}?{}".format(*solr_query))
+
+
+def solr_docs(results_json):
+    app.logger.debug("Solr JSON response code: {}".format(results_json["responseHeader"]["status"]))
+    return results_json["response"]["docs"]
+
+
+def fetch_json(solr_query):
+    """POST a query to SOLR and decode the response, sharing it with identical concurrent requests"""
+    def run():
+        with metrics.stage("solr"):
+            solr_results = solr.post(*solr_query)
         app.logger.debug("Solr request response code: {}".format(solr_results.status_code))
-        results_json = solr_results.json()
-        app.logger.debug("Solr JSON response code: {}".format(results_json["responseHeader"]["status"]))
-        docs = results_json["response"]["docs"]
-    except (requests.exceptions.ConnectionError, ConnectionRefusedError, KeyError, ValueError, AttributeError) as e:
-        app.logger.error("Error occurred with SOLR query: {}".format(type(e)))
-        app.logger.error("Error message: {}".format(e))
-        results_json = {}
-        docs = []
+        with metrics.stage("parse"):
+            return serializer.loads(solr_results.content)
+    return coalesce.flights.do(("json", solr_query), run)
+
 
+def fetch_search_results(solr_query, first_hit=0, hit_limit=None):
+    """POST a IIIF Search query to SOLR and read its hits, sharing them with identical concurrent requests"""
+    def run():
+        with metrics.stage("solr"):
+            solr_results = solr.post(*solr_query)
+        app.logger.debug("Solr request response code: {}".format(solr_results.status_code))
+        with metrics.stage("parse"):
+            return read_search_results(solr_results, first_hit, hit_limit)
+    return coalesce.flights.do(("search", solr_query, first_hit, hit_limit), run)
+
+
+def log_solr_error(e):
+    app.logger.error("Error occurred with SOLR query: {}".format(type(e)))
+    app.logger.error("Error message: {}".format(e))
+
+
+def stream_response(chunks):
+    return app.response_class(
+        response=chunks,
+        mimetype='application/json',
+        headers=[('Access-Control-Allow-Origin', '*')]
+    )
+
+
+@app.route('/search/<manifest>')
+@metrics.timed("search")
+@profiling.profiled("search")
+def search(manifest):
+    app.logger.info("Processing IIIF Search request for document {}".format(manifest))
+
+    manifest, q, ignored = search_params(manifest, request.args)
+    page = search_page(request.args)
+
+    cache_key = cache.search_key(manifest, q, ignored, page)
+    cached = cache.get_cache("search").get(cache_key)
+    if cached is not None:
+        app.logger.info("Serving cached IIIF Search response for document {}".format(manifest))
+        return json_response(cached_search_response(cached, request.url, page))
+
+    solr_query = search_query(manifest, q, search_snippets(page))
+
+    try:
+        results, total_results, start_index = fetch_search_results(solr_query, *search_hits(page))
+        cacheable = True
+    except (requests.exceptions.RequestException, ConnectionRefusedError, KeyError, ValueError, AttributeError,
+            highlights.ParseError) as e:
+        log_solr_error(e)
+        results, total_results, start_index = [], 0, 0
+        cacheable = False
+    metrics.observe_hits(len(results))
+
+    paging = search_paging(request.url, page, total_results, start_index)
+    if stream_annotations(len(results)):
+        app.logger.info("Streaming IIIF Search response with {} hits".format(len(results)))
+        return stream_response(iter_annotations(results, total_results, ignored, request.url,
+                                                app.config["SEARCH_STREAM_CHUNK_SIZE"], paging))
+
+    response_dict = make_annotations(results, total_results, ignored, paging=paging)
+    if cacheable:
+        cache.get_cache("search").set(cache_key, response_dict)
+
+    return json_response(response_dict)
+
+
+def read_search_results(solr_results, first_hit=0, hit_limit=None):
+    """Turn a streamed IIIF Search SOLR response into hits, parsing it as it arrives when ijson is available"""
+    if highlights.streaming_enabled():
+        solr_results.raw.decode_content = True
+        try:
+            return highlights.SearchResultsParser(first_hit, hit_limit).parse(solr_results.raw)
+        # reading the raw body skips requests' own wrapping of urllib3's errors, so do it here
+        except urllib3.exceptions.ReadTimeoutError as e:
+            raise requests.exceptions.ReadTimeout(e)
+        except urllib3.exceptions.HTTPError as e:
+            raise requests.exceptions.ConnectionError(e)
+        finally:
+            solr_results.close()
+    results_json = serializer.loads(solr_results.content)
+    return search_results(results_json, solr_docs(results_json), first_hit, hit_limit)
+
+
+def search_results(results_json, docs, first_hit=0, hit_limit=None):
+    """Group the highlight parts of a IIIF Search SOLR response into hits.
+
+    Only the hits on the page of hit_limit hits (or all of them) from first_hit are kept; the others are only counted.
+    Returns the hits, the total hit count (SOLR's, or the number counted if more) and the index of the first returned
+    hit.
+    """
     results = []
     total_results = 0
+    hit_count = 0
     for doc in docs:
         block = results_json["ocrHighlighting"][doc[app.config["DOCUMENT_ID_FIELD"]]][app.config["OCR_TEXT_FIELD"]]
         snippets = block["snippets"]
         total_results += int(block["numTotal"])
         for fragment in snippets:
-            for highlight in fragment["highlights"]:
-                grouped_hls = []
-                for part in highlight:
-                    x = part["ulx"]
-                    y = part["uly"]
-                    w = part["lrx"] - part["ulx"]
-                    h = part["lry"] - part["uly"]
-                    if "scale" in doc:
-                        scale = doc["scale"]
-                    else:
-                        scale = 1
-                    grouped_hls.append({"manifest_id": doc[app.config["DOCUMENT_ID_FIELD"]],
-                                        "manifest_url": doc[app.config["MANIFEST_URL_FIELD"]],
-                                        "canvas_id": part["page"],
-                                        "coords": "{},{},{},{}".format(x, y, w, h),
-                                        "chars": part["text"],
-                                        "scale": scale})
-                results.append(grouped_hls)
-
-    response_dict = make_annotations(results, total_results, ignored)
-
-    response = app.response_class(
-        response=json.dumps(response_dict),
-        mimetype='application/json',
-        headers=[('Access-Control-Allow-Origin', '*')]
-    )
-    return response
+            on_page = highlights.page_highlights(fragment["highlights"], hit_count, first_hit, hit_limit)
+            hit_count += len(fragment["highlights"])
+            if on_page:
+                results.extend(highlights.fragment_hits(doc, on_page))
+    return results, max(total_results, hit_count), min(first_hit, hit_count)
+
+
+@metrics.stage("transform")
+def make_annotations(results, hit_count, ignored, search_id=None, paging=None):
+    if search_id is None:
+        search_id = request.url
+
+    anno_base = annotation_list_base(hit_count, ignored, search_id, paging)
+    anno_base["resources"] = []
+    anno_base["hits"] = []
 
+    for idx, result in enumerate(results, anno_base.get("startIndex", 0)):
+        anno_base["resources"].extend(hit_resources(idx, result))
+        anno_base["hits"].append(hit_base(idx, result))
+    return anno_base
 
-def make_annotations(results, hit_count, ignored):
-    search_id = request.url
 
+def iter_annotations(results, hit_count, ignored, search_id, chunk_size, paging=None):
+    """Yield the same JSON that make_annotations() serialises to, in chunks of roughly chunk_size characters.
+
+    Only one chunk of annotations is held in memory at a time: the resources are written out hit by hit, then the
+    hits block is built in a second pass over the results.
+    """
+    anno_base = annotation_list_base(hit_count, ignored, search_id, paging)
+    start_index = anno_base.get("startIndex", 0)
+    head = serializer.dumps(anno_base)
+    chunk = [head[:-1], ',"resources":[']
+    chunk_length = 0
+    separator = ""
+    for idx, result in enumerate(results, start_index):
+        for resource in hit_resources(idx, result):
+            encoded = serializer.dumps(resource)
+            chunk.append(separator)
+            chunk.append(encoded)
+            separator = ","
+            chunk_length += len(encoded)
+            if chunk_length >= chunk_size:
+                yield "".join(chunk)
+                chunk = []
+                chunk_length = 0
+    chunk.append('],"hits":[')
+    separator = ""
+    for idx, result in enumerate(results, start_index):
+        encoded = serializer.dumps(hit_base(idx, result))
+        chunk.append(separator)
+        chunk.append(encoded)
+        separator = ","
+        chunk_length += len(encoded)
+        if chunk_length >= chunk_size:
+            yield "".join(chunk)
+            chunk = []
+            chunk_length = 0
+    chunk.append("]}")
+    yield "".join(chunk)
+
+
+def stream_annotations(hit_count):
+    """Whether to stream a IIIF Search response rather than build it in memory, skipping the cache and the encode
+    and size metrics (so never, by default)"""
+    threshold = app.config["SEARCH_STREAM_THRESHOLD"]
+    return 0 <= threshold < hit_count
+
+
+def annotation_list_base(hit_count, ignored, search_id, paging=None):
     anno_base = {"@context": ["http://iiif.io/api/presentation/2/context.json",
                               "http://iiif.io/api/search/1/context.json"],
                  "@id": search_id,
@@ -98,85 +329,107 @@ def make_annotations(results, hit_count, ignored):
                  "within": {"@type": "sc:Layer",
                             "total": hit_count,
                             "ignored": ignored
-                            },
-                 "resources": [],
-                 "hits": []}
-
-    for idx, result in enumerate(results):
-        part_ids = []
-        part_chars = []
-        for in_idx, result_part in enumerate(result):
-            if in_idx > 0:
-                suffix = chr(97 + in_idx)
-            else:
-                suffix = ""
-            x, y, w, h = result_part["coords"].split(",")
-            if result_part["scale"] != 1:
-                x, y, w, h = int(x), int(y), int(w), int(h)
-                x, y, w, h = int(x * result_part["scale"]), int(y * result_part["scale"]), int(
-                    w * result_part["scale"]), int(h * result_part["scale"])
-                x, y, w, h = str(x), str(y), str(w), str(h)
-            result_base = {
-                "@id": "uun:whiiif:%s:%s:%s%s" % (result_part["manifest_id"], result_part["canvas_id"], idx, suffix),
-                "@type": "oa:Annotation",
-                "motivation": "sc:painting",
-                "resource": {"@type": "cnt:ContentAsText",
-                             "chars": result_part["chars"]},
-                "on": "{}/canvas/{}#xywh={}".format(result_part["manifest_url"], result_part["canvas_id"],
-                                                    ",".join([x, y, w, h]))
-            }
-            anno_base["resources"].append(result_base)
-            part_ids.append(result_base["@id"])
-            part_chars.append(result_part["chars"])
-
-        hit_base = {"@type": "search:Hit",
-                    "annotations": part_ids,
-                    "match": " ".join(part_chars)}
-        anno_base["hits"].append(hit_base)
+                            }}
+    if paging is not None:
+        anno_base["within"]["first"] = paging["first"]
+        anno_base["within"]["last"] = paging["last"]
+        for key in ("next", "prev", "startIndex"):
+            if key in paging:
+                anno_base[key] = paging[key]
     return anno_base
 
 
+def annotation_id(result_part, idx, in_idx):
+    if in_idx > 0:
+        suffix = chr(97 + in_idx)
+    else:
+        suffix = ""
+    return "uun:whiiif:%s:%s:%s%s" % (result_part.manifest_id, result_part.canvas_id, idx, suffix)
+
+
+def hit_resources(idx, result):
+    """Build the oa:Annotation resources for each part of a hit"""
+    resources = []
+    for in_idx, result_part in enumerate(result):
+        resources.append({
+            "@id": annotation_id(result_part, idx, in_idx),
+            "@type": "oa:Annotation",
+            "motivation": "sc:painting",
+            "resource": {"@type": "cnt:ContentAsText",
+                         "chars": result_part.chars},
+            "on": "%s/canvas/%s#xywh=%s,%s,%s,%s" % (result_part.manifest_url, result_part.canvas_id, result_part.x,
+                                                  result_part.y, result_part.w, result_part.h)
+        })
+    return resources
+
+
+def hit_base(idx, result):
+    return {"@type": "search:Hit",
+            "annotations": [annotation_id(result_part, idx, in_idx) for in_idx, result_part in enumerate(result)],
+            "match": " ".join(result_part.chars for result_part in result)}
+
+
+def collection_params(args):
+    q = bleach.clean(args.get("q"), strip=True, tags=[])
+
+    app.logger.debug("Request original q: {}".format(args.get("q", default="")))
+    app.logger.debug("Request bleached q: {}".format(q))
+    return q
+
+
+@metrics.stage("query")
+def collection_query(q):
+    solr_query = query.collection(q)
+    log_query(solr_query)
+    return solr_query
+
+
 @app.route("/collection/search")
+@metrics.timed("collection")
+@profiling.profiled("collection")
 def collection_search():
     app.logger.info("Processing Collection Search request")
 
-    q = bleach.clean(request.args.get("q"), strip=True, tags=[])
-
-    app.logger.debug("Request original q: {}".format(request.args.get("q", default="")))
-    app.logger.debug("Request bleached q: {}".format(q))
+    q = collection_params(request.args)
 
-    query_url = "{0}/{1}".format(app.config["SOLR_URL"], app.config["SOLR_CORE"])
-    query_url += "/select?hl=on&hl.weightMatches=true&rows={}".format(app.config["COLLECTION_MAX_RESULTS"])
-    query_url += "&df={}".format(app.config["OCR_TEXT_FIELD"])
-    query_url += "&hl.ocr.fl={}".format(app.config["OCR_TEXT_FIELD"])
-    query_url += "&hl.snippets={}".format(app.config["COLLECTION_MAX_DOCUMENT_RESULTS"])
-    query_url += "&hl.ocr.contextBlock={}".format(app.config["COLLECTION_SNIPPET_CONTEXT"])
-    query_url += "&hl.ocr.contextSize={}".format(app.config["COLLECTION_SNIPPET_CONTEXT_SIZE"])
-    query_url += "&hl.ocr.limitBlock={}".format(app.config["COLLECTION_SNIPPET_CONTEXT_LIMIT"])
-    query_url += "&q={}".format(q)
+    cache_key = cache.collection_key(q)
+    cached = cache.get_cache("collection").get(cache_key)
+    if cached is not None:
+        app.logger.info("Serving cached Collection Search response")
+        return json_response(cached)
 
-    app.logger.info("Built query: {}".format(query_url))
+    solr_query = collection_query(q)
 
     try:
-        solr_results = requests.get(query_url)
-        app.logger.debug("Solr request response code: {}".format(solr_results.status_code))
-        results_json = solr_results.json()
-        app.logger.debug("Solr JSON response code: {}".format(results_json["responseHeader"]["status"]))
-        docs = results_json["response"]["docs"]
-    except (requests.exceptions.ConnectionError, KeyError, ValueError) as e:
-        app.logger.error("Error occurred with SOLR query: {}".format(type(e)))
-        app.logger.error("Error message: {}".format(e))
+        results_json = fetch_json(solr_query)
+        docs = solr_docs(results_json)
+        cacheable = True
+    except (requests.exceptions.RequestException, KeyError, ValueError) as e:
+        log_solr_error(e)
         results_json = {}
         docs = []
+        cacheable = False
+
+    results, complete = collection_results(results_json, docs)
+    metrics.observe_hits(canvas_count(results))
+    if cacheable and complete:
+        cache.get_cache("collection").set(cache_key, results)
+
+    return json_response(results)
 
+
+@metrics.stage("transform")
+def collection_results(results_json, docs):
+    """Build the Collection Search results, returning them and whether every document's manifest could be found"""
+    complete = True
     results = []
     for doc in docs:
         try:
             manifest_path = path.join(app.config["MANIFEST_LOCATION"], doc[app.config["DOCUMENT_ID_FIELD"]]) + ".json"
-            mani_json = json.load(open(manifest_path, 'r'))
-            cvlist = mani_json["sequences"][0]["canvases"]
+            canvas_images = manifests.canvas_lookup(doc[app.config["DOCUMENT_ID_FIELD"]])
         except FileNotFoundError as e:
             app.logger.error("Missing manifest JSON file: {}".format(manifest_path))
+            complete = False
             continue
 
         result = {"id": doc[app.config["DOCUMENT_ID_FIELD"]],
@@ -187,76 +440,174 @@ def collection_search():
                   }
         snippets = results_json["ocrHighlighting"][doc[app.config["DOCUMENT_ID_FIELD"]]][app.config["OCR_TEXT_FIELD"]]["snippets"]
 
-        for fragment in snippets:
-            x = fragment["regions"][0]["ulx"]
-            y = fragment["regions"][0]["uly"]
-            w = fragment["regions"][0]["lrx"] - fragment["regions"][0]["ulx"]
-            h = fragment["regions"][0]["lry"] - fragment["regions"][0]["uly"]
-
-            cv = cvlist[int(fragment["regions"][0]["page"].replace("page_", ""))]
-            img = cv["images"][0]["resource"]["@id"]
+        regions = geometry.xywh([fragment["regions"][0] for fragment in snippets])
+        boxes = iter(geometry.xywh([part for fragment in snippets for highlight in fragment["highlights"]
+                                    for part in highlight], 0.25))
+        page_index = None
+        for fragment, (x, y, w, h) in zip(snippets, regions):
+            fragment_boxes = [next(boxes) for highlight in fragment["highlights"] for part in highlight]
+
+            page_id = fragment["regions"][0]["page"]
+            if page_index is None and not page_id.startswith("page_"):
+                page_index = pages.page_lookup(doc[app.config["DOCUMENT_ID_FIELD"]])
+            try:
+                img = canvas_images[pages.canvas_number(page_id, page_index)]
+            except (ValueError, IndexError):
+                img = None
+            if img is None:
+                app.logger.error("No image for canvas {} in manifest: {}".format(fragment["regions"][0]["page"],
+                                                                                 manifest_path))
+                continue
             frag = img.replace("/full/full", "/{},{},{},{}/{},".format(x, y, w, h, int(w / 4)), 1)
             canvas_doc = {"canvas": fragment["regions"][0]["page"],
                           "region": "{},{},{},{}".format(x, y, w, h),
                           "url": frag,
                           "highlights": []}
 
-            for highlight in fragment["highlights"]:
-                for part in highlight:
-                    x = int(part["ulx"] / 4)
-                    y = int(part["uly"] / 4)
-                    w = int((part["lrx"] - part["ulx"]) / 4)
-                    h = int((part["lry"] - part["uly"]) / 4)
-                    canvas_doc["highlights"].append({"coords": "{},{},{},{}".format(x, y, w, h),
-                                                     "chars": part["text"]})
+            parts = (part for highlight in fragment["highlights"] for part in highlight)
+            for part, (x, y, w, h) in zip(parts, fragment_boxes):
+                canvas_doc["highlights"].append({"coords": "{},{},{},{}".format(x, y, w, h),
+                                                 "chars": part["text"]})
             result["canvases"].append(canvas_doc)
         results.append(result)
+    return results, complete
 
-    response = app.response_class(
-        response=json.dumps(results),
-        mimetype='application/json',
-        headers=[('Access-Control-Allow-Origin', '*')]
-    )
-    return response
+
+def snippets_params(args):
+    q = bleach.clean(args.get("q", default=""), strip=True, tags=[])
+    snips = bleach.clean(args.get("snips", default=str(app.config["SNIPPETS_MAX_RESULTS"])), strip=True, tags=[])
+
+    app.logger.debug("Request original q: {}".format(args.get("q", default="")))
+    app.logger.debug("Request bleached q: {}".format(q))
+    app.logger.debug("Request snips: {}".format(snips))
+    return q, snips
+
+
+@metrics.stage("query")
+def snippets_query(id, q, snips):
+    solr_query = query.snippets(id, q, snips)
+    log_query(solr_query)
+    return solr_query
 
 
 @app.route("/snippets/<id>")
+@metrics.timed("snippets")
+@profiling.profiled("snippets")
 def snippet_search(id):
     app.logger.info("Processing Snippet Search request for document {}".format(id))
 
-    q = bleach.clean(request.args.get("q", default=""), strip=True, tags=[])
-    snips = bleach.clean(request.args.get("snips", default=str(app.config["SNIPPETS_MAX_RESULTS"])), strip=True,
-                         tags=[])
+    q, snips = snippets_params(request.args)
 
-    app.logger.debug("Request original q: {}".format(request.args.get("q", default="")))
-    app.logger.debug("Request bleached q: {}".format(q))
-    app.logger.debug("Request snips: {}".format(snips))
+    cache_key = cache.snippets_key(id, q, snips)
+    cached = cache.get_cache("snippets").get(cache_key)
+    if cached is not None:
+        app.logger.info("Serving cached Snippet Search response for document {}".format(id))
+        return json_response(cached)
 
-    query_url = "{0}/{1}".format(app.config["SOLR_URL"], app.config["SOLR_CORE"])
-    query_url += "/select?hl=on&hl.weightMatches=true"
-    query_url += "&hl.snippets={}".format(snips)
-    query_url += "&df={}".format(app.config["OCR_TEXT_FIELD"])
-    query_url += "&hl.ocr.fl={}".format(app.config["OCR_TEXT_FIELD"])
-    query_url += "&hl.ocr.contextBlock={}".format(app.config["SNIPPET_CONTEXT"])
-    query_url += "&hl.ocr.contextSize={}".format(app.config["SNIPPET_CONTEXT_SIZE"])
-    query_url += "&hl.ocr.limitBlock={}".format(app.config["SNIPPET_CONTEXT_LIMIT"])
-    query_url += "&fq={0}:{1}".format(app.config["DOCUMENT_ID_FIELD"], id)
-    query_url += "&q={}".format(q)
-
-    app.logger.info("Built query: {}".format(query_url))
+    solr_query = snippets_query(id, q, snips)
 
     try:
-        solr_results = requests.get(query_url)
-        app.logger.debug("Solr request response code: {}".format(solr_results.status_code))
-        results_json = solr_results.json()
-        app.logger.debug("Solr JSON response code: {}".format(results_json["responseHeader"]["status"]))
-        docs = results_json["response"]["docs"]
-    except (requests.exceptions.ConnectionError, KeyError, ValueError) as e:
-        app.logger.error("Error occurred with SOLR query: {}".format(type(e)))
-        app.logger.error("Error message: {}".format(e))
+        results_json = fetch_json(solr_query)
+        docs = solr_docs(results_json)
+        cacheable = True
+    except (requests.exceptions.RequestException, KeyError, ValueError) as e:
+        log_solr_error(e)
         results_json = {}
         docs = []
+        cacheable = False
+
+    results = snippets_results(results_json, docs)
+    metrics.observe_hits(canvas_count(results))
+    if cacheable:
+        cache.get_cache("snippets").set(cache_key, results)
+
+    return json_response(results)
+
+
+def snippets_batch_params(args):
+    """Clean up the ids, query and snippet count for a batch Snippet Search, dropping duplicate and excess ids"""
+    q, snips = snippets_params(args)
+    id_regexp = re.compile(r'[^A-Za-z0-9-_]')
+    ids = []
+    for id in args.get("ids", default="").split(","):
+        id = id_regexp.sub("", id)
+        if id and id not in ids:
+            ids.append(id)
+    if len(ids) > app.config["SNIPPETS_BATCH_MAX_IDS"]:
+        app.logger.warning("Batch Snippet Search truncated to {} of {} documents".format(
+            app.config["SNIPPETS_BATCH_MAX_IDS"], len(ids)))
+        ids = ids[:app.config["SNIPPETS_BATCH_MAX_IDS"]]
+
+    app.logger.debug("Request ids: {}".format(ids))
+    return ids, q, snips
+
+
+@metrics.stage("query")
+def snippets_batch_query(ids, q, snips):
+    solr_query = query.snippets_batch(ids, q, snips)
+    log_query(solr_query)
+    return solr_query
+
+
+def cached_snippets(ids, q, snips):
+    """Return the cached Snippet Search results for those of the documents that have them, by document id"""
+    snippets_cache = cache.get_cache("snippets")
+    found = {}
+    for id in ids:
+        cached = snippets_cache.get(cache.snippets_key(id, q, snips))
+        if cached is not None:
+            found[id] = cached
+    return found
+
+
+def snippets_by_document(ids, results, q, snips, cacheable):
+    """Split the results of a batch Snippet Search by document, caching each as its own Snippet Search response"""
+    found = {id: [] for id in ids}
+    for result in results:
+        found.setdefault(result["id"], []).append(result)
+    if cacheable:
+        snippets_cache = cache.get_cache("snippets")
+        for id in ids:
+            snippets_cache.set(cache.snippets_key(id, q, snips), found[id])
+    return found
+
+
+@app.route("/snippets")
+@metrics.timed("snippets_batch")
+@profiling.profiled("snippets_batch")
+def snippet_batch_search():
+    ids, q, snips = snippets_batch_params(request.args)
+    app.logger.info("Processing batch Snippet Search request for {} documents".format(len(ids)))
+
+    found = cached_snippets(ids, q, snips)
+    missing = [id for id in ids if id not in found]
+    if missing:
+        solr_query = snippets_batch_query(missing, q, snips)
+
+        try:
+            results_json = fetch_json(solr_query)
+            docs = solr_docs(results_json)
+            cacheable = True
+        except (requests.exceptions.RequestException, KeyError, ValueError) as e:
+            log_solr_error(e)
+            results_json = {}
+            docs = []
+            cacheable = False
+
+        found.update(snippets_by_document(missing, snippets_results(results_json, docs), q, snips, cacheable))
 
+    results = [result for id in ids for result in found[id]]
+    metrics.observe_hits(canvas_count(results))
+    return json_response(results)
+
+
+def canvas_count(results):
+    """Count the highlighted canvases in Collection or Snippet Search results"""
+    return sum(len(result["canvases"]) for result in results)
+
+
+@metrics.stage("transform")
+def snippets_results(results_json, docs):
     results = []
     for doc in docs:
         result = {"id": doc[app.config["DOCUMENT_ID_FIELD"]],
@@ -266,41 +617,20 @@ def snippet_search(id):
                   }
         snippets = results_json["ocrHighlighting"][doc[app.config["DOCUMENT_ID_FIELD"]]][app.config["OCR_TEXT_FIELD"]]["snippets"]
 
-        for fragment in snippets:
-            x = fragment["regions"][0]["ulx"]
-            y = fragment["regions"][0]["uly"]
-            w = fragment["regions"][0]["lrx"] - fragment["regions"][0]["ulx"]
-            h = fragment["regions"][0]["lry"] - fragment["regions"][0]["uly"]
-            if "scale" in doc and doc["scale"] != 1:
-                x, y, w, h = int(x), int(y), int(w), int(h)
-                x, y, w, h = int(x * doc["scale"]), int(y * doc["scale"]), int(w * doc["scale"]), int(h * doc["scale"])
-                x, y, w, h = str(x), str(y), str(w), str(h)
-
+        scale = doc.get("scale", 1)
+        regions = geometry.xywh([fragment["regions"][0] for fragment in snippets], scale)
+        boxes = iter(geometry.xywh([part for fragment in snippets for highlight in fragment["highlights"]
+                                    for part in highlight], scale))
+        for fragment, (x, y, w, h) in zip(snippets, regions):
             canvas_doc = {"canvas": fragment["regions"][0]["page"],
                           "region": "{},{},{},{}".format(x, y, w, h),
                           "highlights": []}
 
             for highlight in fragment["highlights"]:
                 for part in highlight:
-
-                    x = int(part["ulx"])
-                    y = int(part["uly"])
-                    w = int((part["lrx"] - part["ulx"]))
-                    h = int((part["lry"] - part["uly"]))
-                    if "scale" in doc and doc["scale"] != 1:
-                        x, y, w, h = int(x), int(y), int(w), int(h)
-                        x, y, w, h = int(x * doc["scale"]), int(y * doc["scale"]), int(w * doc["scale"]),\
-                                     int(h * doc["scale"])
-                        x, y, w, h = str(x), str(y), str(w), str(h)
-
+                    x, y, w, h = next(boxes)
                     canvas_doc["highlights"].append({"coords": "{},{},{},{}".format(x, y, w, h),
                                                      "chars": part["text"]})
             result["canvases"].append(canvas_doc)
         results.append(result)
-
-    response = app.response_class(
-        response=json.dumps(results),
-        mimetype='application/json',
-        headers=[('Access-Control-Allow-Origin', '*')]
-    )
-    return response
+    return results